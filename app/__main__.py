@@ -0,0 +1,77 @@
+"""
+Command-line entry point:  python -m app <command> [options]
+
+Subcommand modules keep their heavy imports (torch, faiss, pandas) inside
+their run functions, so `--help` stays fast and each command only pulls in
+what it needs.
+"""
+import argparse, sys
+
+def _export_passages(args) -> None:
+    import os
+    from .config import load_config
+    from .passages import export_from_langchain
+    from .retriever import faiss_dir_for, load_embedder_from_dir
+    cfg = load_config(os.getenv("CONFIG_PATH", "./config.json"))
+    faiss_dir = args.faiss_dir or faiss_dir_for(cfg)
+    export_from_langchain(faiss_dir, args.out_dir)
+    if args.embedder:
+        load_embedder_from_dir(cfg)
+    if args.report:
+        import json
+        from .passages import memory_report
+        print(json.dumps(memory_report(faiss_dir, args.out_dir), indent=2))
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m app", description="BioMed RAG chatbot tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    from . import bench
+    p = sub.add_parser("bench", help="offline latency / throughput / retrieval-quality benchmark")
+    bench.add_arguments(p)
+    p.set_defaults(func=lambda a: bench.run_bench(a))
+
+    from . import batch
+    p = sub.add_parser("batch", help="answer a JSONL / Parquet / CSV file of questions in bulk (resumable)")
+    batch.add_arguments(p)
+    p.set_defaults(func=lambda a: batch.run_batch_job(a))
+
+    from . import indexer
+    p = sub.add_parser("build-index", help="stream passages.parquet into the FAISS index (resumable, appendable)")
+    indexer.add_arguments(p)
+    p.set_defaults(func=lambda a: indexer.run_build_index(a))
+
+    from . import ann
+    p = sub.add_parser("index-report", help="memory footprint vs recall@k for each ANN index type")
+    ann.add_report_arguments(p)
+    p.set_defaults(func=lambda a: ann.run_report(a))
+
+    from . import rerank
+    p = sub.add_parser("rerank-report", help="recall and prompt length with and without cross-encoder reranking")
+    rerank.add_report_arguments(p)
+    p.set_defaults(func=lambda a: rerank.run_report(a))
+
+    from . import cpu_backend
+    p = sub.add_parser("cpu-bench", help="tokens/sec, memory and fp32 answer parity for each CPU backend")
+    cpu_backend.add_arguments(p)
+    p.set_defaults(func=lambda a: cpu_backend.run_cpu_bench(a))
+
+    from . import embedding
+    p = sub.add_parser("export-embedder", help="export the query embedder to ONNX (+ int8) and check parity with torch")
+    embedding.add_arguments(p)
+    p.set_defaults(func=lambda a: embedding.run_export(a))
+
+    p = sub.add_parser("export-passages", help="write the mmap-able columnar passage store from index.pkl")
+    p.add_argument("--faiss-dir", default=None, help="LangChain index folder (default: FAISS_DIR)")
+    p.add_argument("--out-dir", default=None, help="destination (default: same folder)")
+    p.add_argument("--embedder", action="store_true", help="also export the embedder to EMBEDDER_DIR")
+    p.add_argument("--report", action="store_true",
+                   help="compare load time, lookup latency and resident memory with the pickled docstore")
+    p.set_defaults(func=_export_passages)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,238 @@
+"""
+ANN index types for the passage index, chosen with INDEX_TYPE in config:
+
+  flat      exact IndexFlatL2 scan (what FAISS.from_documents builds)
+  hnsw      HNSW graph over full vectors      INDEX_HNSW_M, INDEX_HNSW_EF_CONSTRUCTION / INDEX_HNSW_EF_SEARCH
+  ivf-flat  inverted lists, full vectors      INDEX_IVF_NLIST / INDEX_IVF_NPROBE
+  ivf-pq    inverted lists, PQ-coded vectors  + INDEX_PQ_M sub-quantizers of INDEX_PQ_NBITS bits
+  sq8       scalar-quantized int8 flat scan
+
+All types use the L2 metric, so the `1 - d/2` cosine mapping in retrieve_top_k_scored
+still holds (approximately, for the quantized ones). Build-time keys are read by
+`python -m app build-index`; the query-time keys (nprobe, efSearch) are applied whenever
+an index is loaded, so they can be tuned without rebuilding.
+"""
+import math, time
+from typing import Any, Dict, List
+
+import numpy as np
+
+INDEX_TYPES = ("flat", "hnsw", "ivf-flat", "ivf-pq", "sq8")
+
+def index_type(cfg: Dict[str, Any]) -> str:
+    kind = str(cfg.get("INDEX_TYPE", "flat")).lower()
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"Unknown INDEX_TYPE {kind!r}; expected one of {INDEX_TYPES}")
+    return kind
+
+def _nlist(cfg: Dict[str, Any], n: int) -> int:
+    nlist = int(cfg.get("INDEX_IVF_NLIST", 0))
+    if nlist <= 0:
+        # ~4*sqrt(n) lists, but keep >= 39 training points per centroid as faiss recommends
+        nlist = int(4 * math.sqrt(max(n, 1)))
+    return max(1, min(nlist, max(1, n // 39)))
+
+def _pq_m(cfg: Dict[str, Any], dim: int) -> int:
+    m = int(cfg.get("INDEX_PQ_M", 16))
+    # PQ needs m to divide the dimension; step down to the nearest divisor
+    while m > 1 and dim % m:
+        m -= 1
+    return m
+
+def factory_string(cfg: Dict[str, Any], dim: int, n: int) -> str:
+    kind = index_type(cfg)
+    if kind == "flat":
+        return "Flat"
+    if kind == "hnsw":
+        return f"HNSW{int(cfg.get('INDEX_HNSW_M', 32))}"
+    if kind == "sq8":
+        return "SQ8"
+    nlist = _nlist(cfg, n)
+    if kind == "ivf-flat":
+        return f"IVF{nlist},Flat"
+    return f"IVF{nlist},PQ{_pq_m(cfg, dim)}x{int(cfg.get('INDEX_PQ_NBITS', 8))}"
+
+def build_index(cfg: Dict[str, Any], vectors: np.ndarray, chunk_rows: int = 65536):
+    """Create, train (on a sample of at most INDEX_TRAIN_SIZE rows) and fill an index of the configured type."""
+    import faiss
+
+    n, dim = int(vectors.shape[0]), int(vectors.shape[1])
+    spec = factory_string(cfg, dim, n)
+    index = faiss.index_factory(dim, spec, faiss.METRIC_L2)
+    hnsw = getattr(faiss.downcast_index(index), "hnsw", None)
+    if hnsw is not None:
+        hnsw.efConstruction = int(cfg.get("INDEX_HNSW_EF_CONSTRUCTION", 200))
+    if not index.is_trained:
+        train_size = min(n, int(cfg.get("INDEX_TRAIN_SIZE", 100_000)))
+        # sorted sample rows keep reads sequential when `vectors` is a memmap
+        rows = np.sort(np.random.default_rng(0).choice(n, size=train_size, replace=False))
+        t0 = time.perf_counter()
+        index.train(np.ascontiguousarray(vectors[rows], dtype=np.float32))
+        print(f"  trained {spec} on {train_size} vectors in {time.perf_counter() - t0:.1f}s")
+    for start in range(0, n, chunk_rows):
+        index.add(np.ascontiguousarray(vectors[start:start + chunk_rows], dtype=np.float32))
+    apply_search_params(index, cfg)
+    return index
+
+def apply_search_params(index, cfg: Dict[str, Any]) -> None:
+    """Set query-time knobs (nprobe for IVF, efSearch for HNSW); a no-op for flat/SQ indexes."""
+    import faiss
+
+    ivf = faiss.try_extract_index_ivf(index) if hasattr(faiss, "try_extract_index_ivf") else None
+    if ivf is not None:
+        ivf.nprobe = min(int(cfg.get("INDEX_IVF_NPROBE", 16)), int(ivf.nlist))
+    hnsw = getattr(faiss.downcast_index(index), "hnsw", None)
+    if hnsw is not None:
+        hnsw.efSearch = int(cfg.get("INDEX_HNSW_EF_SEARCH", 64))
+
+def describe(index) -> Dict[str, Any]:
+    import faiss
+
+    inner = faiss.downcast_index(index)
+    out: Dict[str, Any] = {"class": type(inner).__name__, "ntotal": int(index.ntotal), "dim": int(index.d)}
+    ivf = faiss.try_extract_index_ivf(index) if hasattr(faiss, "try_extract_index_ivf") else None
+    if ivf is not None:
+        out["nlist"] = int(ivf.nlist)
+        out["nprobe"] = int(ivf.nprobe)
+    hnsw = getattr(inner, "hnsw", None)
+    if hnsw is not None:
+        out["efSearch"] = int(hnsw.efSearch)
+    return out
+
+_TYPE_OF_CLASS = {
+    "IndexFlat": "flat", "IndexFlatL2": "flat",
+    "IndexHNSWFlat": "hnsw",
+    "IndexIVFFlat": "ivf-flat",
+    "IndexIVFPQ": "ivf-pq",
+    "IndexScalarQuantizer": "sq8",
+}
+
+def build_settings(index) -> Dict[str, Any]:
+    """The config keys that rebuild `index` as it is: INDEX_TYPE plus whatever build keys it records."""
+    import faiss
+
+    inner = faiss.downcast_index(index)
+    kind = _TYPE_OF_CLASS.get(type(inner).__name__)
+    if kind is None:
+        raise ValueError(f"Cannot tell the INDEX_TYPE of a {type(inner).__name__}; expected one of {INDEX_TYPES}")
+    out: Dict[str, Any] = {"INDEX_TYPE": kind}
+    if kind.startswith("ivf"):
+        out["INDEX_IVF_NLIST"] = int(inner.nlist)
+    if kind == "ivf-pq":
+        out["INDEX_PQ_M"] = int(inner.pq.M)
+        out["INDEX_PQ_NBITS"] = int(inner.pq.nbits)
+    return out
+
+def memory_bytes(index) -> int:
+    """Serialized size, a close proxy for the resident footprint of every supported type."""
+    import faiss
+    return int(len(faiss.serialize_index(index)))
+
+def reconstruct_all(index, chunk_rows: int = 65536) -> np.ndarray:
+    """Recover stored vectors (exact for flat / hnsw / ivf-flat, approximate for ivf-pq / sq8)."""
+    import faiss
+
+    ivf = faiss.try_extract_index_ivf(index) if hasattr(faiss, "try_extract_index_ivf") else None
+    if ivf is not None:
+        ivf.make_direct_map()
+    out = np.empty((index.ntotal, index.d), dtype=np.float32)
+    for start in range(0, index.ntotal, chunk_rows):
+        n = min(chunk_rows, index.ntotal - start)
+        out[start:start + n] = index.reconstruct_n(start, n)
+    return out
+
+def is_lossy(index) -> bool:
+    import faiss
+    inner = faiss.downcast_index(index)
+    return isinstance(inner, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)) or hasattr(inner, "pq")
+
+# -----------------------------
+# Memory vs recall report
+# -----------------------------
+def _timed_search(index, queries: np.ndarray, k: int):
+    """Search one query at a time, the way /ask does, and return (rows, per-query ms)."""
+    rows, lat = [], []
+    for q in queries:
+        t0 = time.perf_counter()
+        _, I = index.search(q[None, :], k)
+        lat.append((time.perf_counter() - t0) * 1000.0)
+        rows.append(I[0])
+    return np.asarray(rows), lat
+
+def _overlap(approx: np.ndarray, exact: np.ndarray, k: int) -> float:
+    hits = sum(len(set(a[:k]) & set(e[:k])) for a, e in zip(approx, exact))
+    return round(hits / float(k * len(exact)), 4) if len(exact) else 0.0
+
+def run_report(args) -> Dict[str, Any]:
+    """
+    Build every requested index type from the exact vectors of the current index and
+    compare memory, build time, single-query latency, overlap with exact top-k, and
+    recall@k / hit@k / MRR against the test set's relevant_passage_ids.
+    """
+    import json, os
+    import faiss
+    from .bench import load_test_set, retrieval_metrics, summarize
+    from .config import load_config
+    from .passages import PassageStore, iter_langchain_docstore, store_exists
+    from .retriever import faiss_dir_for, load_embedder_from_dir
+
+    cfg = load_config(os.getenv("CONFIG_PATH", "./config.json"))
+    faiss_dir = args.faiss_dir or faiss_dir_for(cfg)
+    source = faiss.read_index(os.path.join(faiss_dir, "index.faiss"))
+    if is_lossy(source):
+        print("⚠ The current index is quantized; the 'exact' baseline is computed from its approximate vectors.")
+    vectors = reconstruct_all(source)
+    if store_exists(faiss_dir):
+        doc_ids = np.asarray(PassageStore(faiss_dir).doc_ids)
+    else:
+        doc_ids = np.asarray([d for _, d in iter_langchain_docstore(faiss_dir)], dtype=np.int64)
+
+    tests = load_test_set(args.test_set, args.limit)
+    embedder = load_embedder_from_dir(cfg)
+    queries = np.asarray(embedder.embed_documents([t["question"] for t in tests]), dtype=np.float32)
+    relevant = [t["relevant"] for t in tests]
+    k_values = [int(x) for x in args.k_values.split(",") if x.strip()]
+    k = max(k_values)
+
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    exact_rows, _ = _timed_search(exact, queries, k)
+
+    results: List[Dict[str, Any]] = []
+    for kind in [t.strip() for t in args.types.split(",") if t.strip()]:
+        kcfg = dict(cfg, INDEX_TYPE=kind)
+        t0 = time.perf_counter()
+        index = build_index(kcfg, vectors)
+        build_s = time.perf_counter() - t0
+        rows, lat = _timed_search(index, queries, k)
+        ranked = [[int(doc_ids[r]) for r in rs if r >= 0] for rs in rows]
+        entry = {
+            "type": kind,
+            "factory": factory_string(kcfg, vectors.shape[1], len(vectors)),
+            "index": describe(index),
+            "memory_mb": round(memory_bytes(index) / 2**20, 2),
+            "build_s": round(build_s, 2),
+            "search": summarize(lat),
+            f"overlap_with_exact@{k}": _overlap(rows, exact_rows, k),
+            "retrieval": retrieval_metrics(ranked, relevant, k_values),
+        }
+        results.append(entry)
+        print(f"  {kind:9s} {entry['memory_mb']:9.2f} MB  p50 {entry['search']['p50_ms']:.3f} ms  "
+              f"overlap@{k} {entry[f'overlap_with_exact@{k}']:.3f}  recall@{k} {entry['retrieval'].get(f'recall@{k}')}")
+
+    report = {"faiss_dir": faiss_dir, "vectors": int(len(vectors)), "dim": int(vectors.shape[1]),
+              "questions": len(tests), "results": results}
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ Wrote {args.out}")
+    return report
+
+def add_report_arguments(p) -> None:
+    p.add_argument("--types", default=",".join(INDEX_TYPES), help="comma-separated index types to compare")
+    p.add_argument("--faiss-dir", default=None, help="index folder to read vectors from (default: FAISS_DIR)")
+    p.add_argument("--test-set", default=None, help="test.parquet / df_test.csv (default: data/test.parquet)")
+    p.add_argument("--limit", type=int, default=500, help="number of test questions")
+    p.add_argument("--k-values", default="1,5,10")
+    p.add_argument("--out", default="bench_results/index_report.json")
@@ -0,0 +1,447 @@
+"""
+ASGI serving mode (Starlette + uvicorn).
+
+Same contracts as the Flask app in app.main (/ask, /ask/stream, /ask/batch, /health, /reload, /reload/rollback),
+but request handling never blocks the event loop:
+  * rewriting/generation run on a dedicated single-thread executor (or the batch scheduler),
+  * embedding + FAISS search run on a small retrieval executor,
+  * admission control bounds in-flight + queued requests (429 when full, 503 before startup),
+  * every request has a timeout (504) and is cancelled when the client disconnects,
+  * streamed responses keep their admission slot and deadline until the last chunk is sent.
+
+Run with:  python -m app.asgi   (or: uvicorn app.asgi:app --port 8080)
+"""
+import asyncio, contextvars, json, os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import Optional
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+
+from . import main as core
+from . import metrics
+
+CFG = core.CFG
+
+_gen_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gen")
+_retrieval_executor = ThreadPoolExecutor(
+    max_workers=int(CFG.get("RETRIEVAL_WORKERS", 2)), thread_name_prefix="retrieval"
+)
+# steps /ask/batch generators; one thread, so a step and the close that follows it never overlap
+_batch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch")
+_ready = asyncio.Event()
+
+class Overloaded(Exception):
+    pass
+
+class AdmissionController:
+    """At most max_concurrent requests run; up to max_queue more may wait; the rest are rejected."""
+
+    def __init__(self, max_concurrent: int, max_queue: int):
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.max_queue = max(0, int(max_queue))
+        self._sem = asyncio.Semaphore(self.max_concurrent)
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    async def acquire(self) -> None:
+        if self._sem.locked() and self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise Overloaded()
+        self.waiting += 1
+        try:
+            await self._sem.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+
+    def release(self) -> None:
+        self.active -= 1
+        self._sem.release()
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+        }
+
+admission = AdmissionController(
+    int(CFG.get("ASGI_MAX_CONCURRENCY", 8)),
+    int(CFG.get("ASGI_MAX_QUEUE", 32)),
+)
+
+async def _in(executor, fn, *args, **kwargs):
+    # carry the request's context (and its trace) into the worker thread
+    ctx = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(ctx.run, fn, *args, **kwargs))
+
+def _blocking_in(executor, fn):
+    """fn as a blocking call that runs on `executor` in the caller's context (trace, pinned index)."""
+    def run(*args, **kwargs):
+        ctx = contextvars.copy_context()
+        return executor.submit(ctx.run, fn, *args, **kwargs).result()
+    return run
+
+async def _watch_disconnect(request: Request, task: asyncio.Task):
+    while not task.done():
+        if await request.is_disconnected():
+            task.cancel()
+            return
+        await asyncio.sleep(0.25)
+
+def _timeout_s() -> float:
+    return float(CFG.get("ASGI_REQUEST_TIMEOUT_S", 120))
+
+async def _bounded(request: Request, coro, timeout: float):
+    task = asyncio.ensure_future(coro)
+    watcher = asyncio.ensure_future(_watch_disconnect(request, task))
+    try:
+        return await asyncio.wait_for(task, timeout=timeout)
+    finally:
+        watcher.cancel()
+
+def _not_ready():
+    return JSONResponse(core.not_ready_response(), status_code=503, headers={"Retry-After": "5"})
+
+def _busy():
+    return JSONResponse({"error": "Server busy, try again later"}, status_code=429, headers={"Retry-After": "1"})
+
+async def _guarded(request: Request, coro):
+    """Run coro under admission control, the request timeout and disconnect cancellation."""
+    if not _ready.is_set() or not core.is_ready():
+        coro.close()
+        return _not_ready()
+    try:
+        async with admission.slot():
+            return await _bounded(request, coro, _timeout_s())
+    except Overloaded:
+        coro.close()
+        return _busy()
+    except asyncio.TimeoutError:
+        return JSONResponse({"error": "Request timed out"}, status_code=504)
+    except asyncio.CancelledError:
+        # client went away; nobody will read this response
+        return JSONResponse({"error": "Client disconnected"}, status_code=499)
+
+class _HeldStreamingResponse(StreamingResponse):
+    """A StreamingResponse that runs `release` once the body is exhausted, fails or is abandoned."""
+
+    def __init__(self, content, release, **kwargs):
+        super().__init__(content, **kwargs)
+        self._release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            try:
+                aclose = getattr(self.body_iterator, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+            finally:
+                self._release()
+
+async def _guarded_stream(request: Request, start, **response_kwargs):
+    """
+    _guarded for streamed bodies: the admission slot is held, and the request timeout enforced,
+    until the body is exhausted or the client goes away, not just while the response is built.
+    start(deadline) is a coroutine returning the body as an async iterator that honours `deadline`
+    (event-loop time).
+    """
+    if not _ready.is_set() or not core.is_ready():
+        return _not_ready()
+    try:
+        await admission.acquire()
+    except Overloaded:
+        return _busy()
+    released = False
+
+    def release():
+        nonlocal released
+        if not released:
+            released = True
+            admission.release()
+
+    timeout = _timeout_s()
+    try:
+        body = await _bounded(request, start(asyncio.get_running_loop().time() + timeout), timeout)
+    except asyncio.TimeoutError:
+        release()
+        return JSONResponse({"error": "Request timed out"}, status_code=504)
+    except asyncio.CancelledError:
+        release()
+        return JSONResponse({"error": "Client disconnected"}, status_code=499)
+    except BaseException:
+        release()
+        raise
+    return _HeldStreamingResponse(body, release, **response_kwargs)
+
+async def _iterate(executor, lines, deadline: float, on_timeout: str,
+                   ctx: Optional[contextvars.Context] = None):
+    """
+    Step the sync generator `lines` on `executor`, one next() per chunk, so its work stays on the
+    executor that owns it instead of Starlette's threadpool. Every step runs in one context, `ctx`
+    or a copy of the iterating one (a trace or pinned index set by the generator survives between
+    steps). Past `deadline` the `on_timeout` chunk is sent and the generator is closed.
+    """
+    loop = asyncio.get_running_loop()
+    ctx = ctx if ctx is not None else contextvars.copy_context()
+    done = object()
+    try:
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            line = await asyncio.wait_for(loop.run_in_executor(executor, ctx.run, next, lines, done), remaining)
+            if line is done:
+                return
+            yield line
+    except asyncio.TimeoutError:
+        yield on_timeout
+    finally:
+        # queued behind any step still running; a generator cannot be closed while it executes
+        try:
+            executor.submit(ctx.run, lines.close)
+        except RuntimeError:  # executor already shut down
+            pass
+
+async def _sent(*lines: str):
+    for line in lines:
+        yield line
+
+async def _retrieve(question: str, k: int, preferred_option: str):
+    fetch = core.rerank_fetch_k(k)
+    probed = await _in(_retrieval_executor, core.probe_stage, question, fetch)
+    if probed is not None:
+        rewritten, (hits, ctx) = question, probed
+    else:
+        rewritten = await _in(_gen_executor, core.rewrite_stage, question, preferred_option)
+        hits, ctx = await _in(_retrieval_executor, core.search_stage, rewritten, fetch)
+    hits, ctx = await _in(_retrieval_executor, core.rerank_stage, question, hits, ctx, k)
+    ctx = await _in(_retrieval_executor, core.context_stage, question, hits, ctx)
+    return rewritten, hits, ctx
+
+async def _generate(question: str, ctx: str) -> str:
+    if core.scheduler is not None:
+        with metrics.span("generate"):
+            # cancelling the wrapped future drops the request from the batch queue if not yet running
+            answer, stats = await asyncio.wrap_future(core.scheduler.submit_async(question, ctx))
+        core.record_generation(stats)
+        return answer
+    return await _in(_gen_executor, core.generate_stage, question, ctx)
+
+async def _ask(question: str, k: int, preferred_option: str, inline: bool):
+    metrics.start_trace(inline=inline)
+    try:
+        payload = core.cached_answer(question, k, preferred_option)
+        outcome = "cached" if payload is not None else "ok"
+        if payload is None:
+            # _in copies the context, so the pinned version follows the stages into the executors
+            with core.pin_index():
+                rewritten, hits, ctx = await _retrieve(question, k, preferred_option)
+                (payload,), (vec,) = await _in(_retrieval_executor, core.semantic_answers, [question], k,
+                                               preferred_option, [(rewritten, hits)])
+                if payload is not None:
+                    outcome = "semantic_cache"
+                else:
+                    answer = await _generate(question, ctx)
+                    payload = core.ask_response(question, rewritten, answer, hits)
+                    core.remember_answer(question, k, preferred_option, payload, vec)
+    except BaseException:
+        metrics.finish_request("ask", "error")
+        raise
+    timings = metrics.finish_request("ask", outcome)
+    if inline:
+        payload = {**payload, "timings": timings}
+    return JSONResponse(payload)
+
+async def _json_body(request: Request):
+    try:
+        return await request.json() or {}
+    except ValueError:
+        return {}
+
+async def index(request: Request):
+    return FileResponse(os.path.join(core.app.static_folder, "index.html"))
+
+async def health(request: Request):
+    if not _ready.is_set():
+        return JSONResponse({"status": "starting"}, status_code=503)
+    payload = core.health_payload()
+    payload["admission"] = admission.stats()
+    return JSONResponse(payload)
+
+async def metrics_endpoint(request: Request):
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+async def ask(request: Request):
+    data = await _json_body(request)
+    try:
+        question, k, preferred_option = core.parse_ask_request(data)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    inline = core.wants_timings(data, request.query_params)
+    return await _guarded(request, _ask(question, k, preferred_option, inline))
+
+async def ask_stream(request: Request):
+    data = await _json_body(request) if request.method == "POST" else request.query_params
+    try:
+        question, k, preferred_option = core.parse_ask_request(data)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    async def _start(deadline: float):
+        metrics.start_trace()
+        try:
+            payload = core.cached_answer(question, k, preferred_option)
+            if payload is not None:
+                metrics.finish_request("ask_stream", "cached")
+                return _sent(
+                    core.sse_event("meta", {key: payload[key] for key in ("question", "rewritten", "sources")}),
+                    core.sse_event("done", {"answer": payload["answer"]}),
+                )
+            with core.pin_index() as handle:
+                rewritten, hits, ctx = await _retrieve(question, k, preferred_option)
+                (payload,), (vec,) = await _in(_retrieval_executor, core.semantic_answers, [question], k,
+                                               preferred_option, [(rewritten, hits)], handle.version)
+        except BaseException:
+            metrics.finish_request("ask_stream", "error")
+            raise
+        version = handle.version
+        if payload is not None:
+            metrics.finish_request("ask_stream", "semantic_cache")
+            return _sent(
+                core.sse_event("meta", {key: payload[key] for key in
+                                        ("question", "rewritten", "sources", "index_version", "semantic_cache")}),
+                core.sse_event("done", {"answer": payload["answer"]}),
+            )
+
+        def events():
+            outcome = "ok"
+            try:
+                yield core.sse_event("meta", {
+                    "question": question,
+                    "rewritten": rewritten if core.rewriter_enabled() else None,
+                    "sources": hits,
+                    "index_version": version,
+                })
+                for kind, text in core.stream_answer(question, ctx):
+                    if kind == "token":
+                        yield core.sse_event("token", {"text": text})
+                    else:
+                        # the pin was released before streaming; a swap since then retired this answer's version
+                        if handle is core.indexes.current:
+                            core.remember_answer(question, k, preferred_option,
+                                                 core.ask_response(question, rewritten, text, hits, version), vec)
+                        yield core.sse_event("done", {"answer": text})
+            except Exception as e:
+                outcome = "error"
+                yield core.sse_event("error", {"error": str(e)})
+            finally:
+                metrics.finish_request("ask_stream", outcome)
+
+        # each token is pulled on the generation executor; closing the generator stops generate.
+        # The steps run in this context so generation spans land on the trace started above.
+        return _iterate(_gen_executor, events(), deadline, core.sse_event("error", {"error": "Request timed out"}),
+                        contextvars.copy_context())
+
+    return await _guarded_stream(
+        request, _start,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+async def ask_batch(request: Request):
+    data = await _json_body(request)
+    try:
+        records, k, preferred_option = core.parse_batch_request(data)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    async def _start(deadline: float):
+        # one admission slot for the whole job: chunk retrieval runs on the retrieval executor,
+        # generation groups on the scheduler (or the generation executor), in step with the stream
+        generate = core.generate_group if core.scheduler is not None else _blocking_in(_gen_executor, core.generate_batch)
+        lines = core.batch_lines(records, k, preferred_option, generate=generate,
+                                 retrieve=_blocking_in(_retrieval_executor, core.retrieve_batch_stage))
+        return _iterate(_batch_executor, lines, deadline, json.dumps({"error": "Request timed out"}) + "\n")
+
+    return await _guarded_stream(request, _start, media_type="application/x-ndjson")
+
+async def reload_index(request: Request):
+    data = await _json_body(request)
+    try:
+        version, run_async = core.parse_reload_request(data)
+        if run_async:
+            core.reload_in_background(version)
+            return JSONResponse({"status": "loading", "version": version}, status_code=202)
+        # loads on a worker thread; requests keep being served from the active version meanwhile
+        result = await asyncio.get_running_loop().run_in_executor(None, core.reload_vector_db, version)
+        return JSONResponse({"status": "reloaded", **result})
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    except RuntimeError as e:
+        return JSONResponse({"error": str(e)}, status_code=409)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+async def rollback_index(request: Request):
+    try:
+        result = await asyncio.get_running_loop().run_in_executor(None, lambda: core.reload_vector_db(rollback=True))
+        return JSONResponse({"status": "rolled_back", **result})
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    except RuntimeError as e:
+        return JSONResponse({"error": str(e)}, status_code=409)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+@asynccontextmanager
+async def lifespan(app):
+    await asyncio.get_running_loop().run_in_executor(None, core.startup)
+    _ready.set()
+    try:
+        yield
+    finally:
+        if core.scheduler is not None:
+            core.scheduler.stop()
+        _gen_executor.shutdown(wait=False, cancel_futures=True)
+        _retrieval_executor.shutdown(wait=False, cancel_futures=True)
+        _batch_executor.shutdown(wait=False, cancel_futures=True)
+
+app = Starlette(
+    routes=[
+        Route("/", index, methods=["GET"]),
+        Route("/health", health, methods=["GET"]),
+        Route("/metrics", metrics_endpoint, methods=["GET"]),
+        Route("/ask", ask, methods=["POST"]),
+        Route("/ask/stream", ask_stream, methods=["GET", "POST"]),
+        Route("/ask/batch", ask_batch, methods=["POST"]),
+        Route("/reload", reload_index, methods=["POST"]),
+        Route("/reload/rollback", rollback_index, methods=["POST"]),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])],
+    lifespan=lifespan,
+)
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=int(CFG.get("PORT", 8080)), log_level="info")
@@ -0,0 +1,230 @@
+"""
+Bulk question answering, shared by POST /ask/batch and `python -m app batch`.
+
+Questions are processed in chunks. Each chunk is retrieved with one batched
+embed_documents call and one index.search over the query matrix
+(main.retrieve_batch_stage), then sorted by prompt length and generated in padded
+groups of ASK_BATCH_GEN_SIZE, so rows in a group need little padding. Results are
+yielded per group as JSON-serialisable dicts, one per question, tagged with its id.
+
+The CLI streams them to a JSONL file and, when rerun on the same output, skips ids
+that are already there, so an interrupted job resumes where it stopped.
+"""
+import json, os, time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+Record = Dict[str, Any]
+
+def _record(raw: Any, row: int) -> Optional[Record]:
+    if isinstance(raw, str):
+        raw = {"question": raw}
+    question = str(raw.get("question") or "").strip()
+    if not question:
+        return None
+    rid = raw.get("id", raw.get("doc_id", row))
+    return {"id": rid if isinstance(rid, (int, str)) else str(rid), "question": question}
+
+def read_questions(path: str) -> List[Record]:
+    """Questions from .jsonl (objects or bare strings), .parquet or .csv; ids default to the row number."""
+    raws: List[Any]
+    if path.endswith(".parquet") or path.endswith(".csv"):
+        from .bench import read_records
+        raws = read_records(path, ("id", "doc_id", "question"))
+        if path.endswith(".csv"):
+            # csv cells are strings; integer ids stay integers, as in a parquet or JSONL input
+            for raw in raws:
+                for key in ("id", "doc_id"):
+                    if isinstance(raw.get(key), str) and raw[key].lstrip("-").isdigit():
+                        raw[key] = int(raw[key])
+        # a missing id falls back to doc_id, then the row number
+        raws = [{k: v for k, v in raw.items() if v is not None} for raw in raws]
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            raws = [json.loads(line) for line in f if line.strip()]
+    out = []
+    for row, raw in enumerate(raws):
+        rec = _record(raw, row)
+        if rec is not None:
+            out.append(rec)
+    return out
+
+def records_from_payload(data: Any, max_questions: int) -> List[Record]:
+    """/ask/batch body: {"questions": [str | {"id", "question"}]} or a plain list; raises ValueError."""
+    items = data.get("questions") if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        raise ValueError("Missing 'questions' (a non-empty list)")
+    if len(items) > max_questions:
+        raise ValueError(f"Too many questions ({len(items)} > {max_questions}); use `python -m app batch` for bulk jobs")
+    records = [_record(raw, row) for row, raw in enumerate(items) if isinstance(raw, (str, dict))]
+    records = [r for r in records if r is not None]
+    if not records:
+        raise ValueError("No non-empty questions")
+    return records
+
+def _chunks(seq: List[Any], size: int) -> Iterator[List[Any]]:
+    for i in range(0, len(seq), max(1, size)):
+        yield seq[i:i + size]
+
+def prompt_length_fn(tokenizer) -> Callable[[str, str], int]:
+    """Sort key for generation groups: prompt tokens when a tokenizer is loaded, characters otherwise."""
+    from .context import BudgetedContext
+    from .gemma import build_answer_prompt, budgeted_prompt_ids
+
+    def length(question: str, ctx) -> int:
+        intent, prompt = build_answer_prompt(question, ctx)
+        if prompt is None:
+            return 0
+        if tokenizer is None:
+            return len(prompt)
+        if isinstance(ctx, BudgetedContext):
+            return len(budgeted_prompt_ids(tokenizer, intent, question, ctx))
+        return len(tokenizer(prompt, add_special_tokens=True)["input_ids"])
+    return length
+
+def iter_answers(
+    records: List[Record],
+    k: int,
+    preferred_option: str = "Option 2",
+    gen_batch_size: int = 16,
+    chunk_size: int = 256,
+    generate: Optional[Callable[[List[Tuple[str, str]]], List[Tuple[str, Dict[str, Any]]]]] = None,
+    retrieve: Optional[Callable[[List[str], int, str], List[Tuple[str, Any, Any]]]] = None,
+) -> Iterator[Record]:
+    """
+    Yield one /ask-shaped payload (plus "id") per record, group by group. Output order
+    follows generation order, not input order; match results back by id.
+    `retrieve` defaults to main.retrieve_batch_stage, `generate` to main.generate_group.
+    """
+    from . import main as core
+
+    generate = generate or core.generate_group
+    retrieve = retrieve or core.retrieve_batch_stage
+    length = prompt_length_fn(core.tokenizer)
+    for chunk in _chunks(records, chunk_size):
+        todo = []
+        for rec in chunk:
+            payload = core.cached_answer(rec["question"], k, preferred_option)
+            if payload is not None:
+                yield {"id": rec["id"], **payload, "cached": True}
+            else:
+                todo.append(rec)
+        if not todo:
+            continue
+        # pinned per chunk: a generator's context does not survive across threadpool next() calls
+        with core.pin_index() as handle:
+            retrieved = retrieve([r["question"] for r in todo], k, preferred_option)
+            semantic, vecs = core.semantic_answers([r["question"] for r in todo], k, preferred_option,
+                                                   [(rw, hits) for rw, hits, _ in retrieved], handle.version)
+        version = handle.version
+        for rec, payload in zip(todo, semantic):
+            if payload is not None:
+                yield {"id": rec["id"], **payload, "cached": True}
+        items = [(rec["question"], ctx) for rec, (_, _, ctx) in zip(todo, retrieved)]
+        order = sorted((i for i in range(len(items)) if semantic[i] is None), key=lambda i: length(*items[i]))
+        for group in _chunks(order, gen_batch_size):
+            with core.span("batch_generate"):
+                results = generate([items[i] for i in group])
+            for i, (answer, stats) in zip(group, results):
+                rewritten, hits, _ = retrieved[i]
+                payload = core.ask_response(todo[i]["question"], rewritten, answer, hits, version)
+                core.remember_answer(todo[i]["question"], k, preferred_option, payload, vecs[i])
+                out = {"id": todo[i]["id"], **payload}
+                if stats and "prompt_tokens" in stats:
+                    out["batch"] = {key: stats[key] for key in ("prompt_tokens", "generated_tokens", "batch_size")
+                                    if key in stats}
+                yield out
+
+# -----------------------------
+# Offline job runner
+# -----------------------------
+def completed_ids(out_path: str) -> Set[Any]:
+    """Ids already answered in `out_path`; a torn last line from a crash is cut off."""
+    done: Set[Any] = set()
+    if not os.path.exists(out_path):
+        return done
+    good = 0
+    with open(out_path, "rb") as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)["id"])
+            except (ValueError, KeyError):
+                break
+            good += len(line)
+    with open(out_path, "r+b") as f:
+        f.truncate(good)
+    return done
+
+def _stub_generate(ms_per_token: float) -> Callable[[List[Tuple[str, str]]], List[Tuple[str, Dict[str, Any]]]]:
+    from .bench import StubGenerator
+    stub = StubGenerator(ms_per_token)
+    return lambda items: [(answer, {}) for answer in stub(items)]
+
+def _per_request_baseline(records: List[Record], k: int, preferred_option: str, generate) -> float:
+    """Seconds per question through the one-at-a-time /ask path (retrieve_context + single generation)."""
+    from . import main as core
+    t0 = time.perf_counter()
+    for rec in records:
+        _, _, ctx = core.retrieve_context(rec["question"], k, preferred_option)
+        generate([(rec["question"], ctx)])
+    return (time.perf_counter() - t0) / max(1, len(records))
+
+def run_batch_job(args) -> Dict[str, Any]:
+    from . import main as core
+
+    records = read_questions(args.input)
+    if args.limit:
+        records = records[: args.limit]
+    if args.restart and os.path.exists(args.out):
+        os.remove(args.out)
+    done = completed_ids(args.out)
+    todo = [r for r in records if r["id"] not in done]
+    print(f"📝 {len(records)} questions, {len(done)} already answered in {args.out}, {len(todo)} to go")
+
+    core.startup(load_model=not args.stub, background=False)
+    generate = _stub_generate(args.stub_ms_per_token) if args.stub else None
+    k = int(args.k or core.CFG.get("TOP_K_DEFAULT", 5))
+    gen_size = int(args.gen_batch_size or core.CFG.get("ASK_BATCH_GEN_SIZE", 16))
+
+    per_q = None
+    if args.compare and records:
+        # timed before the job so the batch run cannot warm its caches
+        per_q = _per_request_baseline(records[: args.compare], k, args.preferred_option,
+                                      generate or core.generate_batch)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    t0 = time.perf_counter()
+    written = 0
+    with open(args.out, "a", encoding="utf-8") as f:
+        for result in iter_answers(todo, k, args.preferred_option, gen_size, args.chunk_size, generate=generate):
+            f.write(json.dumps(result) + "\n")
+            written += 1
+            if written % gen_size == 0:
+                f.flush()
+                print(f"  {written}/{len(todo)} answered ({written / (time.perf_counter() - t0):.2f} q/s)")
+    elapsed = time.perf_counter() - t0
+    summary: Dict[str, Any] = {
+        "questions": written,
+        "seconds": round(elapsed, 2),
+        "questions_per_second": round(written / elapsed, 3) if elapsed else None,
+        "out": args.out,
+    }
+    if per_q:
+        summary["per_request_questions_per_second"] = round(1.0 / per_q, 3)
+        if summary["questions_per_second"]:
+            summary["speedup"] = round(summary["questions_per_second"] * per_q, 2)
+    print(json.dumps(summary, indent=2))
+    return summary
+
+def add_arguments(p) -> None:
+    p.add_argument("--input", required=True, help="questions: .jsonl, .parquet or .csv (e.g. data/df_test.csv)")
+    p.add_argument("--out", default="bench_results/answers.jsonl", help="JSONL output; rerun to resume")
+    p.add_argument("--k", type=int, default=None, help="passages per question (default: TOP_K_DEFAULT)")
+    p.add_argument("--preferred-option", default="Option 2")
+    p.add_argument("--gen-batch-size", type=int, default=None, help="rows per generate call (default: ASK_BATCH_GEN_SIZE)")
+    p.add_argument("--chunk-size", type=int, default=256, help="questions retrieved per batched embed/search")
+    p.add_argument("--limit", type=int, default=None)
+    p.add_argument("--restart", action="store_true", help="discard existing output instead of resuming")
+    p.add_argument("--stub", action="store_true", help="model-free extractive generator (see bench --stub)")
+    p.add_argument("--stub-ms-per-token", type=float, default=0.0)
+    p.add_argument("--compare", type=int, default=0, metavar="N",
+                   help="also time N questions through the per-request path and report the speedup")
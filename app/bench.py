@@ -0,0 +1,366 @@
+"""
+Offline benchmark: replays the BioASQ test questions through the real pipeline stages.
+
+    python -m app bench --limit 200 --stub --concurrency 1,4,8 --out bench.json
+    python -m app bench --limit 50 --baseline bench_prev.json
+
+Reports per-stage latency percentiles (rewrite, embed, search, rerank, context filter, generate),
+end-to-end throughput at several concurrency levels, and retrieval quality
+(recall@k, hit@k, MRR) against relevant_passage_ids. Results are written as JSON.
+"""
+import ast, json, os, subprocess, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from .config import load_config
+
+STAGES = ("rewrite", "embed", "search", "rerank", "context_filter", "generate")
+_DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+def percentile(values: Sequence[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    xs = sorted(values)
+    pos = (len(xs) - 1) * pct / 100.0
+    lo = int(pos)
+    hi = min(lo + 1, len(xs) - 1)
+    return xs[lo] + (xs[hi] - xs[lo]) * (pos - lo)
+
+def summarize(values: Sequence[float]) -> Dict[str, float]:
+    return {
+        "n": len(values),
+        "mean_ms": round(sum(values) / len(values), 3) if values else 0.0,
+        "p50_ms": round(percentile(values, 50), 3),
+        "p95_ms": round(percentile(values, 95), 3),
+        "p99_ms": round(percentile(values, 99), 3),
+    }
+
+def _parse_ids(raw: Any) -> List[int]:
+    if raw is None:
+        return []
+    if isinstance(raw, str):
+        raw = ast.literal_eval(raw) if raw.strip() else []
+    return [int(x) for x in raw]
+
+def read_records(path: str, columns: Optional[Sequence[str]] = None) -> List[Dict[str, Any]]:
+    """
+    Rows of a .parquet (pyarrow) or .csv (csv module) file as dicts, restricted to `columns`
+    where given; empty CSV cells become None. Keeps pandas out of the requirements.
+    """
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        names = pq.read_schema(path).names
+        wanted = [c for c in columns if c in names] if columns is not None else None
+        return pq.read_table(path, columns=wanted).to_pylist()
+    import csv
+    csv.field_size_limit(2**31 - 1)
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        rows = list(csv.DictReader(f))
+    return [{k: (v if v != "" else None) for k, v in row.items() if columns is None or k in columns} for row in rows]
+
+def load_test_set(path: Optional[str] = None, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Questions + relevant_passage_ids from data/test.parquet (falls back to data/df_test.csv)."""
+    path = path or os.path.join(_DATA_DIR, "test.parquet")
+    if not (path.endswith(".parquet") and os.path.exists(path)):
+        path = path if path.endswith(".csv") else os.path.join(_DATA_DIR, "df_test.csv")
+    out: List[Dict[str, Any]] = []
+    seen = set()
+    for row in read_records(path, ("question", "relevant_passage_ids", "answer")):
+        question = row.get("question")
+        if question is None or question in seen:
+            continue
+        seen.add(question)
+        out.append({"question": str(question), "relevant": _parse_ids(row.get("relevant_passage_ids")),
+                    "answer": str(row.get("answer") or "")})
+        if limit and len(out) >= int(limit):
+            break
+    return out
+
+def retrieval_metrics(ranked: List[List[int]], relevant: List[List[int]], k_values: Sequence[int]) -> Dict[str, float]:
+    """
+    recall@k, hit@k and MRR averaged over the questions that have relevant_passage_ids; the
+    ones without are left out of every denominator and counted in questions_skipped.
+    """
+    pairs = [(ids, set(rel)) for ids, rel in zip(ranked, relevant) if rel]
+    out: Dict[str, float] = {"questions_evaluated": len(pairs), "questions_skipped": len(ranked) - len(pairs)}
+    n = len(pairs)
+    if not n:
+        return out
+    for k in k_values:
+        recall = hit = 0.0
+        for ids, rel_set in pairs:
+            found = len(rel_set.intersection(ids[:k]))
+            recall += found / len(rel_set)
+            hit += 1.0 if found else 0.0
+        out[f"recall@{k}"] = round(recall / n, 4)
+        out[f"hit@{k}"] = round(hit / n, 4)
+    mrr = 0.0
+    for ids, rel_set in pairs:
+        for rank, doc_id in enumerate(ids, start=1):
+            if doc_id in rel_set:
+                mrr += 1.0 / rank
+                break
+    out["mrr"] = round(mrr / n, 4)
+    return out
+
+class StubGenerator:
+    """
+    Model-free stand-in for Gemma so the harness runs in seconds on a CPU-only box.
+    It still builds the real intent prompt (so context filtering is exercised) and
+    answers with the first focused sentence, sleeping per pseudo-token if asked to.
+    """
+
+    def __init__(self, ms_per_token: float = 0.0, max_new_tokens: int = 32):
+        self.ms_per_token = ms_per_token
+        self.max_new_tokens = max_new_tokens
+
+    def __call__(self, items: List[Tuple[str, str]]) -> List[str]:
+        from .gemma import build_answer_prompt, postprocess_answer
+        from .intent import FALLBACK_LINE
+        out = []
+        for question, context in items:
+            intent, prompt = build_answer_prompt(question, context)
+            if prompt is None:
+                out.append(FALLBACK_LINE)
+                continue
+            focused = prompt.split("Context:\n", 1)[-1].split("\n\nQuestion:", 1)[0]
+            words = focused.split()[: self.max_new_tokens]
+            if self.ms_per_token:
+                time.sleep(self.ms_per_token * len(words) / 1000.0)
+            out.append(postprocess_answer(intent, " ".join(words)))
+        return out
+
+class Pipeline:
+    """
+    The /ask stages, loaded once and timed individually. Queries are embedded through the
+    embedding service and searched with retrieve_by_vector, as main.search_stage does (hybrid
+    fusion, tombstone-aware search); the pipeline caches stay off so every pass does the work.
+    """
+
+    def __init__(self, cfg: Dict[str, Any], stub: bool, stub_ms_per_token: float = 0.0):
+        from .retriever import load_embedder, load_embedder_from_dir, load_faiss
+        from .rewriter import QueryRewriter
+        self.cfg = cfg
+        print("🔄 Loading embedder and FAISS index...")
+        embedder = load_embedder_from_dir(cfg) if cfg.get("FAST_START", False) else load_embedder(cfg)
+        if cfg.get("EMBED_SERVICE_ENABLED", True):
+            from .embedding import load_embedding_service
+            embedder = load_embedding_service(dict(cfg, EMBED_CACHE_SIZE=0), embedder)
+        self.vector_db = load_faiss(cfg, embedder)
+        self.embedder = self.vector_db.embedding_function
+        gen_pipeline = None
+        self.context_builder = None
+        if stub:
+            self.generate_batch: Callable[[List[Tuple[str, str]]], List[str]] = StubGenerator(stub_ms_per_token)
+        else:
+            from .gemma import load_gemma, build_rewriter, answer_batch_with_gemma, device_kind
+            print("🔄 Loading Gemma model...")
+            tokenizer, model = load_gemma(cfg["MODEL_DIR"])
+            model = model.to(device_kind()).eval()
+            if device_kind() == "cpu":
+                from .cpu_backend import prepare_cpu_model
+                model, _ = prepare_cpu_model(model, tokenizer, cfg)
+            prefix = None
+            if cfg.get("PREFIX_CACHE_ENABLED", True):
+                from .prefix_cache import PrefixCache
+                prefix = PrefixCache(model, tokenizer, cfg).warm()
+            from .decoding import load_decoder
+            # one decoder (and draft model) for the whole run, as the server does
+            self.decoder = load_decoder(cfg, device_kind())
+            self.generate_batch = lambda items: answer_batch_with_gemma(items, tokenizer, model, cfg,
+                                                                        prefix_cache=prefix, decoder=self.decoder)
+            if int(cfg.get("CONTEXT_TOKEN_BUDGET", 0)) > 0:
+                from .context import ContextBuilder
+                self.context_builder = ContextBuilder(cfg, tokenizer)
+            mode = str(cfg.get("REWRITER_MODE", "llm")).lower()
+            if cfg.get("USE_REWRITER", True) and mode in ("llm", "llm-greedy"):
+                gen_pipeline = build_rewriter(
+                    tokenizer, model,
+                    max_new_tokens=int(cfg.get("REWRITER_GREEDY_MAX_NEW_TOKENS", 48)) if mode == "llm-greedy" else 128,
+                    num_beams=1 if mode == "llm-greedy" else 4,
+                )
+        self.rewriter = QueryRewriter(cfg, gen_pipeline)
+        self.reranker = None
+        if cfg.get("RERANK_ENABLED", False):
+            from .rerank import load_reranker
+            print("🔄 Loading cross-encoder reranker...")
+            self.reranker = load_reranker(cfg)
+        self.scheduler = None
+
+    def run(self, question: str, k: int, generate: bool = True) -> Tuple[Dict[str, float], List[int]]:
+        from .intent import FilteredContext, detect_question_intent, filter_context_for_intent
+        from .retriever import retrieve_by_vector
+        t: Dict[str, float] = {}
+
+        t0 = time.perf_counter()
+        rewritten = self.rewriter.rewrite(question)
+        t["rewrite"] = (time.perf_counter() - t0) * 1000.0
+
+        t0 = time.perf_counter()
+        vec = self.embedder.embed_query(rewritten)
+        t["embed"] = (time.perf_counter() - t0) * 1000.0
+
+        t0 = time.perf_counter()
+        fetch = self.reranker.fetch(k) if self.reranker is not None else k
+        hits = retrieve_by_vector(self.vector_db, vec, k=fetch, query=rewritten)
+        t["search"] = (time.perf_counter() - t0) * 1000.0
+
+        if self.reranker is not None:
+            t0 = time.perf_counter()
+            hits, _ = self.reranker.rerank(question, hits, k)
+            t["rerank"] = (time.perf_counter() - t0) * 1000.0
+
+        ctx = "\n".join(h["passage"] for h in hits)
+        t0 = time.perf_counter()
+        if self.context_builder is not None:
+            ctx = self.context_builder.build(question, hits)
+        else:
+            intent = detect_question_intent(question)
+            sentences = getattr(self.vector_db, "sentences", None)
+            filtered = sentences.filter(hits, intent) if sentences is not None else None
+            if filtered is not None:
+                ctx = filtered
+            else:
+                # the filtered text is what /ask puts in the prompt; wrapped so it is not filtered twice
+                ctx = FilteredContext(filter_context_for_intent(ctx, intent), intent)
+        t["context_filter"] = (time.perf_counter() - t0) * 1000.0
+
+        if generate:
+            t0 = time.perf_counter()
+            if self.scheduler is not None:
+                self.scheduler.submit(question, ctx)
+            else:
+                self.generate_batch([(question, ctx)])
+            t["generate"] = (time.perf_counter() - t0) * 1000.0
+        return t, [h["doc_id"] for h in hits]
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(_DATA_DIR), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+def _throughput(pipe: Pipeline, questions: List[str], k: int, concurrency: int) -> Dict[str, Any]:
+    from .scheduler import BatchScheduler
+    if pipe.cfg.get("USE_BATCHING", True) and concurrency > 1:
+        pipe.scheduler = BatchScheduler(
+            pipe.generate_batch,
+            max_batch_size=int(pipe.cfg.get("BATCH_MAX_SIZE", 8)),
+            max_wait_ms=float(pipe.cfg.get("BATCH_MAX_WAIT_MS", 20)),
+        ).start()
+    latencies: List[float] = []
+    lock = threading.Lock()
+
+    def one(q: str):
+        t0 = time.perf_counter()
+        pipe.run(q, k)
+        ms = (time.perf_counter() - t0) * 1000.0
+        with lock:
+            latencies.append(ms)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, questions))
+    wall = time.perf_counter() - t0
+    stats = pipe.scheduler.stats() if pipe.scheduler is not None else None
+    if pipe.scheduler is not None:
+        pipe.scheduler.stop()
+        pipe.scheduler = None
+    return {
+        "concurrency": concurrency,
+        "requests": len(questions),
+        "wall_s": round(wall, 3),
+        "qps": round(len(questions) / wall, 3) if wall else 0.0,
+        "latency": summarize(latencies),
+        "avg_batch_size": stats["avg_batch_size"] if stats else 1.0,
+    }
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """Human-readable deltas of the headline numbers against a previous run."""
+    lines = []
+    for stage, cur in current.get("stages", {}).items():
+        old = baseline.get("stages", {}).get(stage)
+        if old and old.get("p50_ms"):
+            delta = (cur["p50_ms"] - old["p50_ms"]) / old["p50_ms"] * 100.0
+            lines.append(f"{stage:>15} p50 {old['p50_ms']:.2f} -> {cur['p50_ms']:.2f} ms ({delta:+.1f}%)")
+    for key, cur in current.get("retrieval", {}).items():
+        old = baseline.get("retrieval", {}).get(key)
+        if old is not None and not key.startswith("questions_"):
+            lines.append(f"{key:>15} {old:.4f} -> {cur:.4f} ({cur - old:+.4f})")
+    old_tp = {r["concurrency"]: r for r in baseline.get("throughput", [])}
+    for row in current.get("throughput", []):
+        old = old_tp.get(row["concurrency"])
+        if old and old.get("qps"):
+            delta = (row["qps"] - old["qps"]) / old["qps"] * 100.0
+            lines.append(f"{'qps@' + str(row['concurrency']):>15} {old['qps']:.3f} -> {row['qps']:.3f} ({delta:+.1f}%)")
+    return lines
+
+def run_bench(args) -> Dict[str, Any]:
+    cfg = load_config(os.getenv("CONFIG_PATH", "./config.json"))
+    if args.rewriter_mode:
+        cfg["REWRITER_MODE"] = args.rewriter_mode
+    k_values = sorted({int(x) for x in args.k_values.split(",")})
+    k = max(k_values + [int(args.k)])
+    concurrency = [int(x) for x in args.concurrency.split(",") if x.strip()]
+
+    tests = load_test_set(args.test_set, args.limit)
+    pipe = Pipeline(cfg, stub=args.stub, stub_ms_per_token=args.stub_ms_per_token)
+
+    print(f"🔄 Replaying {len(tests)} questions (k={k})...")
+    per_stage: Dict[str, List[float]] = {s: [] for s in STAGES}
+    ranked, relevant = [], []
+    for item in tests:
+        timings, ids = pipe.run(item["question"], k, generate=not args.no_generate)
+        for stage, ms in timings.items():
+            per_stage[stage].append(ms)
+        ranked.append(ids)
+        relevant.append(item["relevant"])
+
+    result: Dict[str, Any] = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "questions": len(tests),
+            "k": k,
+            "stub_model": bool(args.stub),
+            "rewriter_mode": pipe.rewriter.mode,
+            "rerank": pipe.reranker.stats() if pipe.reranker is not None else None,
+            "num_beams": cfg.get("NUM_BEAMS"),
+            "max_new_tokens": cfg.get("MAX_NEW_TOKENS"),
+        },
+        "stages": {s: summarize(v) for s, v in per_stage.items() if v},
+        "retrieval": retrieval_metrics(ranked, relevant, k_values),
+        "throughput": [],
+    }
+    if not args.no_generate:
+        questions = [t["question"] for t in tests]
+        for c in concurrency:
+            print(f"🔄 Throughput at concurrency {c}...")
+            result["throughput"].append(_throughput(pipe, questions, k, c))
+
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"✅ Wrote {args.out}")
+    print(json.dumps({k_: result[k_] for k_ in ("stages", "retrieval")}, indent=2))
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            for line in compare(result, json.load(f)):
+                print(line)
+    return result
+
+def add_arguments(p) -> None:
+    p.add_argument("--test-set", default=None, help="test.parquet / df_test.csv (default: data/test.parquet)")
+    p.add_argument("--limit", type=int, default=200, help="number of questions to replay")
+    p.add_argument("--k", type=int, default=5)
+    p.add_argument("--k-values", default="1,3,5,10", help="cutoffs for recall@k / hit@k")
+    p.add_argument("--concurrency", default="1,4,8", help="comma-separated concurrency levels")
+    p.add_argument("--stub", action="store_true", help="replace Gemma with a model-free extractive stub")
+    p.add_argument("--stub-ms-per-token", type=float, default=0.0, help="simulated decode cost for --stub")
+    p.add_argument("--no-generate", action="store_true", help="retrieval-only run")
+    p.add_argument("--rewriter-mode", default=None, help="override REWRITER_MODE")
+    p.add_argument("--out", default="bench_results/bench.json")
+    p.add_argument("--baseline", default=None, help="previous JSON result to diff against")
@@ -0,0 +1,126 @@
+"""
+In-process BM25 over the same rows as the FAISS index, for exact-token matches
+(gene / drug names such as RET, GDNF, HB-EGF) that MiniLM embeddings tend to blur.
+
+Files (next to index.faiss, all memory-mapped at load):
+  bm25.vocab.json       term -> term id, plus k1 / b / avgdl
+  bm25.offsets.npy      int64[V + 1]; postings of term t are [offsets[t], offsets[t + 1])
+  bm25.docs.npy         int32[P]; row ids, ascending within each term
+  bm25.tf.npy           uint16[P]; term frequency of the term in that row
+  bm25.doc_len.npy      int32[N]; tokens per row
+
+Build with `python -m app build-index --bm25` (full builds, appends and compactions
+rebuild it automatically when it exists).
+"""
+import json, math, os, re
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+VOCAB_FILE = "bm25.vocab.json"
+OFFSETS_FILE = "bm25.offsets.npy"
+DOCS_FILE = "bm25.docs.npy"
+TF_FILE = "bm25.tf.npy"
+DOC_LEN_FILE = "bm25.doc_len.npy"
+
+_TOKEN = re.compile(r"[a-z0-9]+(?:[-/][a-z0-9]+)*")
+_SPLIT = re.compile(r"[-/]")
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have how in is it its of on or that the this to was were what "
+    "which who why with does do did can not no".split()
+)
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word tokens; hyphenated names are kept whole and also split ("hb-egf", "hb", "egf")."""
+    out: List[str] = []
+    for tok in _TOKEN.findall(text.lower()):
+        if len(tok) < 2 or tok in _STOPWORDS:
+            continue
+        out.append(tok)
+        if "-" in tok or "/" in tok:
+            out.extend(p for p in _SPLIT.split(tok) if len(p) > 1 and p not in _STOPWORDS)
+    return out
+
+def index_exists(directory: str) -> bool:
+    return all(os.path.exists(os.path.join(directory, f))
+               for f in (VOCAB_FILE, OFFSETS_FILE, DOCS_FILE, TF_FILE, DOC_LEN_FILE))
+
+def build_bm25(directory: str, rows: Iterable[Tuple[str, int]], k1: float = 1.2, b: float = 0.75) -> int:
+    """
+    Index (text, doc_id) rows in FAISS row order. Postings are collected as flat
+    (term, row, tf) arrays and grouped with one stable sort, so no per-term Python lists.
+    """
+    vocab: Dict[str, int] = {}
+    terms, docs, tfs = array("i"), array("i"), array("H")
+    doc_len = array("i")
+    for row, (text, _) in enumerate(rows):
+        toks = tokenize(text or "")
+        doc_len.append(len(toks))
+        for term, tf in Counter(toks).items():
+            terms.append(vocab.setdefault(term, len(vocab)))
+            docs.append(row)
+            tfs.append(min(tf, 65535))
+    t = np.frombuffer(terms, dtype=np.int32)
+    order = np.argsort(t, kind="stable")  # rows stay ascending inside each term
+    counts = np.bincount(t, minlength=len(vocab))
+    offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    lengths = np.frombuffer(doc_len, dtype=np.int32)
+
+    def save(name: str, arr: np.ndarray) -> None:
+        tmp = os.path.join(directory, name + ".tmp.npy")
+        np.save(tmp, arr)
+        os.replace(tmp, os.path.join(directory, name))
+
+    save(DOCS_FILE, np.frombuffer(docs, dtype=np.int32)[order])
+    save(TF_FILE, np.frombuffer(tfs, dtype=np.uint16)[order])
+    save(OFFSETS_FILE, offsets)
+    save(DOC_LEN_FILE, lengths)
+    meta = {"k1": k1, "b": b, "avgdl": float(lengths.mean()) if len(lengths) else 0.0, "vocab": vocab}
+    tmp = os.path.join(directory, VOCAB_FILE + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp, os.path.join(directory, VOCAB_FILE))
+    return len(lengths)
+
+class BM25Index:
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, VOCAB_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.vocab: Dict[str, int] = meta["vocab"]
+        self.k1 = float(meta["k1"])
+        self.b = float(meta["b"])
+        self.offsets = np.load(os.path.join(directory, OFFSETS_FILE), mmap_mode="r")
+        self.docs = np.load(os.path.join(directory, DOCS_FILE), mmap_mode="r")
+        self.tf = np.load(os.path.join(directory, TF_FILE), mmap_mode="r")
+        doc_len = np.load(os.path.join(directory, DOC_LEN_FILE), mmap_mode="r")
+        self.n = len(doc_len)
+        avgdl = float(meta["avgdl"]) or 1.0
+        # length normalisation is per row and query-independent, so precompute it once
+        self._norm = (self.k1 * (1.0 - self.b + self.b * np.asarray(doc_len, dtype=np.float32) / avgdl)).astype(np.float32)
+
+    def __len__(self) -> int:
+        return self.n
+
+    def search(self, query: str, k: int, exclude=frozenset()) -> List[Tuple[int, float]]:
+        """Top-k (row, score) by BM25; rows in `exclude` (tombstones) are skipped."""
+        term_ids = {self.vocab[t] for t in tokenize(query) if t in self.vocab}
+        if not term_ids or k <= 0:
+            return []
+        scores = np.zeros(self.n, dtype=np.float32)
+        for t in term_ids:
+            start, end = int(self.offsets[t]), int(self.offsets[t + 1])
+            rows = np.asarray(self.docs[start:end])
+            tf = np.asarray(self.tf[start:end], dtype=np.float32)
+            df = end - start
+            idf = math.log(1.0 + (self.n - df + 0.5) / (df + 0.5))
+            scores[rows] += idf * tf * (self.k1 + 1.0) / (tf + self._norm[rows])
+        if exclude:
+            scores[[r for r in exclude if r < self.n]] = 0.0
+        hit = np.flatnonzero(scores)
+        if len(hit) > k:
+            hit = hit[np.argpartition(-scores[hit], k - 1)[:k]]
+        hit = hit[np.argsort(-scores[hit], kind="stable")]
+        return [(int(r), float(scores[r])) for r in hit]
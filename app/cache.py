@@ -0,0 +1,382 @@
+import json, os, re, sqlite3, threading, time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+# langchain_core is imported on first wrap_embedder(), not here: app.main imports this module
+# eagerly and FAST_START relies on that import staying cheap.
+_MISSING = object()
+
+def normalize_text(text: str) -> str:
+    """Case/whitespace/trailing-punctuation insensitive cache key for questions and queries."""
+    text = re.sub(r"\s+", " ", text or "").strip().lower()
+    return text.rstrip(" ?!.")
+
+class SQLiteBackend:
+    """
+    Optional on-disk store shared by all cache levels so entries survive restarts.
+    Values are stored as JSON; each row carries its level name and absolute expiry.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._connect()
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " level TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires REAL,"
+            " PRIMARY KEY (level, key))"
+        )
+
+    def _connect(self) -> None:
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+
+    def reopen(self) -> None:
+        """New connection in a forked worker; a SQLite handle must not be used across fork()."""
+        self._connect()
+
+    def get(self, level: str, key: str) -> Any:
+        """(value, expires) for a live row, _MISSING otherwise; expires is the absolute time stored with it."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires FROM cache WHERE level=? AND key=?", (level, key)
+            ).fetchone()
+        if row is None:
+            return _MISSING
+        value, expires = row
+        if expires is not None and expires < time.time():
+            self.delete(level, key)
+            return _MISSING
+        return json.loads(value), expires
+
+    def set(self, level: str, key: str, value: Any, expires: Optional[float]) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (level, key, value, expires) VALUES (?, ?, ?, ?)",
+                (level, key, json.dumps(value), expires),
+            )
+
+    def delete(self, level: str, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM cache WHERE level=? AND key=?", (level, key))
+
+    def clear(self, level: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM cache WHERE level=?", (level,))
+
+    def prune(self, level: str, maxsize: int) -> None:
+        """Drop expired rows and keep only the maxsize most recently written ones."""
+        with self._lock:
+            self._conn.execute("DELETE FROM cache WHERE level=? AND expires < ?", (level, time.time()))
+            self._conn.execute(
+                "DELETE FROM cache WHERE level=? AND rowid NOT IN "
+                "(SELECT rowid FROM cache WHERE level=? ORDER BY rowid DESC LIMIT ?)",
+                (level, level, maxsize),
+            )
+
+class LRUCache:
+    """Thread-safe LRU with per-entry TTL, hit/miss counters and an optional write-through backend."""
+
+    def __init__(self, name: str, maxsize: int, ttl_s: float = 0, backend: Optional[SQLiteBackend] = None):
+        self.name = name
+        self.maxsize = max(1, int(maxsize))
+        self.ttl_s = float(ttl_s or 0)
+        self.backend = backend
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._writes = 0
+
+    def _expiry(self) -> Optional[float]:
+        return time.time() + self.ttl_s if self.ttl_s > 0 else None
+
+    def get(self, key: str, default: Any = None) -> Any:
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires >= now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+        if self.backend is not None:
+            row = self.backend.get(self.name, key)
+            if row is not _MISSING:
+                value, expires = row
+                with self._lock:
+                    self.hits += 1
+                    # keep the row's own expiry; a fresh TTL would outlive what was written to disk
+                    self._insert(key, value, expires)
+                return value
+        with self._lock:
+            self.misses += 1
+        return default
+
+    def set(self, key: str, value: Any) -> None:
+        expires = self._expiry()
+        with self._lock:
+            self._insert(key, value, expires)
+        if self.backend is not None:
+            self.backend.set(self.name, key, value, expires)
+            self._writes += 1
+            if self._writes % 256 == 0:
+                self.backend.prune(self.name, self.maxsize)
+
+    def _insert(self, key: str, value: Any, expires: Optional[float]) -> None:
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+        if self.backend is not None:
+            self.backend.clear(self.name)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl_s": self.ttl_s,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+class SemanticAnswerCache:
+    """
+    Answers looked up by question embedding instead of question text, so paraphrases
+    ("What causes Hirschsprung disease?" / "Etiology of Hirschsprung's?") share one generation.
+    A hit needs cosine >= min_cosine against a cached question with the same k, rewrite option,
+    intent and index version, and a retrieved doc_id set overlapping the cached one by
+    >= min_overlap (Jaccard), so the answer was generated from much the same passages.
+    Vectors sit in one preallocated unit-norm matrix (a brute-force inner-product index, which
+    is as fast as anything at this size); entries are evicted LRU. Memory only.
+    """
+
+    def __init__(self, maxsize: int, ttl_s: float = 0, min_cosine: float = 0.92, min_overlap: float = 0.6):
+        self.name = "semantic"
+        self.maxsize = max(1, int(maxsize))
+        self.ttl_s = float(ttl_s or 0)
+        self.min_cosine = float(min_cosine)
+        self.min_overlap = float(min_overlap)
+        self._vectors: Optional[np.ndarray] = None  # (maxsize, dim), allocated on the first put
+        self._live = np.zeros(self.maxsize, dtype=bool)
+        self._entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()  # slot -> entry, LRU order
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.near_misses = 0  # similar question, but retrieval found other passages
+        self.evictions = 0
+        self._similarity_total = 0.0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _unit(vector) -> np.ndarray:
+        v = np.asarray(vector, dtype=np.float32).ravel()
+        return v / max(float(np.linalg.norm(v)), 1e-12)
+
+    def get(self, vector, k: int, preferred_option: str, intent: str, doc_ids, version: str):
+        """(payload, match info) of the closest qualifying entry, or None."""
+        q = self._unit(vector)
+        wanted = frozenset(doc_ids)
+        now = time.time()
+        with self._lock:
+            if self._vectors is None or not self._entries or len(q) != self._vectors.shape[1]:
+                self.misses += 1
+                return None
+            sims = self._vectors @ q
+            sims[~self._live] = -1.0
+            near = False
+            for slot in np.argsort(-sims):
+                similarity = float(sims[slot])
+                if similarity < self.min_cosine:
+                    break
+                e = self._entries[int(slot)]
+                if e["expires"] is not None and e["expires"] < now:
+                    self._drop(int(slot))
+                    continue
+                if (e["k"], e["option"], e["intent"], e["version"]) != (k, preferred_option, intent, version):
+                    continue
+                union = len(wanted | e["doc_ids"])
+                overlap = len(wanted & e["doc_ids"]) / union if union else 1.0
+                if overlap < self.min_overlap:
+                    near = True
+                    continue
+                self._entries.move_to_end(int(slot))
+                self.hits += 1
+                self._similarity_total += similarity
+                return e["payload"], {"question": e["question"], "similarity": round(similarity, 4),
+                                      "overlap": round(overlap, 3)}
+            self.misses += 1
+            self.near_misses += near
+            return None
+
+    def put(self, vector, k: int, preferred_option: str, intent: str, doc_ids, version: str,
+            question: str, payload: Dict[str, Any]) -> None:
+        v = self._unit(vector)
+        with self._lock:
+            if self._vectors is None or len(v) != self._vectors.shape[1]:
+                self._vectors = np.zeros((self.maxsize, len(v)), dtype=np.float32)
+                self._live[:] = False
+                self._entries.clear()
+            if len(self._entries) >= self.maxsize:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+            slot = int(np.flatnonzero(~self._live)[0])
+            self._vectors[slot] = v
+            self._live[slot] = True
+            self._entries[slot] = {
+                "k": k, "option": preferred_option, "intent": intent, "version": version,
+                "doc_ids": frozenset(doc_ids), "question": question, "payload": payload,
+                "expires": time.time() + self.ttl_s if self.ttl_s > 0 else None,
+            }
+
+    def _drop(self, slot: int) -> None:
+        del self._entries[slot]
+        self._live[slot] = False
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._live[:] = False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "ttl_s": self.ttl_s,
+                "min_cosine": self.min_cosine,
+                "min_overlap": self.min_overlap,
+                "hits": self.hits,
+                "misses": self.misses,
+                "near_misses": self.near_misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "avg_hit_similarity": round(self._similarity_total / self.hits, 4) if self.hits else None,
+            }
+
+_cached_embeddings_cls = None
+
+def cached_embeddings_class():
+    """CachedEmbeddings, defined on first use so that importing this module never loads langchain."""
+    global _cached_embeddings_cls
+    if _cached_embeddings_cls is not None:
+        return _cached_embeddings_cls
+    from langchain_core.embeddings import Embeddings
+
+    class CachedEmbeddings(Embeddings):
+        """Drop-in wrapper that memoizes embed_query; embed_documents is passed through."""
+
+        def __init__(self, inner: Embeddings, cache: LRUCache):
+            self.inner = inner
+            self.cache = cache
+
+        def embed_documents(self, texts: List[str]) -> List[List[float]]:
+            return self.inner.embed_documents(texts)
+
+        def embed_query(self, text: str) -> List[float]:
+            key = normalize_text(text)
+            vec = self.cache.get(key)
+            if vec is None:
+                vec = [float(x) for x in self.inner.embed_query(text)]
+                self.cache.set(key, vec)
+            return vec
+
+    _cached_embeddings_cls = CachedEmbeddings
+    return CachedEmbeddings
+
+class PipelineCache:
+    """
+    Cache levels around the /ask pipeline:
+      answers     normalized question (+k, rewrite option) -> full /ask payload
+      hits        rewritten query (+k) -> retrieved passages, keyed on the FAISS index version
+      embeddings  normalized query text -> query vector
+      semantic    question embedding (+k, rewrite option, intent, retrieved doc_ids) -> /ask payload,
+                  with CACHE_SEMANTIC_ENABLED (SemanticAnswerCache; not persisted by the sqlite backend)
+    set_index_version() drops every level when the version changes (or when forced, as /reload does),
+    so swapping vector_db never serves stale entries. The on-disk backend remembers the version it was
+    filled against, which lets entries survive a restart on the same index.
+    """
+
+    def __init__(self, cfg: Dict[str, Any]):
+        backend = None
+        if str(cfg.get("CACHE_BACKEND", "memory")).lower() == "sqlite":
+            backend = SQLiteBackend(cfg["CACHE_SQLITE_PATH"])
+        self.backend = backend
+        self.index_version = ""
+        self.answers = LRUCache("answers", cfg.get("CACHE_ANSWER_SIZE", 1024), cfg.get("CACHE_ANSWER_TTL_S", 3600), backend)
+        self.hits = LRUCache("hits", cfg.get("CACHE_HITS_SIZE", 2048), cfg.get("CACHE_HITS_TTL_S", 3600), backend)
+        self.embeddings = LRUCache("embeddings", cfg.get("CACHE_EMBED_SIZE", 4096), cfg.get("CACHE_EMBED_TTL_S", 86400), backend)
+        self.semantic: Optional[SemanticAnswerCache] = None
+        if cfg.get("CACHE_SEMANTIC_ENABLED", False):
+            self.semantic = SemanticAnswerCache(cfg.get("CACHE_SEMANTIC_SIZE", 512), cfg.get("CACHE_SEMANTIC_TTL_S", 3600),
+                                                cfg.get("CACHE_SEMANTIC_MIN_COSINE", 0.92),
+                                                cfg.get("CACHE_SEMANTIC_MIN_OVERLAP", 0.6))
+
+    def levels(self) -> List[Any]:
+        return [self.answers, self.hits, self.embeddings] + ([self.semantic] if self.semantic is not None else [])
+
+    def set_index_version(self, version: str, force: bool = False) -> None:
+        previous = self.index_version
+        if not previous and self.backend is not None:
+            stored = self.backend.get("meta", "index_version")
+            previous = "" if stored is _MISSING else stored[0]
+        if force or version != previous:
+            for level in self.levels():
+                level.clear()
+        self.index_version = version
+        if self.backend is not None:
+            self.backend.set("meta", "index_version", version, None)
+
+    def after_fork(self) -> None:
+        if self.backend is not None:
+            self.backend.reopen()
+
+    def wrap_embedder(self, embedder):
+        """embedder (a LangChain Embeddings) with embed_query memoized in the embeddings level."""
+        cls = cached_embeddings_class()
+        if isinstance(embedder, cls):
+            return embedder
+        return cls(embedder, self.embeddings)
+
+    def _answer_key(self, question: str, k: int, preferred_option: str) -> str:
+        return f"{self.index_version}|{k}|{preferred_option}|{normalize_text(question)}"
+
+    def _hits_key(self, rewritten: str, k: int) -> str:
+        return f"{self.index_version}|{k}|{normalize_text(rewritten)}"
+
+    def get_answer(self, question: str, k: int, preferred_option: str) -> Optional[Dict[str, Any]]:
+        return self.answers.get(self._answer_key(question, k, preferred_option))
+
+    def put_answer(self, question: str, k: int, preferred_option: str, payload: Dict[str, Any]) -> None:
+        self.answers.set(self._answer_key(question, k, preferred_option), payload)
+
+    def get_hits(self, rewritten: str, k: int) -> Optional[List[Dict[str, Any]]]:
+        return self.hits.get(self._hits_key(rewritten, k))
+
+    def put_hits(self, rewritten: str, k: int, hits: List[Dict[str, Any]]) -> None:
+        self.hits.set(self._hits_key(rewritten, k), hits)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "index_version": self.index_version,
+            "backend": "sqlite" if self.backend is not None else "memory",
+            **{level.name: level.stats() for level in self.levels()},
+        }
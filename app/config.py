@@ -9,7 +9,63 @@ _DEFAULTS: Dict[str, Any] = {
     "EMBEDDING_NAME_OR_DIR": "sentence-transformers/all-MiniLM-L6-v2",
     "EMBEDDER_DIR": "./app/embedder_model_folder",
     
+    # open the port immediately and warm components in the background; uses the mmap'd
+    # index.faiss + columnar passage store and a pickle-free embedder directory
+    "FAST_START": False,
+    # serve passages from the columnar store (passages.*) whenever the index folder has one, never unpickling index.pkl
+    "PASSAGE_STORE": True,
+
+    # query embedding service (app/embedding.py): micro-batched embed_query, torch | onnx backend
+    "EMBED_SERVICE_ENABLED": True,
+    "EMBED_BACKEND": "torch",
+    "EMBED_ONNX_INT8": True,           # dynamic int8 quantization of the exported ONNX model
+    "EMBED_ONNX_THREADS": 0,           # onnxruntime intra-op threads; 0 = its default
+    "EMBED_BATCH_MAX_SIZE": 32,
+    "EMBED_BATCH_MAX_WAIT_MS": 2,
+    "EMBED_CACHE_SIZE": 4096,          # own LRU when CACHE_ENABLED is off (else the pipeline cache's level)
+    "EMBED_VERIFY_ON_LOAD": True,      # check query embeddings against the index at startup and on /reload
+    "EMBED_VERIFY_SAMPLES": 16,        # stored passages re-embedded by that check
+    "EMBED_VERIFY_MIN_COSINE": 0.99,
+
+    # ANN index type written by `python -m app build-index` (see app/ann.py)
+    "INDEX_TYPE": "flat",              # flat | hnsw | ivf-flat | ivf-pq | sq8
+    "INDEX_HNSW_M": 32,
+    "INDEX_HNSW_EF_CONSTRUCTION": 200,
+    "INDEX_IVF_NLIST": 0,              # 0 = ~4*sqrt(n)
+    "INDEX_PQ_M": 16,
+    "INDEX_PQ_NBITS": 8,
+    "INDEX_TRAIN_SIZE": 100000,
+    # query-time, applied on every index load
+    "INDEX_IVF_NPROBE": 16,
+    "INDEX_HNSW_EF_SEARCH": 64,
+
+    # hybrid retrieval: BM25 fused with dense results by reciprocal rank fusion (needs build-index --bm25)
+    "HYBRID_RETRIEVAL": False,
+    "HYBRID_FETCH_K": 20,              # candidates taken from each retriever
+    "HYBRID_BUDGET_MS": 100,           # per-query wait before fusing whatever has finished
+    "HYBRID_MAX_WAIT_MS": 1000,        # hard cap when neither retriever is done by then (no hits past it)
+    "RRF_K": 60,
+    "BM25_K1": 1.2,
+    "BM25_B": 0.75,
+
+    # cross-encoder reranking of over-fetched candidates (app/rerank.py)
+    "RERANK_ENABLED": False,
+    "RERANKER_DIR": "./app/models/reranker",
+    "RERANKER_HF_REPO": "cross-encoder/ms-marco-MiniLM-L-6-v2",  # downloaded into RERANKER_DIR when it is empty
+    "RERANKER_INT8": True,             # dynamic int8 quantization on CPU
+    "RERANK_FETCH_K": 20,              # candidates retrieved and scored
+    "RERANK_TOP_N": 3,                 # passages kept (never more than the request's k)
+    "RERANK_TOKEN_BUDGET": 0,          # > 0: keep the best passages that fit this many tokens instead
+    "RERANK_BATCH_SIZE": 16,
+    "RERANK_MAX_LENGTH": 256,          # query + passage tokens per pair
+    "RERANK_BUDGET_MS": 150,           # per-request cap; past it the request keeps FAISS order
+
     "USE_REWRITER": True,
+    "REWRITER_MODE": "llm",            # none | llm | llm-greedy | lexical
+    "REWRITER_GREEDY_MAX_NEW_TOKENS": 48,
+    "REWRITE_POLICY": "always",        # always | on_low_score
+    "REWRITE_SCORE_THRESHOLD": 0.5,    # cosine relevance of the best first-pass hit
+    "REWRITE_CACHE_SIZE": 4096,
     "TOP_K_DEFAULT": 5,
 
     "MAX_NEW_TOKENS": 320,
@@ -18,6 +74,79 @@ _DEFAULTS: Dict[str, Any] = {
     "REPETITION_PENALTY": 1.05,
     "LENGTH_PENALTY": 0.9,
 
+    # beam | greedy | prompt-lookup | assisted (app/decoding.py)
+    "DECODING_STRATEGY": "beam",
+    "PROMPT_LOOKUP_NUM_TOKENS": 10,    # draft length copied from the prompt
+    "PROMPT_LOOKUP_MAX_NGRAM": 3,      # longest n-gram matched against the prompt
+    "ASSISTANT_MODEL_DIR": "./app/models/assistant",
+    "ASSISTANT_HF_REPO": "",           # downloaded into ASSISTANT_MODEL_DIR when it is empty
+    "ASSISTANT_NUM_TOKENS": 5,
+
+    # token-budgeted context (0 = legacy: 15 cue-ranked sentences, tokenizer truncation)
+    "CONTEXT_TOKEN_BUDGET": 0,
+    "CONTEXT_DEDUP_THRESHOLD": 0.85,   # term-set Jaccard at which two sentences count as duplicates
+    "CONTEXT_TOKEN_CACHE_SIZE": 8192,  # passages (by text hash) whose sentence token ids are kept
+    "SENTENCE_INDEX": True,            # serve the default filter from stored splits (build-index --sentences)
+
+    # CPU serving (app/cpu_backend.py): fp32 | bf16 | int8; 0 threads = from the cgroup CPU quota
+    "CPU_BACKEND": "fp32",
+    "CPU_THREADS": 0,
+    "CPU_INTEROP_THREADS": 1,
+    "TORCH_COMPILE": False,
+    "CPU_SELF_BENCHMARK": False,       # tokens/sec + RSS at startup, reported on /health
+
+    # past-key-values of the static INTENT_TEMPLATES heads, computed at startup
+    "PREFIX_CACHE_ENABLED": True,
+    "PREFIX_CACHE_MAX_MB": 256,
+
+    # micro-batching of concurrent /ask generations
+    "USE_BATCHING": True,
+    "BATCH_MAX_SIZE": 8,
+    "BATCH_MAX_WAIT_MS": 20,
+
+    # /ask/batch and `python -m app batch`
+    "ASK_BATCH_MAX_QUESTIONS": 1000,   # per HTTP request; the CLI has no limit
+    "ASK_BATCH_GEN_SIZE": 16,          # rows per length-sorted generate call
+
+    # /ask/stream decoding (beam search cannot stream; greedy unless sampling is enabled)
+    "STREAM_DO_SAMPLE": False,
+    "STREAM_TEMPERATURE": 0.7,
+    "STREAM_TOP_P": 0.9,
+
+    # /ask pipeline cache (answers, retrieval hits, query embeddings)
+    "CACHE_ENABLED": True,
+    "CACHE_BACKEND": "memory",         # memory | sqlite
+    "CACHE_SQLITE_PATH": "./app/cache/pipeline_cache.sqlite3",
+    "CACHE_ANSWER_SIZE": 1024,
+    "CACHE_ANSWER_TTL_S": 3600,
+    "CACHE_HITS_SIZE": 2048,
+    "CACHE_HITS_TTL_S": 3600,
+    "CACHE_EMBED_SIZE": 4096,
+    "CACHE_EMBED_TTL_S": 86400,
+    # answers reused across paraphrases: question cosine + retrieved doc_id overlap (Jaccard)
+    "CACHE_SEMANTIC_ENABLED": False,
+    "CACHE_SEMANTIC_SIZE": 512,
+    "CACHE_SEMANTIC_TTL_S": 3600,
+    "CACHE_SEMANTIC_MIN_COSINE": 0.92,
+    "CACHE_SEMANTIC_MIN_OVERLAP": 0.6,
+
+    # per-stage tracing + /metrics (inline timings are still available per request when off)
+    "METRICS_ENABLED": True,
+
+    # ASGI serving mode (python -m app.asgi)
+    "SERVER_MODE": "flask",            # flask | asgi
+    "ASGI_MAX_CONCURRENCY": 8,
+    "ASGI_MAX_QUEUE": 32,
+    "ASGI_REQUEST_TIMEOUT_S": 120,
+    "RETRIEVAL_WORKERS": 2,
+
+    # pre-fork worker pool (python -m app.workers; docker-entrypoint.sh uses it when WORKERS > 0)
+    "WORKERS": 0,                      # worker processes behind the router on PORT; 0 = single process
+    "WORKER_BASE_PORT": 0,             # workers listen on 127.0.0.1:<base + i>; 0 = PORT + 1
+    "WORKER_PIN_CORES": True,          # give each worker its own slice of the CPU affinity set
+    "WORKER_MAX_REQUESTS": 0,          # recycle a worker (re-forked from memory) after this many; 0 = never
+    "WORKER_TIMEOUT_S": 300,           # router -> worker read timeout
+
     "TRANSFORMERS_OFFLINE": True,
     "PORT": 8080
 }
@@ -27,9 +156,59 @@ _ENV_OVERRIDES = {
     "MODEL_DIR", "FAISS_DIR", "EMBEDDER_PKL", "EMBEDDING_NAME_OR_DIR",
     "USE_REWRITER", "TOP_K_DEFAULT", "MAX_NEW_TOKENS", "NUM_BEAMS",
     "NO_REPEAT_NGRAM_SIZE", "REPETITION_PENALTY", "LENGTH_PENALTY",
-    "TRANSFORMERS_OFFLINE", "PORT"
+    "TRANSFORMERS_OFFLINE", "PORT",
+    "USE_BATCHING", "BATCH_MAX_SIZE", "BATCH_MAX_WAIT_MS",
+    "STREAM_DO_SAMPLE", "STREAM_TEMPERATURE", "STREAM_TOP_P",
+    "SERVER_MODE", "ASGI_MAX_CONCURRENCY", "ASGI_MAX_QUEUE", "ASGI_REQUEST_TIMEOUT_S",
+    "RETRIEVAL_WORKERS",
+    "REWRITER_MODE", "REWRITER_GREEDY_MAX_NEW_TOKENS", "REWRITE_POLICY", "REWRITE_SCORE_THRESHOLD",
+    "REWRITE_CACHE_SIZE", "METRICS_ENABLED", "FAST_START", "PASSAGE_STORE", "EMBEDDER_DIR",
+    "CACHE_ENABLED", "CACHE_BACKEND", "CACHE_SQLITE_PATH", "CACHE_ANSWER_SIZE", "CACHE_ANSWER_TTL_S",
+    "CACHE_HITS_SIZE", "CACHE_HITS_TTL_S", "CACHE_EMBED_SIZE", "CACHE_EMBED_TTL_S",
+    "CACHE_SEMANTIC_ENABLED", "CACHE_SEMANTIC_SIZE", "CACHE_SEMANTIC_TTL_S", "CACHE_SEMANTIC_MIN_COSINE",
+    "CACHE_SEMANTIC_MIN_OVERLAP",
+    "INDEX_TYPE", "INDEX_HNSW_M", "INDEX_HNSW_EF_CONSTRUCTION", "INDEX_IVF_NLIST", "INDEX_PQ_M",
+    "INDEX_PQ_NBITS", "INDEX_TRAIN_SIZE", "INDEX_IVF_NPROBE", "INDEX_HNSW_EF_SEARCH",
+    "ASK_BATCH_MAX_QUESTIONS", "ASK_BATCH_GEN_SIZE",
+    "HYBRID_RETRIEVAL", "HYBRID_FETCH_K", "HYBRID_BUDGET_MS", "HYBRID_MAX_WAIT_MS", "RRF_K", "BM25_K1", "BM25_B",
+    "RERANK_ENABLED", "RERANKER_DIR", "RERANKER_HF_REPO", "RERANKER_INT8", "RERANK_FETCH_K", "RERANK_TOP_N",
+    "RERANK_TOKEN_BUDGET", "RERANK_BATCH_SIZE", "RERANK_MAX_LENGTH", "RERANK_BUDGET_MS",
+    "CONTEXT_TOKEN_BUDGET", "CONTEXT_DEDUP_THRESHOLD", "CONTEXT_TOKEN_CACHE_SIZE", "SENTENCE_INDEX",
+    "PREFIX_CACHE_ENABLED", "PREFIX_CACHE_MAX_MB",
+    "CPU_BACKEND", "CPU_THREADS", "CPU_INTEROP_THREADS", "TORCH_COMPILE", "CPU_SELF_BENCHMARK",
+    "DECODING_STRATEGY", "PROMPT_LOOKUP_NUM_TOKENS", "PROMPT_LOOKUP_MAX_NGRAM", "ASSISTANT_MODEL_DIR",
+    "ASSISTANT_HF_REPO", "ASSISTANT_NUM_TOKENS",
+    "WORKERS", "WORKER_BASE_PORT", "WORKER_PIN_CORES", "WORKER_MAX_REQUESTS", "WORKER_TIMEOUT_S",
+    "EMBED_SERVICE_ENABLED", "EMBED_BACKEND", "EMBED_ONNX_INT8", "EMBED_ONNX_THREADS", "EMBED_BATCH_MAX_SIZE",
+    "EMBED_BATCH_MAX_WAIT_MS", "EMBED_CACHE_SIZE", "EMBED_VERIFY_SAMPLES", "EMBED_VERIFY_MIN_COSINE",
+    "EMBED_VERIFY_ON_LOAD",
 }
 
+_INT_KEYS = {"TOP_K_DEFAULT", "MAX_NEW_TOKENS", "NUM_BEAMS", "NO_REPEAT_NGRAM_SIZE", "PORT",
+             "BATCH_MAX_SIZE", "ASGI_MAX_CONCURRENCY", "ASGI_MAX_QUEUE", "RETRIEVAL_WORKERS",
+             "CACHE_ANSWER_SIZE", "CACHE_HITS_SIZE", "CACHE_EMBED_SIZE", "CACHE_SEMANTIC_SIZE",
+             "REWRITER_GREEDY_MAX_NEW_TOKENS", "REWRITE_CACHE_SIZE",
+             "INDEX_HNSW_M", "INDEX_HNSW_EF_CONSTRUCTION", "INDEX_IVF_NLIST", "INDEX_PQ_M", "INDEX_PQ_NBITS",
+             "INDEX_TRAIN_SIZE", "INDEX_IVF_NPROBE", "INDEX_HNSW_EF_SEARCH",
+             "ASK_BATCH_MAX_QUESTIONS", "ASK_BATCH_GEN_SIZE", "HYBRID_FETCH_K", "RRF_K",
+             "CONTEXT_TOKEN_BUDGET", "CONTEXT_TOKEN_CACHE_SIZE", "CPU_THREADS", "CPU_INTEROP_THREADS",
+             "PROMPT_LOOKUP_NUM_TOKENS", "PROMPT_LOOKUP_MAX_NGRAM", "ASSISTANT_NUM_TOKENS",
+             "WORKERS", "WORKER_BASE_PORT", "WORKER_MAX_REQUESTS",
+             "EMBED_ONNX_THREADS", "EMBED_BATCH_MAX_SIZE", "EMBED_CACHE_SIZE", "EMBED_VERIFY_SAMPLES",
+             "RERANK_FETCH_K", "RERANK_TOP_N", "RERANK_TOKEN_BUDGET", "RERANK_BATCH_SIZE", "RERANK_MAX_LENGTH"}
+_FLOAT_KEYS = {"REPETITION_PENALTY", "LENGTH_PENALTY", "BATCH_MAX_WAIT_MS",
+               "STREAM_TEMPERATURE", "STREAM_TOP_P", "ASGI_REQUEST_TIMEOUT_S",
+               "CACHE_ANSWER_TTL_S", "CACHE_HITS_TTL_S", "CACHE_EMBED_TTL_S", "CACHE_SEMANTIC_TTL_S",
+               "CACHE_SEMANTIC_MIN_COSINE", "CACHE_SEMANTIC_MIN_OVERLAP",
+               "REWRITE_SCORE_THRESHOLD", "HYBRID_BUDGET_MS", "HYBRID_MAX_WAIT_MS", "BM25_K1", "BM25_B",
+               "CONTEXT_DEDUP_THRESHOLD", "PREFIX_CACHE_MAX_MB", "WORKER_TIMEOUT_S",
+               "EMBED_BATCH_MAX_WAIT_MS", "EMBED_VERIFY_MIN_COSINE", "RERANK_BUDGET_MS"}
+_BOOL_KEYS = {"USE_REWRITER", "TRANSFORMERS_OFFLINE", "USE_BATCHING", "STREAM_DO_SAMPLE", "CACHE_ENABLED",
+              "METRICS_ENABLED", "FAST_START", "PASSAGE_STORE", "HYBRID_RETRIEVAL",
+              "PREFIX_CACHE_ENABLED", "TORCH_COMPILE", "CPU_SELF_BENCHMARK", "WORKER_PIN_CORES",
+              "EMBED_SERVICE_ENABLED", "EMBED_ONNX_INT8", "EMBED_VERIFY_ON_LOAD", "SENTENCE_INDEX",
+              "CACHE_SEMANTIC_ENABLED", "RERANK_ENABLED", "RERANKER_INT8"}
+
 def load_config(path: str = "./config.json") -> Dict[str, Any]:
     cfg = dict(_DEFAULTS)
     if os.path.exists(path):
@@ -43,19 +222,20 @@ def load_config(path: str = "./config.json") -> Dict[str, Any]:
             if v is None:
                 continue
             # cast numeric/bool
-            if k in {"TOP_K_DEFAULT", "MAX_NEW_TOKENS", "NUM_BEAMS", "NO_REPEAT_NGRAM_SIZE", "PORT"}:
+            if k in _INT_KEYS:
                 try: v = int(v)
                 except: pass
-            if k in {"REPETITION_PENALTY", "LENGTH_PENALTY"}:
+            if k in _FLOAT_KEYS:
                 try: v = float(v)
                 except: pass
-            if k in {"USE_REWRITER", "TRANSFORMERS_OFFLINE"}:
+            if k in _BOOL_KEYS:
                 v = v.lower() in {"1","true","yes","on"}
             cfg[k] = v
 
     # Ensure paths are absolute
     base_dir = os.path.dirname(os.path.abspath(__file__))  # /.../Project/app
-    for key in ["MODEL_DIR", "FAISS_DIR", "EMBEDDER_PKL", "EMBEDDER_DIR"]:
+    for key in ["MODEL_DIR", "FAISS_DIR", "EMBEDDER_PKL", "EMBEDDER_DIR", "CACHE_SQLITE_PATH", "ASSISTANT_MODEL_DIR",
+                "RERANKER_DIR"]:
         if key in cfg:
             cfg[key] = os.path.abspath(os.path.join(base_dir, "..", cfg[key].replace("./", "")))
 
@@ -0,0 +1,146 @@
+"""
+Token-budgeted context assembly.
+
+Instead of joining every hit and letting the tokenizer truncate the prompt, ContextBuilder:
+  1. splits each retrieved passage into sentences and tokenizes them once, caching
+     (sentence, token ids, term set, intent cue scores) per passage text, so a reload that
+     changes a passage under the same doc_id never serves stale splits,
+  2. drops sentences that are near-duplicates (term-set Jaccard >= CONTEXT_DEDUP_THRESHOLD)
+     of one already chosen, which is common across overlapping BioASQ abstracts,
+  3. ranks sentences by relevance to the question (idf-weighted term overlap, intent cue
+     matches, passage rank) and packs them into CONTEXT_TOKEN_BUDGET tokens,
+  4. returns them in reading order as a BudgetedContext carrying both the text and the
+     concatenated token ids, so generation can build input_ids without re-tokenizing.
+"""
+import hashlib, math, re, threading
+from typing import Any, Dict, List, NamedTuple, Sequence, Tuple
+
+from .cache import LRUCache
+from .intent import CUE_INTENTS, cue_scores, detect_question_intent, split_sentences
+
+_WORD = re.compile(r"[a-z0-9]+(?:-[a-z0-9]+)*")
+_STOP = frozenset(
+    "a an and are as at be by for from has have how in is it its of on or that the this to was were what "
+    "which who why with does do did can not no".split()
+)
+
+class BudgetedContext(NamedTuple):
+    text: str
+    token_ids: Tuple[int, ...]
+    doc_ids: Tuple[int, ...]
+
+    def __str__(self) -> str:
+        return self.text
+
+def _terms(text: str) -> frozenset:
+    return frozenset(t for t in _WORD.findall(text.lower()) if t not in _STOP and len(t) > 1)
+
+class _Sentence(NamedTuple):
+    text: str
+    ids: Tuple[int, ...]
+    terms: frozenset
+    cues: Tuple[int, ...]  # cue matches per intent, CUE_INTENTS order
+
+class ContextBuilder:
+    def __init__(self, cfg: Dict[str, Any], tokenizer):
+        self.tokenizer = tokenizer
+        self.budget = int(cfg.get("CONTEXT_TOKEN_BUDGET", 0))
+        self.dedup_threshold = float(cfg.get("CONTEXT_DEDUP_THRESHOLD", 0.85))
+        self.sentences = LRUCache("context_tokens", int(cfg.get("CONTEXT_TOKEN_CACHE_SIZE", 8192)), 0)
+        self._lock = threading.Lock()
+        self._stats = {"contexts": 0, "tokens_total": 0, "deduplicated": 0, "sentences_dropped": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.budget > 0 and self.tokenizer is not None
+
+    def _passage_sentences(self, passage: str) -> List[_Sentence]:
+        if not passage:
+            return []
+        key = hashlib.blake2b(passage.encode("utf-8"), digest_size=16).hexdigest()
+        cached = self.sentences.get(key)
+        if cached is not None:
+            return cached
+        texts = split_sentences(passage)
+        if not texts:
+            return []
+        # leading space so sentence ids concatenate into properly spaced text
+        enc = self.tokenizer([" " + t for t in texts], add_special_tokens=False)["input_ids"]
+        out = [_Sentence(t, tuple(ids), _terms(t), cue_scores(t)) for t, ids in zip(texts, enc)]
+        self.sentences.set(key, out)
+        return out
+
+    def build(self, question: str, hits: Sequence[Dict[str, Any]]) -> BudgetedContext:
+        intent = detect_question_intent(question)
+        col = CUE_INTENTS.index(intent) if intent in CUE_INTENTS else None
+        q_terms = _terms(question)
+
+        candidates: List[Tuple[int, int, _Sentence]] = []  # (passage rank, position, sentence)
+        for rank, hit in enumerate(hits):
+            for pos, sent in enumerate(self._passage_sentences(hit.get("passage", ""))):
+                candidates.append((rank, pos, sent))
+        if not candidates:
+            return BudgetedContext("", (), ())
+
+        # document frequency over the retrieved sentences, so rare query terms (gene names) weigh most
+        df: Dict[str, int] = {}
+        for _, _, sent in candidates:
+            for t in sent.terms & q_terms:
+                df[t] = df.get(t, 0) + 1
+        n = len(candidates)
+
+        def relevance(item) -> float:
+            rank, _, sent = item
+            overlap = sum(math.log(1.0 + n / df[t]) for t in sent.terms & q_terms)
+            cue = sent.cues[col] if col is not None else 0
+            if not overlap and not cue:
+                return 0.0
+            return overlap + 0.5 * cue + 0.25 / (1 + rank)
+
+        scored = [(relevance(it), it) for it in candidates]
+        if any(score > 0 for score, _ in scored):
+            # sentences sharing nothing with the question only pad the prompt
+            scored = [(score, it) for score, it in scored if score > 0]
+        ranked = [it for _, it in sorted(scored, key=lambda p: (-p[0], p[1][0], p[1][1]))]
+        chosen: List[Tuple[int, int, _Sentence]] = []
+        used = deduped = dropped = 0
+        for item in ranked:
+            sent = item[2]
+            if any(_jaccard(sent.terms, c[2].terms) >= self.dedup_threshold for c in chosen):
+                deduped += 1
+                continue
+            if used + len(sent.ids) > self.budget:
+                dropped += 1
+                continue  # a shorter, lower-ranked sentence may still fit
+            chosen.append(item)
+            used += len(sent.ids)
+        chosen.sort(key=lambda it: (it[0], it[1]))
+
+        ids: List[int] = []
+        for _, _, sent in chosen:
+            ids.extend(sent.ids)
+        with self._lock:
+            s = self._stats
+            s["contexts"] += 1
+            s["tokens_total"] += used
+            s["deduplicated"] += deduped
+            s["sentences_dropped"] += dropped
+        doc_ids = tuple(dict.fromkeys(int(hits[r]["doc_id"]) for r, _, _ in chosen if hits[r].get("doc_id") is not None))
+        return BudgetedContext(" ".join(sent.text for _, _, sent in chosen), tuple(ids), doc_ids)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            s = dict(self._stats)
+        return {
+            "token_budget": self.budget,
+            "contexts": s["contexts"],
+            "avg_tokens": round(s["tokens_total"] / s["contexts"], 1) if s["contexts"] else 0.0,
+            "deduplicated": s["deduplicated"],
+            "sentences_dropped": s["sentences_dropped"],
+            "token_cache": self.sentences.stats(),
+        }
+
+def _jaccard(a: frozenset, b: frozenset) -> float:
+    if not a or not b:
+        return 1.0 if a == b else 0.0
+    return len(a & b) / float(len(a | b))
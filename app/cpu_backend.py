@@ -0,0 +1,278 @@
+"""
+CPU generation backends, chosen with CPU_BACKEND in config:
+
+  fp32   float32 weights (what move_model_to_device used to leave on CPU)
+  bf16   bfloat16 weights, when the CPU has native bf16 (AVX512-BF16 / AMX); fp32 otherwise
+  int8   dynamic int8 quantization of every nn.Linear (weights int8, activations quantized per call)
+
+Torch intra-op threads follow the container's cgroup CPU quota (a pod limited to 4 CPUs
+on a 64-core host should not start 64 threads), unless CPU_THREADS pins them;
+CPU_INTEROP_THREADS sets the inter-op pool. TORCH_COMPILE wraps the forward pass in
+torch.compile and pays the compilation with a short warmup generate at startup.
+
+CPU_SELF_BENCHMARK times a fixed greedy generation once the model is loaded and reports
+tokens/sec and resident memory on /health. `python -m app cpu-bench` loads each mode in a
+fresh process and compares speed, memory and answer parity against fp32 on the test set.
+"""
+import math, os, re, time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+CPU_BACKENDS = ("fp32", "bf16", "int8")
+
+def cpu_backend(cfg: Dict[str, Any]) -> str:
+    mode = str(cfg.get("CPU_BACKEND", "fp32")).lower()
+    if mode not in CPU_BACKENDS:
+        raise ValueError(f"Unknown CPU_BACKEND {mode!r}; expected one of {CPU_BACKENDS}")
+    return mode
+
+def cgroup_cpu_quota() -> Optional[float]:
+    """CPUs granted by the cgroup CPU limit (v2 cpu.max or v1 cfs quota/period); None when unlimited."""
+    try:
+        with open("/sys/fs/cgroup/cpu.max", "r") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            return int(quota) / float(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "r") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us", "r") as f:
+            period = int(f.read())
+        return quota / float(period) if quota > 0 and period > 0 else None
+    except (OSError, ValueError):
+        return None
+
+def available_cpus() -> int:
+    """min(CPU affinity, ceil(cgroup quota))."""
+    try:
+        n = len(os.sched_getaffinity(0))
+    except AttributeError:
+        n = os.cpu_count() or 1
+    quota = cgroup_cpu_quota()
+    if quota:
+        n = min(n, max(1, math.ceil(quota)))
+    return max(1, n)
+
+def tune_threads(cfg: Dict[str, Any]) -> Dict[str, int]:
+    """Set torch intra-/inter-op threads; call before the first parallel op (inter-op can only be set once)."""
+    import torch
+
+    threads = int(cfg.get("CPU_THREADS", 0)) or available_cpus()
+    interop = int(cfg.get("CPU_INTEROP_THREADS", 1))
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(max(1, interop))
+    except RuntimeError:
+        pass  # already fixed by earlier parallel work in this process
+    return {"threads": torch.get_num_threads(), "interop_threads": torch.get_num_interop_threads()}
+
+def bf16_supported() -> bool:
+    """Native bf16 matmuls (AVX512-BF16 or AMX); emulated bf16 is slower than fp32."""
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            flags = next((line for line in f if line.startswith("flags")), "")
+    except OSError:
+        return False
+    return bool(re.search(r"\b(avx512_bf16|amx_bf16)\b", flags))
+
+def apply_backend(model, mode: str):
+    """Convert a CPU model to the requested backend; returns (model, effective mode)."""
+    import torch
+
+    model = model.eval()
+    if mode == "int8":
+        model = model.float()
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return model, "int8"
+    if mode == "bf16":
+        if bf16_supported():
+            return model.to(dtype=torch.bfloat16), "bf16"
+        print("⚠ CPU has no native bf16; keeping float32.")
+    return model.float(), "fp32"
+
+def compile_model(model, tokenizer) -> float:
+    """torch.compile the forward pass and warm it with a short generate; returns warmup ms."""
+    import torch
+
+    model.forward = torch.compile(model.forward, dynamic=True)
+    t0 = time.perf_counter()
+    with torch.no_grad():
+        warm = tokenizer(["warmup"], return_tensors="pt")
+        model.generate(**warm, max_new_tokens=4, pad_token_id=tokenizer.eos_token_id)
+    return (time.perf_counter() - t0) * 1000.0
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024.0, 1)
+    except OSError:
+        pass
+    import resource
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+
+_BENCH_PROMPT = (
+    "You are a biomedical expert.\nUsing ONLY the context, explain the mechanisms mentioned.\n\n"
+    "Context:\nGDNF signals through the RET receptor tyrosine kinase together with the GFRA1 co-receptor, "
+    "and loss-of-function RET mutations impair enteric neural crest migration.\n\n"
+    "Question:\nHow do RET mutations cause Hirschsprung disease?\n\nAnswer:\n"
+)
+
+def self_benchmark(model, tokenizer, new_tokens: int = 32) -> Dict[str, Any]:
+    """Prefill + exactly `new_tokens` greedy decode steps on a fixed prompt."""
+    import torch
+
+    inputs = tokenizer([_BENCH_PROMPT], return_tensors="pt").to(model.device)
+    with torch.no_grad():
+        t0 = time.perf_counter()
+        model.generate(**inputs, max_new_tokens=1, pad_token_id=tokenizer.eos_token_id)
+        prefill_ms = (time.perf_counter() - t0) * 1000.0
+        t0 = time.perf_counter()
+        out = model.generate(**inputs, max_new_tokens=new_tokens, min_new_tokens=new_tokens,
+                             do_sample=False, pad_token_id=tokenizer.eos_token_id)
+        total_ms = (time.perf_counter() - t0) * 1000.0
+    n = int(out.shape[1] - inputs["input_ids"].shape[1])
+    return {
+        "prompt_tokens": int(inputs["input_ids"].shape[1]),
+        "new_tokens": n,
+        "prefill_ms": round(prefill_ms, 1),
+        "tokens_per_second": round(n / (total_ms / 1000.0), 2) if total_ms else None,
+        "rss_mb": rss_mb(),
+    }
+
+def prepare_cpu_model(model, tokenizer, cfg: Dict[str, Any]) -> Tuple[Any, Dict[str, Any]]:
+    """Startup hook for CPU serving: threads, backend conversion, optional compile and self-benchmark."""
+    info: Dict[str, Any] = tune_threads(cfg)
+    info["cgroup_quota"] = cgroup_cpu_quota()
+    requested = cpu_backend(cfg)
+    t0 = time.perf_counter()
+    model, info["backend"] = apply_backend(model, requested)
+    info["convert_ms"] = round((time.perf_counter() - t0) * 1000.0, 1)
+    if info["backend"] != requested:
+        info["requested_backend"] = requested
+    if cfg.get("TORCH_COMPILE", False):
+        info["compile_warmup_ms"] = round(compile_model(model, tokenizer), 1)
+    if cfg.get("CPU_SELF_BENCHMARK", False):
+        info["self_benchmark"] = self_benchmark(model, tokenizer)
+    info["rss_mb"] = rss_mb()
+    return model, info
+
+# -----------------------------
+# Per-mode comparison (python -m app cpu-bench)
+# -----------------------------
+_WORD = re.compile(r"\w+")
+
+def token_f1(pred: str, ref: str) -> float:
+    p, r = _WORD.findall(pred.lower()), _WORD.findall(ref.lower())
+    if not p or not r:
+        return float(p == r)
+    common: Dict[str, int] = {}
+    for t in r:
+        common[t] = common.get(t, 0) + 1
+    overlap = 0
+    for t in p:
+        if common.get(t, 0) > 0:
+            overlap += 1
+            common[t] -= 1
+    if not overlap:
+        return 0.0
+    precision, recall = overlap / len(p), overlap / len(r)
+    return 2 * precision * recall / (precision + recall)
+
+def _run_mode(mode: str, cfg: Dict[str, Any], items: List[Tuple[str, str]], batch_size: int) -> Dict[str, Any]:
+    """Runs in a fresh process so RSS and thread settings belong to this mode alone."""
+    from .decoding import load_decoder
+    from .gemma import answer_batch_with_gemma, load_gemma
+
+    cfg = dict(cfg, CPU_BACKEND=mode, CPU_SELF_BENCHMARK=True)
+    t0 = time.perf_counter()
+    tokenizer, model = load_gemma(cfg["MODEL_DIR"])
+    model, info = prepare_cpu_model(model.to("cpu"), tokenizer, cfg)
+    decoder = load_decoder(cfg, "cpu")
+    info["load_s"] = round(time.perf_counter() - t0, 2)
+    answers: List[str] = []
+    t0 = time.perf_counter()
+    for start in range(0, len(items), batch_size):
+        answers.extend(answer_batch_with_gemma(items[start:start + batch_size], tokenizer, model, cfg,
+                                               decoder=decoder))
+    info["answer_s"] = round(time.perf_counter() - t0, 2)
+    info["rss_mb"] = rss_mb()
+    info["answers"] = answers
+    return info
+
+def run_cpu_bench(args) -> Dict[str, Any]:
+    import json
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing as mp
+    from .bench import load_test_set
+    from .config import load_config
+    from .retriever import load_embedder, load_faiss, retrieve_top_k
+
+    cfg = load_config(os.getenv("CONFIG_PATH", "./config.json"))
+    if args.max_new_tokens:
+        cfg["MAX_NEW_TOKENS"] = args.max_new_tokens
+    if args.num_beams:
+        cfg["NUM_BEAMS"] = args.num_beams
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    if "fp32" not in modes and args.limit:
+        modes.insert(0, "fp32")  # parity reference
+
+    items: List[Tuple[str, str]] = []
+    gold: List[str] = []
+    if args.limit:
+        tests = load_test_set(args.test_set, args.limit)
+        vs = load_faiss(cfg, load_embedder(cfg))
+        k = int(cfg.get("TOP_K_DEFAULT", 5))
+        for t in tests:
+            hits = retrieve_top_k(vs, t["question"], k=k)
+            items.append((t["question"], "\n".join(h["passage"] for h in hits)))
+            gold.append(t.get("answer", ""))
+
+    results: Dict[str, Dict[str, Any]] = {}
+    for mode in modes:
+        print(f"🔄 {mode}: loading in a fresh process...")
+        with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context("spawn")) as pool:
+            results[mode] = pool.submit(_run_mode, mode, cfg, items, args.batch_size).result()
+        bench = results[mode].get("self_benchmark", {})
+        print(f"  {mode:5s} ({results[mode]['backend']}) {bench.get('tokens_per_second')} tok/s  "
+              f"prefill {bench.get('prefill_ms')} ms  RSS {results[mode]['rss_mb']} MB")
+
+    reference = results.get("fp32", {}).get("answers")
+    for mode, res in results.items():
+        answers = res.pop("answers")
+        if not answers:
+            continue
+        parity: Dict[str, Any] = {}
+        if reference:
+            parity["exact_match_vs_fp32"] = round(sum(a == b for a, b in zip(answers, reference)) / len(answers), 4)
+            parity["token_f1_vs_fp32"] = round(sum(token_f1(a, b) for a, b in zip(answers, reference)) / len(answers), 4)
+        if any(gold):
+            parity["token_f1_vs_gold"] = round(sum(token_f1(a, g) for a, g in zip(answers, gold)) / len(answers), 4)
+        res["parity"] = parity
+        if parity:
+            print(f"  {mode:5s} parity {parity}")
+        if args.min_parity and reference and mode != "fp32" and parity["token_f1_vs_fp32"] < args.min_parity:
+            print(f"⚠ {mode} token F1 vs fp32 {parity['token_f1_vs_fp32']} is below {args.min_parity}")
+
+    report = {"cpus": available_cpus(), "cgroup_quota": cgroup_cpu_quota(), "bf16_native": bf16_supported(),
+              "questions": len(items), "max_new_tokens": int(cfg["MAX_NEW_TOKENS"]),
+              "num_beams": int(cfg["NUM_BEAMS"]), "modes": results}
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ Wrote {args.out}")
+    return report
+
+def add_arguments(p) -> None:
+    p.add_argument("--modes", default=",".join(CPU_BACKENDS), help="comma-separated CPU backends to compare")
+    p.add_argument("--test-set", default=None, help="test.parquet / df_test.csv (default: data/test.parquet)")
+    p.add_argument("--limit", type=int, default=50, help="test questions for the parity check (0 = speed only)")
+    p.add_argument("--batch-size", type=int, default=8)
+    p.add_argument("--max-new-tokens", type=int, default=None, help="override MAX_NEW_TOKENS")
+    p.add_argument("--num-beams", type=int, default=None, help="override NUM_BEAMS")
+    p.add_argument("--min-parity", type=float, default=0.9, help="warn when token F1 vs fp32 falls below this")
+    p.add_argument("--out", default="bench_results/cpu_backends.json")
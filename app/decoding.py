@@ -0,0 +1,174 @@
+"""
+Decoding strategies for answer generation, chosen with DECODING_STRATEGY in config:
+
+  beam           NUM_BEAMS-way beam search with no-repeat n-grams (the original behaviour)
+  greedy         one token per forward pass
+  prompt-lookup  greedy + n-gram speculation: drafts of up to PROMPT_LOOKUP_NUM_TOKENS tokens are
+                 copied from wherever the last PROMPT_LOOKUP_MAX_NGRAM generated tokens occur in
+                 the prompt and verified in one forward pass. Extractive answers copy long runs of
+                 the retrieved context, so most drafts are accepted.
+  assisted       greedy + a small draft model (ASSISTANT_MODEL_DIR / ASSISTANT_HF_REPO) proposing
+                 ASSISTANT_NUM_TOKENS tokens at a time; falls back to prompt-lookup without one
+
+The non-beam modes stop a row as soon as the answer is complete (the model starts another
+"Question:" / "Context:" section or has emitted the fallback line) instead of running to
+MAX_NEW_TOKENS, and skip no_repeat_ngram_size, which also bans n-grams from the prompt and
+so blocks copying from the context. Speculative modes decode one row at a time
+(transformers' assisted generation is batch-size 1), and report accepted draft tokens
+per row and in aggregate on /health.
+"""
+import threading
+from typing import Any, Callable, Dict, Optional
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+from .intent import FALLBACK_LINE
+
+STRATEGIES = ("beam", "greedy", "prompt-lookup", "assisted")
+STOP_MARKERS = ("\nQuestion:", "\nContext:", "\nAnswer:")
+
+def decoding_strategy(cfg: Dict[str, Any]) -> str:
+    mode = str(cfg.get("DECODING_STRATEGY", "beam")).lower()
+    if mode not in STRATEGIES:
+        raise ValueError(f"Unknown DECODING_STRATEGY {mode!r}; expected one of {STRATEGIES}")
+    return mode
+
+def trim_at_stop(text: str) -> str:
+    """Cut a continuation where it starts a new prompt section."""
+    cut = min((i for i in (text.find(m) for m in STOP_MARKERS) if i >= 0), default=-1)
+    return text[:cut] if cut >= 0 else text
+
+class AnswerCompleteCriteria(StoppingCriteria):
+    """Stops each row once its continuation has begun a new prompt section or emitted the fallback line."""
+
+    def __init__(self, tokenizer, prompt_len: int, window: int = 24):
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+        self.window = window
+
+    def __call__(self, input_ids, scores, **kwargs):
+        start = max(self.prompt_len, input_ids.shape[1] - self.window)
+        tails = self.tokenizer.batch_decode(input_ids[:, start:], skip_special_tokens=True)
+        done = [any(m in t for m in STOP_MARKERS) or FALLBACK_LINE in t for t in tails]
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+# forward passes of the target model, per generating thread; accepted drafts = generated - forwards
+_forwards = threading.local()
+
+def _count_forward(module, args, kwargs=None):
+    _forwards.n = getattr(_forwards, "n", 0) + 1
+
+def count_forwards(model) -> None:
+    if not getattr(model, "_rag_forward_counter", False):
+        model.register_forward_pre_hook(_count_forward)
+        model._rag_forward_counter = True
+
+def forwards_so_far() -> int:
+    return getattr(_forwards, "n", 0)
+
+class Decoder:
+    def __init__(self, cfg: Dict[str, Any], assistant_model=None, assistant_tokenizer=None):
+        self.strategy = decoding_strategy(cfg)
+        self.assistant_model = assistant_model
+        self.assistant_tokenizer = assistant_tokenizer
+        if self.strategy == "assisted" and assistant_model is None:
+            print("⚠ DECODING_STRATEGY=assisted without a draft model; using prompt-lookup.")
+            self.strategy = "prompt-lookup"
+        self.lookup_tokens = int(cfg.get("PROMPT_LOOKUP_NUM_TOKENS", 10))
+        self.lookup_ngram = int(cfg.get("PROMPT_LOOKUP_MAX_NGRAM", 3))
+        self.assistant_tokens = int(cfg.get("ASSISTANT_NUM_TOKENS", 5))
+        self._lock = threading.Lock()
+        self._stats = {"rows": 0, "generated_tokens": 0, "accepted_tokens": 0, "forwards": 0}
+
+    @property
+    def speculative(self) -> bool:
+        return self.strategy in ("prompt-lookup", "assisted")
+
+    def generate_kwargs(self, tokenizer, gen_cfg: Dict[str, Any], prompt_len: int) -> Dict[str, Any]:
+        kwargs: Dict[str, Any] = dict(
+            max_new_tokens=int(gen_cfg["MAX_NEW_TOKENS"]),
+            do_sample=False,
+            repetition_penalty=float(gen_cfg["REPETITION_PENALTY"]),
+            pad_token_id=tokenizer.pad_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+        )
+        if self.strategy == "beam":
+            kwargs.update(
+                num_beams=int(gen_cfg["NUM_BEAMS"]),
+                no_repeat_ngram_size=int(gen_cfg["NO_REPEAT_NGRAM_SIZE"]),
+                length_penalty=float(gen_cfg["LENGTH_PENALTY"]),
+            )
+            return kwargs
+        kwargs.update(num_beams=1,
+                      stopping_criteria=StoppingCriteriaList([AnswerCompleteCriteria(tokenizer, prompt_len)]))
+        if self.speculative:
+            # candidate verification crops the cache, which Gemma 2's default HybridCache cannot do
+            kwargs["cache_implementation"] = None
+        if self.strategy == "prompt-lookup":
+            kwargs.update(prompt_lookup_num_tokens=self.lookup_tokens, max_matching_ngram_size=self.lookup_ngram)
+        elif self.strategy == "assisted":
+            kwargs["assistant_model"] = self.assistant_model
+            self.assistant_model.generation_config.num_assistant_tokens = self.assistant_tokens
+            if self.assistant_tokenizer is not None and self.assistant_tokenizer.get_vocab() != tokenizer.get_vocab():
+                # universal assisted decoding re-tokenizes drafts between the two vocabularies
+                kwargs.update(tokenizer=tokenizer, assistant_tokenizer=self.assistant_tokenizer)
+        return kwargs
+
+    def beams(self, gen_cfg: Dict[str, Any]) -> int:
+        return int(gen_cfg["NUM_BEAMS"]) if self.strategy == "beam" else 1
+
+    def record(self, generated: int, forwards: int) -> Dict[str, Any]:
+        """Per-row speculation stats; each target forward pass yields one token plus its accepted drafts."""
+        accepted = max(0, generated - forwards)
+        with self._lock:
+            s = self._stats
+            s["rows"] += 1
+            s["generated_tokens"] += generated
+            s["accepted_tokens"] += accepted
+            s["forwards"] += forwards
+        return {
+            "accepted_tokens": accepted,
+            "acceptance_rate": round(accepted / generated, 3) if generated else 0.0,
+            "tokens_per_forward": round(generated / forwards, 2) if forwards else None,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            s = dict(self._stats)
+        out: Dict[str, Any] = {"strategy": self.strategy, **s}
+        if self.speculative:
+            out["acceptance_rate"] = round(s["accepted_tokens"] / s["generated_tokens"], 3) if s["generated_tokens"] else 0.0
+            out["tokens_per_forward"] = round(s["generated_tokens"] / s["forwards"], 2) if s["forwards"] else None
+        return out
+
+def load_assistant(cfg: Dict[str, Any]):
+    """
+    Draft model for DECODING_STRATEGY=assisted from ASSISTANT_MODEL_DIR, downloaded from
+    ASSISTANT_HF_REPO when the folder is empty; (None, None) when neither is available.
+    """
+    import os
+    model_dir = cfg.get("ASSISTANT_MODEL_DIR") or "./app/models/assistant"
+    repo = cfg.get("ASSISTANT_HF_REPO")
+    if not repo and not (os.path.isdir(model_dir) and os.listdir(model_dir)):
+        return None, None
+    from .gemma import load_gemma
+    tokenizer, model = load_gemma(model_dir, repo or None)
+    return tokenizer, model.eval()
+
+def load_decoder(cfg: Dict[str, Any], device: str = "cpu", place: Optional[Callable[[Any], Any]] = None) -> Decoder:
+    """
+    The Decoder for DECODING_STRATEGY, loading the draft model when it is assisted. `place` moves
+    it next to the target model (default: .to(device)); on CPU it gets the same CPU_BACKEND.
+    Build one per run and pass it to every generate call, so the draft model loads only once.
+    """
+    assistant_tok = assistant = None
+    if decoding_strategy(cfg) == "assisted":
+        print("🔄 Loading draft model for assisted generation...")
+        assistant_tok, assistant = load_assistant(cfg)
+        if assistant is not None:
+            assistant = place(assistant) if place is not None else assistant.to(device)
+            if device == "cpu":
+                from .cpu_backend import apply_backend, cpu_backend
+                assistant, _ = apply_backend(assistant, cpu_backend(cfg))
+    return Decoder(cfg, assistant, assistant_tok)
@@ -0,0 +1,358 @@
+"""
+Query embedding service: a drop-in Embeddings for the FAISS store (EMBED_SERVICE_ENABLED).
+
+  micro-batching  concurrent embed_query calls are coalesced into one encode call of up to
+                  EMBED_BATCH_MAX_SIZE texts, waiting at most EMBED_BATCH_MAX_WAIT_MS after
+                  the first; embed_documents (index builds, /ask/batch) is already batched
+  backends        EMBED_BACKEND=torch runs the sentence-transformers model as before;
+                  onnx runs MiniLM exported to EMBEDDER_DIR/onnx with onnxruntime, dynamically
+                  int8-quantized with EMBED_ONNX_INT8 (`python -m app export-embedder`;
+                  needs `pip install onnx onnxruntime`)
+  cache           normalized text -> vector LRU: the pipeline cache's embeddings level when
+                  CACHE_ENABLED, else its own EMBED_CACHE_SIZE entries; hits skip the queue
+  verification    with EMBED_VERIFY_ON_LOAD, EMBED_VERIFY_SAMPLES stored passages are re-embedded and
+                  compared with their vectors in the index at every load; below EMBED_VERIFY_MIN_COSINE the onnx
+                  backend is dropped for torch (a torch mismatch, or a lossy index, only warns)
+"""
+import json, os, queue, threading, time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from .cache import LRUCache, normalize_text
+
+EMBED_BACKENDS = ("torch", "onnx")
+ONNX_SUBDIR = "onnx"
+
+def embed_backend(cfg: Dict[str, Any]) -> str:
+    mode = str(cfg.get("EMBED_BACKEND", "torch")).lower()
+    if mode not in EMBED_BACKENDS:
+        raise ValueError(f"Unknown EMBED_BACKEND {mode!r}; expected one of {EMBED_BACKENDS}")
+    return mode
+
+def onnx_paths(cfg: Dict[str, Any]) -> Dict[str, str]:
+    base = os.path.join(cfg["EMBEDDER_DIR"], ONNX_SUBDIR)
+    return {"fp32": os.path.join(base, "model.onnx"), "int8": os.path.join(base, "model.int8.onnx")}
+
+def st_settings(st_dir: str) -> Dict[str, Any]:
+    """Pooling mode, normalization and max length from a sentence-transformers folder, as its modules apply them."""
+    out: Dict[str, Any] = {"pooling": "mean", "normalize": False, "max_length": 256}
+    try:
+        with open(os.path.join(st_dir, "modules.json"), "r", encoding="utf-8") as f:
+            modules = json.load(f)
+    except OSError:
+        return out
+    for m in modules:
+        kind = m.get("type", "")
+        if kind.endswith("Normalize"):
+            out["normalize"] = True
+        elif kind.endswith("Pooling"):
+            try:
+                with open(os.path.join(st_dir, m.get("path", ""), "config.json"), "r", encoding="utf-8") as f:
+                    pooling = json.load(f)
+                if pooling.get("pooling_mode_cls_token"):
+                    out["pooling"] = "cls"
+            except OSError:
+                pass
+    try:
+        with open(os.path.join(st_dir, "sentence_bert_config.json"), "r", encoding="utf-8") as f:
+            out["max_length"] = int(json.load(f).get("max_seq_length", out["max_length"]))
+    except (OSError, ValueError):
+        pass
+    return out
+
+# -----------------------------
+# Encoders: encode(texts) -> float32 (n, dim)
+# -----------------------------
+class TorchEncoder:
+    name = "torch"
+
+    def __init__(self, embedder):
+        # HuggingFaceEmbeddings: its SentenceTransformer and the encode kwargs it was built with
+        self.client = embedder.client
+        self.encode_kwargs = dict(getattr(embedder, "encode_kwargs", None) or {})
+
+    def encode(self, texts: Sequence[str]) -> np.ndarray:
+        kwargs = {"show_progress_bar": False, **self.encode_kwargs, "convert_to_numpy": True}
+        return np.asarray(self.client.encode(list(texts), **kwargs), dtype=np.float32)
+
+class OnnxEncoder:
+    def __init__(self, model_path: str, st_dir: str, threads: int = 0):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            opts.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(model_path, opts, providers=["CPUExecutionProvider"])
+        self.inputs = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(st_dir)
+        self.settings = st_settings(st_dir)
+        self.name = "onnx-int8" if model_path.endswith(".int8.onnx") else "onnx"
+
+    def encode(self, texts: Sequence[str]) -> np.ndarray:
+        enc = self.tokenizer(list(texts), padding=True, truncation=True,
+                             max_length=self.settings["max_length"], return_tensors="np")
+        hidden = self.session.run(None, {k: v.astype(np.int64) for k, v in enc.items() if k in self.inputs})[0]
+        if self.settings["pooling"] == "cls":
+            vecs = hidden[:, 0]
+        else:
+            mask = enc["attention_mask"][..., None].astype(np.float32)
+            vecs = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.settings["normalize"]:
+            vecs = vecs / np.clip(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12, None)
+        return vecs.astype(np.float32)
+
+def export_onnx(cfg: Dict[str, Any], int8: bool = True) -> Dict[str, str]:
+    """Export the sentence-transformers model under EMBEDDER_DIR to ONNX (plus an int8 copy)."""
+    import inspect
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+    from .retriever import SENTENCE_TRANSFORMER_SUBDIR, load_embedder_from_dir
+
+    load_embedder_from_dir(cfg)  # makes sure the sentence-transformers folder exists
+    st_dir = os.path.join(cfg["EMBEDDER_DIR"], SENTENCE_TRANSFORMER_SUBDIR)
+    paths = onnx_paths(cfg)
+    os.makedirs(os.path.dirname(paths["fp32"]), exist_ok=True)
+
+    model = AutoModel.from_pretrained(st_dir).eval()
+    sample = AutoTokenizer.from_pretrained(st_dir)(["export"], return_tensors="pt")
+    names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in sample]
+
+    class _Hidden(torch.nn.Module):
+        def __init__(self, inner):
+            super().__init__()
+            self.inner = inner
+
+        def forward(self, *args):
+            return self.inner(**dict(zip(names, args))).last_hidden_state
+
+    axes = {n: {0: "batch", 1: "seq"} for n in names + ["last_hidden_state"]}
+    extra = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(_Hidden(model), tuple(sample[n] for n in names), paths["fp32"], input_names=names,
+                          output_names=["last_hidden_state"], dynamic_axes=axes, opset_version=17, **extra)
+    print(f"✅ ONNX embedder written to {paths['fp32']}")
+    if int8:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(paths["fp32"], paths["int8"], weight_type=QuantType.QInt8)
+        print(f"✅ int8 ONNX embedder written to {paths['int8']}")
+    return paths
+
+def onnx_encoder(cfg: Dict[str, Any]) -> OnnxEncoder:
+    from .retriever import SENTENCE_TRANSFORMER_SUBDIR
+
+    paths = onnx_paths(cfg)
+    path = paths["int8"] if cfg.get("EMBED_ONNX_INT8", True) else paths["fp32"]
+    if not os.path.exists(path):
+        export_onnx(cfg, int8=bool(cfg.get("EMBED_ONNX_INT8", True)))
+    st_dir = os.path.join(cfg["EMBEDDER_DIR"], SENTENCE_TRANSFORMER_SUBDIR)
+    return OnnxEncoder(path, st_dir, int(cfg.get("EMBED_ONNX_THREADS", 0)))
+
+# -----------------------------
+# Service
+# -----------------------------
+class _Pending:
+    __slots__ = ("text", "future")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.future: Future = Future()
+
+class EmbeddingService(Embeddings):
+    def __init__(self, encoder, cfg: Dict[str, Any], cache: Optional[LRUCache] = None, fallback=None):
+        self.encoder = encoder
+        self.fallback = fallback  # torch encoder to switch to when verification fails
+        self.max_batch = max(1, int(cfg.get("EMBED_BATCH_MAX_SIZE", 32)))
+        self.max_wait = max(0.0, float(cfg.get("EMBED_BATCH_MAX_WAIT_MS", 2))) / 1000.0
+        size = int(cfg.get("EMBED_CACHE_SIZE", 4096))
+        self.cache = cache if cache is not None else (LRUCache("embeddings", size, 0) if size > 0 else None)
+        self.verification: Optional[Dict[str, Any]] = None
+        self._lock = threading.Lock()
+        self._queue: "queue.Queue[_Pending]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {"requests": 0, "batches": 0, "batched_requests": 0, "max_batch_seen": 0,
+                       "encode_ms_total": 0.0, "documents": 0}
+
+    def _ensure_thread(self) -> None:
+        # started on first use, and again in a pre-forked worker (threads do not survive fork)
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(target=self._loop, name="embed-batcher", daemon=True)
+                self._thread.start()
+
+    def embed_query(self, text: str) -> List[float]:
+        key = normalize_text(text)
+        if self.cache is not None:
+            vec = self.cache.get(key)
+            if vec is not None:
+                return vec
+        self._ensure_thread()
+        pending = _Pending(text)
+        self._queue.put(pending)
+        vec = pending.future.result()
+        if self.cache is not None:
+            self.cache.set(key, vec)
+        return vec
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with self._lock:
+            self._stats["documents"] += len(texts)
+        return self.encoder.encode(texts).tolist() if texts else []
+
+    def _loop(self) -> None:
+        q = self._queue
+        while True:
+            batch = [q.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(q.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            t0 = time.perf_counter()
+            try:
+                vecs = self.encoder.encode([p.text for p in batch])
+                for p, v in zip(batch, vecs):
+                    p.future.set_result([float(x) for x in v])
+            except Exception as e:
+                for p in batch:
+                    p.future.set_exception(e)
+            with self._lock:
+                s = self._stats
+                s["requests"] += len(batch)
+                s["batches"] += 1
+                s["batched_requests"] += len(batch) if len(batch) > 1 else 0
+                s["max_batch_seen"] = max(s["max_batch_seen"], len(batch))
+                s["encode_ms_total"] += (time.perf_counter() - t0) * 1000.0
+
+    def verify(self, vs, samples: int = 16, min_cosine: float = 0.99) -> Dict[str, Any]:
+        """
+        Re-embed `samples` stored passages (spread over the index) and compare them with the
+        vectors the index holds for them. Falls back to the torch encoder when an onnx one
+        does not match an exact index.
+        """
+        result = verify_against_index(self.encoder, vs, samples, min_cosine)
+        if not result.get("ok", True) and not result.get("lossy_index") and self.fallback is not None \
+                and self.encoder is not self.fallback:
+            print(f"⚠ {self.encoder.name} embeddings do not match the index "
+                  f"(min cosine {result['min_cosine']}); using the torch embedder.")
+            result["rejected_backend"] = self.encoder.name
+            self.encoder = self.fallback
+            if self.cache is not None:
+                self.cache.clear()
+        elif not result.get("ok", True):
+            print(f"⚠ Query embeddings differ from the indexed vectors (min cosine {result['min_cosine']}).")
+        self.verification = result
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            s = dict(self._stats)
+        return {
+            "backend": self.encoder.name,
+            "max_batch_size": self.max_batch,
+            "max_wait_ms": round(self.max_wait * 1000.0, 2),
+            **s,
+            "encode_ms_total": round(s["encode_ms_total"], 1),
+            "avg_batch": round(s["requests"] / s["batches"], 2) if s["batches"] else 0.0,
+            "cache": self.cache.stats() if self.cache is not None else None,
+            "verification": self.verification,
+        }
+
+def verify_against_index(encoder, vs, samples: int = 16, min_cosine: float = 0.99) -> Dict[str, Any]:
+    from .ann import is_lossy
+    from .retriever import DocstorePassages
+
+    index = vs.index
+    total = int(index.ntotal)
+    tombstones = getattr(vs, "tombstones", frozenset())
+    if total == 0 or samples <= 0:
+        return {"checked": 0}
+    step = max(1, total // samples)
+    rows = [r for r in range(0, total, step) if r not in tombstones][:samples]
+    try:
+        stored = _reconstruct(index, rows)
+    except RuntimeError as e:
+        return {"checked": 0, "skipped": f"index cannot reconstruct vectors ({e})"}
+    passages = getattr(vs, "passages", None)
+    passages = passages if passages is not None else DocstorePassages(vs)
+    fresh = encoder.encode([passages.get(r)[0] for r in rows])
+    norms = np.linalg.norm(stored, axis=1) * np.linalg.norm(fresh, axis=1)
+    cos = (stored * fresh).sum(axis=1) / np.clip(norms, 1e-12, None)
+    return {
+        "backend": encoder.name,
+        "checked": len(rows),
+        "min_cosine": round(float(cos.min()), 5),
+        "mean_cosine": round(float(cos.mean()), 5),
+        "max_abs_diff": round(float(np.abs(stored - fresh).max()), 5),
+        "lossy_index": bool(is_lossy(index)),
+        "threshold": min_cosine,
+        "ok": bool(cos.min() >= min_cosine),
+    }
+
+def _reconstruct(index, rows: List[int]) -> np.ndarray:
+    import faiss
+    try:
+        return np.stack([index.reconstruct(int(r)) for r in rows]).astype(np.float32)
+    except RuntimeError:
+        ivf = faiss.try_extract_index_ivf(index) if hasattr(faiss, "try_extract_index_ivf") else None
+        if ivf is None:
+            raise
+        ivf.make_direct_map()
+        return np.stack([index.reconstruct(int(r)) for r in rows]).astype(np.float32)
+
+def load_embedding_service(cfg: Dict[str, Any], embedder, cache: Optional[LRUCache] = None) -> EmbeddingService:
+    """Wrap a loaded HuggingFaceEmbeddings; EMBED_BACKEND=onnx swaps in onnxruntime when it is available."""
+    torch_encoder = TorchEncoder(embedder)
+    encoder = torch_encoder
+    if embed_backend(cfg) == "onnx":
+        try:
+            encoder = onnx_encoder(cfg)
+        except Exception as e:
+            print(f"⚠ ONNX embedder unavailable ({e}); using the torch embedder.")
+    return EmbeddingService(encoder, cfg, cache, fallback=torch_encoder)
+
+# -----------------------------
+# Export + parity check (python -m app export-embedder)
+# -----------------------------
+_PARITY_TEXTS = [
+    "What are biomarkers for lung cancer?",
+    "GDNF signals through the RET receptor tyrosine kinase.",
+    "Loss-of-function mutations impair enteric neural crest migration.",
+    "HB-EGF is a heparin-binding member of the EGF family.",
+]
+
+def run_export(args) -> Dict[str, Any]:
+    from .config import load_config
+    from .retriever import SENTENCE_TRANSFORMER_SUBDIR, load_embedder_from_dir
+
+    cfg = load_config(os.getenv("CONFIG_PATH", "./config.json"))
+    paths = export_onnx(cfg, int8=not args.no_int8)
+    reference = TorchEncoder(load_embedder_from_dir(cfg)).encode(_PARITY_TEXTS)
+    report: Dict[str, Any] = {}
+    for kind, path in paths.items():
+        if not os.path.exists(path):
+            continue
+        enc = OnnxEncoder(path, os.path.join(cfg["EMBEDDER_DIR"], SENTENCE_TRANSFORMER_SUBDIR))
+        t0 = time.perf_counter()
+        vecs = enc.encode(_PARITY_TEXTS)
+        cos = (vecs * reference).sum(axis=1) / np.clip(
+            np.linalg.norm(vecs, axis=1) * np.linalg.norm(reference, axis=1), 1e-12, None)
+        report[kind] = {"path": path, "size_mb": round(os.path.getsize(path) / 2**20, 1),
+                        "min_cosine_vs_torch": round(float(cos.min()), 5),
+                        "encode_ms": round((time.perf_counter() - t0) * 1000.0, 1)}
+    print(json.dumps(report, indent=2))
+    return report
+
+def add_arguments(p) -> None:
+    p.add_argument("--no-int8", action="store_true", help="skip the dynamically quantized int8 copy")
@@ -1,11 +1,21 @@
-from typing import Dict, Any
-import os, re, torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import os, re, threading, time, torch
+from transformers import (
+    AutoTokenizer,
+    AutoModelForCausalLM,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextIteratorStreamer,
+    pipeline,
+)
 from huggingface_hub import snapshot_download
 
+from .context import BudgetedContext
+from .decoding import Decoder, count_forwards, forwards_so_far, trim_at_stop
 from .intent import (
     detect_question_intent,
     filter_context_for_intent,
+    FilteredContext,
     INTENT_TEMPLATES,
     FALLBACK_LINE,
 )
@@ -62,11 +72,12 @@ def load_gemma(model_dir: str | None = None, repo_id: str | None = None, revisio
     # If you run fully offline later, TRANSFORMERS_OFFLINE=1 will make these calls hit the local_path only
     tok = AutoTokenizer.from_pretrained(local_path, use_fast=True)
     # dtype ‘auto’ is safe; on CPU it will pick float32
-    model = AutoModelForCausalLM.from_pretrained(local_path, torch_dtype="auto")
+    # low_cpu_mem_usage maps the safetensors shards instead of allocating a random-init copy first
+    model = AutoModelForCausalLM.from_pretrained(local_path, torch_dtype="auto", low_cpu_mem_usage=True)
 
     return tok, model
 
-def build_rewriter(tokenizer, model, max_new_tokens: int = 128):
+def build_rewriter(tokenizer, model, max_new_tokens: int = 128, num_beams: int = 4):
     dev = device_kind()
     dev_idx = 0 if dev == "cuda" else -1
     return pipeline(
@@ -74,7 +85,7 @@ def build_rewriter(tokenizer, model, max_new_tokens: int = 128):
         model=model,
         tokenizer=tokenizer,
         max_new_tokens=max_new_tokens,
-        num_beams=4,
+        num_beams=num_beams,
         pad_token_id=tokenizer.eos_token_id,
         eos_token_id=tokenizer.eos_token_id,
         device=dev_idx,
@@ -100,36 +111,90 @@ def rewrite_query(gen_pipeline, question: str, preferred_option: str = "Option 2
             return line.split(":", 1)[-1].strip() or question
     return question
 
-@torch.no_grad()
-def answer_with_gemma(
-    question: str,
-    context: str,
-    tokenizer,
-    model,
-    gen_cfg: Dict[str, Any],
-) -> str:
+def build_answer_prompt(question: str, context):
+    """
+    Return (intent, prompt); prompt is None when the focused context is empty.
+    A BudgetedContext (context.ContextBuilder) or FilteredContext (sentences.SentenceIndex) is
+    already ranked and trimmed, so it is used as is.
+    """
     intent = detect_question_intent(question)
-    focused_context = filter_context_for_intent(context, intent)
+    if isinstance(context, (BudgetedContext, FilteredContext)):
+        focused_context = context.text
+    else:
+        focused_context = filter_context_for_intent(context, intent)
     if not focused_context.strip():
-        return FALLBACK_LINE
+        return intent, None
+    return intent, INTENT_TEMPLATES[intent].format(context=focused_context, question=question)
 
-    prompt = INTENT_TEMPLATES[intent].format(context=focused_context, question=question)
-    inputs = tokenizer([prompt], return_tensors="pt", padding=True, truncation=True).to(model.device)
-
-    outputs = model.generate(
-        **inputs,
-        max_new_tokens=int(gen_cfg["MAX_NEW_TOKENS"]),
-        num_beams=int(gen_cfg["NUM_BEAMS"]),
-        do_sample=False,
-        no_repeat_ngram_size=int(gen_cfg["NO_REPEAT_NGRAM_SIZE"]),
-        repetition_penalty=float(gen_cfg["REPETITION_PENALTY"]),
-        length_penalty=float(gen_cfg["LENGTH_PENALTY"]),
-        pad_token_id=tokenizer.eos_token_id,
-        eos_token_id=tokenizer.eos_token_id,
-    )
-    raw = tokenizer.decode(outputs[0], skip_special_tokens=True)
-    answer = raw.replace(prompt, "").strip()
+_HEAD_IDS: Dict[Tuple[int, str], List[int]] = {}
 
+def template_head_ids(tokenizer, intent: str) -> List[int]:
+    """Token ids (with BOS) of the static part of an intent template, everything before {context}."""
+    key = (id(tokenizer), intent)
+    head_ids = _HEAD_IDS.get(key)
+    if head_ids is None:
+        head = INTENT_TEMPLATES[intent].split("{context}", 1)[0]
+        head_ids = _HEAD_IDS[key] = list(tokenizer(head, add_special_tokens=True)["input_ids"])
+    return head_ids
+
+def budgeted_prompt_ids(tokenizer, intent: str, question: str, context: BudgetedContext) -> List[int]:
+    """
+    Prompt token ids assembled from the template head (tokenized once per intent), the
+    context's cached sentence ids and the tokenized question tail, so the context itself
+    is never re-tokenized.
+    """
+    tail = INTENT_TEMPLATES[intent].split("{context}", 1)[1]
+    tail_ids = tokenizer(tail.format(question=question), add_special_tokens=False)["input_ids"]
+    return template_head_ids(tokenizer, intent) + list(context.token_ids) + list(tail_ids)
+
+def prompt_id_lists(tokenizer, prompts: List[str], contexts: List[Any], questions: List[str],
+                    intents: List[str]) -> List[List[int]]:
+    """Unpadded prompt token ids; budgeted contexts skip the tokenizer for their context part."""
+    seqs: List[Optional[List[int]]] = [
+        budgeted_prompt_ids(tokenizer, intent, q, c) if isinstance(c, BudgetedContext) else None
+        for q, c, intent in zip(questions, contexts, intents)
+    ]
+    plain = [i for i, s in enumerate(seqs) if s is None]
+    if plain:
+        enc = tokenizer([prompts[i] for i in plain], truncation=True)["input_ids"]
+        for i, ids in zip(plain, enc):
+            seqs[i] = list(ids)
+    return seqs
+
+def pad_prompts(tokenizer, seqs: List[List[int]], device, keep: int = 0) -> Dict[str, Any]:
+    """
+    Left-pad to a common width. With keep > 0 the padding goes after the first `keep`
+    tokens instead, so a shared cached prefix stays at positions 0..keep-1 in every row.
+    """
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    width = max(len(s) for s in seqs)
+    pad = tokenizer.pad_token_id
+    input_ids = torch.tensor([s[:keep] + [pad] * (width - len(s)) + s[keep:] for s in seqs], dtype=torch.long)
+    attention_mask = torch.tensor([[1] * keep + [0] * (width - len(s)) + [1] * (len(s) - keep) for s in seqs],
+                                  dtype=torch.long)
+    return {"input_ids": input_ids.to(device), "attention_mask": attention_mask.to(device)}
+
+def encode_prompts(tokenizer, prompts: List[str], contexts: List[Any], questions: List[str],
+                   intents: List[str], device, prefix_cache=None, beams: int = 1) -> Dict[str, Any]:
+    """
+    Generate kwargs for a batch of prompts: input_ids / attention_mask, plus past_key_values
+    when a PrefixCache (app.prefix_cache) holds a prefix shared by every row.
+    """
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    seqs = prompt_id_lists(tokenizer, prompts, contexts, questions, intents)
+    past, keep = prefix_cache.lookup(intents, seqs, len(seqs) * beams) if prefix_cache is not None else (None, 0)
+    inputs = pad_prompts(tokenizer, seqs, device, keep)
+    if past is not None:
+        inputs["past_key_values"] = past
+        # Gemma 2 defaults to a HybridCache; a caller-supplied cache replaces it
+        inputs["cache_implementation"] = None
+        inputs["prefix_tokens"] = keep
+    return inputs
+
+def postprocess_answer(intent: str, answer: str) -> str:
+    answer = trim_at_stop(answer).strip()
     if not answer or answer.lower().startswith("the context does not") or "cannot answer" in answer.lower():
         return FALLBACK_LINE
 
@@ -137,3 +202,169 @@ def answer_with_gemma(
         if len(answer) < 30:
             return FALLBACK_LINE
     return answer
+
+@torch.no_grad()
+def answer_batch_with_gemma(
+    items: List[Tuple[str, str]],
+    tokenizer,
+    model,
+    gen_cfg: Dict[str, Any],
+    stats: Optional[List[Dict[str, Any]]] = None,
+    prefix_cache=None,
+    decoder: Optional[Decoder] = None,
+) -> List[str]:
+    """
+    Answer several (question, context) pairs with a single model.generate call.
+    Prompts are left-padded so every row ends at the same column and the
+    generated continuation can be sliced off uniformly.
+    If `stats` is given it is filled with one dict per item (context filter time,
+    prompt/generated token counts, generate time, tokens/sec, batch size).
+    With a PrefixCache the template prefix is not prefilled again (see app.prefix_cache).
+    The Decoder (default: DECODING_STRATEGY from gen_cfg) picks beam, greedy or speculative
+    decoding; speculative strategies generate row by row and add acceptance stats.
+    """
+    answers: List[str] = [FALLBACK_LINE] * len(items)
+    per_item: List[Dict[str, Any]] = [{} for _ in items]
+    intents: List[str] = []
+    prompts: List[str] = []
+    rows: List[int] = []
+    for i, (question, context) in enumerate(items):
+        t0 = time.perf_counter()
+        intent, prompt = build_answer_prompt(question, context)
+        per_item[i]["context_filter_ms"] = (time.perf_counter() - t0) * 1000.0
+        if prompt is None:
+            continue
+        intents.append(intent)
+        prompts.append(prompt)
+        rows.append(i)
+    if stats is not None:
+        stats[:] = per_item
+    if not prompts:
+        return answers
+
+    decoder = decoder or Decoder(gen_cfg)
+    if decoder.speculative:
+        count_forwards(model)
+    groups = [[j] for j in range(len(rows))] if decoder.speculative else [list(range(len(rows)))]
+    for group in groups:
+        inputs = encode_prompts(tokenizer, [prompts[j] for j in group], [items[rows[j]][1] for j in group],
+                                [items[rows[j]][0] for j in group], [intents[j] for j in group], model.device,
+                                prefix_cache=prefix_cache, beams=decoder.beams(gen_cfg))
+        prefix_tokens = inputs.pop("prefix_tokens", 0)
+        prompt_len = inputs["input_ids"].shape[1]
+        kwargs = decoder.generate_kwargs(tokenizer, gen_cfg, prompt_len)
+        kwargs.update(inputs)
+
+        forwards = forwards_so_far()
+        t0 = time.perf_counter()
+        outputs = model.generate(**kwargs)
+        generate_ms = (time.perf_counter() - t0) * 1000.0
+        forwards = forwards_so_far() - forwards
+        prompt_tokens = inputs["attention_mask"].sum(dim=1).tolist()
+        for pos, (j, seq) in enumerate(zip(group, outputs)):
+            row = rows[j]
+            gen = seq[prompt_len:]
+            raw = tokenizer.decode(gen, skip_special_tokens=True)
+            answers[row] = postprocess_answer(intents[j], raw)
+            n_gen = int((gen != tokenizer.pad_token_id).sum())
+            spec = decoder.record(n_gen, forwards) if decoder.speculative else {}
+            if stats is not None:
+                stats[row].update(
+                    prompt_tokens=int(prompt_tokens[pos]),
+                    generated_tokens=n_gen,
+                    generate_ms=generate_ms,
+                    tokens_per_second=round(n_gen / (generate_ms / 1000.0), 2) if generate_ms else None,
+                    batch_size=len(prompts),
+                    prefix_cached_tokens=prefix_tokens,
+                    **spec,
+                )
+    return answers
+
+def answer_with_gemma(
+    question: str,
+    context,
+    tokenizer,
+    model,
+    gen_cfg: Dict[str, Any],
+    prefix_cache=None,
+    decoder: Optional[Decoder] = None,
+) -> str:
+    return answer_batch_with_gemma([(question, context)], tokenizer, model, gen_cfg,
+                                   prefix_cache=prefix_cache, decoder=decoder)[0]
+
+class _CancelCriteria(StoppingCriteria):
+    """Stops generation once the streaming consumer has gone away."""
+
+    def __init__(self, cancelled: threading.Event):
+        self.cancelled = cancelled
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.cancelled.is_set(), dtype=torch.bool, device=input_ids.device)
+
+def stream_answer_with_gemma(
+    question: str,
+    context: str,
+    tokenizer,
+    model,
+    gen_cfg: Dict[str, Any],
+    prefix_cache=None,
+    decoder: Optional[Decoder] = None,
+) -> Iterator[Tuple[str, str]]:
+    """
+    Yield ("token", text) chunks as Gemma produces them, then a final
+    ("done", answer) with the same guardrails as answer_with_gemma.
+    Beam search cannot stream, so this always uses greedy or sampled decoding;
+    greedy and speculative decoder strategies are streamed as configured.
+    Closing the iterator early stops the background generate call.
+    """
+    intent, prompt = build_answer_prompt(question, context)
+    if prompt is None:
+        yield "done", FALLBACK_LINE
+        return
+
+    inputs = encode_prompts(tokenizer, [prompt], [context], [question], [intent], model.device,
+                            prefix_cache=prefix_cache)
+    inputs.pop("prefix_tokens", None)
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    cancelled = threading.Event()
+    do_sample = bool(gen_cfg.get("STREAM_DO_SAMPLE", False))
+    decoder = decoder or Decoder(gen_cfg)
+    if do_sample or decoder.strategy == "beam":
+        kwargs: Dict[str, Any] = dict(
+            max_new_tokens=int(gen_cfg["MAX_NEW_TOKENS"]),
+            num_beams=1,
+            do_sample=do_sample,
+            no_repeat_ngram_size=int(gen_cfg["NO_REPEAT_NGRAM_SIZE"]),
+            repetition_penalty=float(gen_cfg["REPETITION_PENALTY"]),
+            stopping_criteria=StoppingCriteriaList([_CancelCriteria(cancelled)]),
+            pad_token_id=tokenizer.eos_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+        )
+    else:
+        kwargs = decoder.generate_kwargs(tokenizer, gen_cfg, inputs["input_ids"].shape[1])
+        kwargs["stopping_criteria"] = StoppingCriteriaList([*kwargs["stopping_criteria"], _CancelCriteria(cancelled)])
+    kwargs.update(inputs, streamer=streamer)
+    if do_sample:
+        kwargs["temperature"] = float(gen_cfg.get("STREAM_TEMPERATURE", 0.7))
+        kwargs["top_p"] = float(gen_cfg.get("STREAM_TOP_P", 0.9))
+
+    def _generate():
+        with torch.no_grad():
+            try:
+                model.generate(**kwargs)
+            finally:
+                # make sure the consumer loop terminates even if generate raised
+                streamer.end()
+
+    worker = threading.Thread(target=_generate, name="gemma-stream", daemon=True)
+    worker.start()
+
+    parts: List[str] = []
+    try:
+        for text in streamer:
+            if text:
+                parts.append(text)
+                yield "token", text
+    finally:
+        cancelled.set()
+    yield "done", postprocess_answer(intent, "".join(parts))
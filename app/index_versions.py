@@ -0,0 +1,157 @@
+"""
+Versioned index directories and the reference-counted handles the server reads through.
+
+Layout under FAISS_DIR:
+  versions/<name>/   one complete index folder each (index.faiss, index.pkl, passages.*, bm25.*, sentences.*)
+  CURRENT            name of the active version, replaced atomically
+A FAISS_DIR without CURRENT is a plain index folder (the original layout) and is served as is.
+
+Requests pin the active IndexHandle for as long as they read the index. A reload loads
+and warms the new version off the request path, then swaps it in under a lock; the old
+handle is retired and its store released only once the last request pinning it is done.
+"""
+import hashlib, os, threading, time
+from typing import Any, Dict, List, Optional, Tuple
+
+VERSIONS_DIR = "versions"
+CURRENT_FILE = "CURRENT"
+
+def versions_root(root: str) -> str:
+    return os.path.join(root, VERSIONS_DIR)
+
+def version_dir(root: str, name: str) -> str:
+    if not name or os.sep in name or name in (".", ".."):
+        raise ValueError(f"Invalid index version name {name!r}")
+    return os.path.join(versions_root(root), name)
+
+def list_versions(root: str) -> List[str]:
+    base = versions_root(root)
+    if not os.path.isdir(base):
+        return []
+    return sorted(n for n in os.listdir(base)
+                  if os.path.exists(os.path.join(base, n, "index.faiss")))
+
+def current_name(root: str) -> Optional[str]:
+    try:
+        with open(os.path.join(root, CURRENT_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def set_current(root: str, name: Optional[str]) -> None:
+    """Point CURRENT at `name` (atomically); None returns to the plain folder layout."""
+    path = os.path.join(root, CURRENT_FILE)
+    if name is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    if not os.path.exists(os.path.join(version_dir(root, name), "index.faiss")):
+        raise FileNotFoundError(f"No index.faiss in version {name!r}")
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(name + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def resolve_dir(root: str, name: Optional[str] = None) -> str:
+    """Folder of version `name`, of CURRENT when None, or `root` itself without versions."""
+    name = name or current_name(root)
+    return version_dir(root, name) if name else root
+
+def fingerprint(directory: str) -> str:
+    """Fingerprint of the files in an index folder (name, size, mtime); changes whenever it is rebuilt."""
+    h = hashlib.sha1()
+    for name in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            st = os.stat(path)
+            h.update(f"{name}:{st.st_size}:{int(st.st_mtime)}".encode())
+    return h.hexdigest()[:12]
+
+def version_label(root: str, directory: str) -> str:
+    """The version name for folders under versions/, the content fingerprint otherwise."""
+    parent, name = os.path.split(os.path.normpath(directory))
+    if os.path.normpath(parent) == os.path.normpath(versions_root(root)):
+        return name
+    return fingerprint(directory)
+
+class IndexHandle:
+    def __init__(self, vs, version: str, directory: str):
+        self.vs = vs
+        self.version = version
+        self.directory = directory
+        self.loaded_at = time.time()
+        self.refs = 0
+        self.retired = False
+
+    def describe(self) -> Dict[str, Any]:
+        return {"version": self.version, "dir": self.directory, "in_flight": self.refs,
+                "loaded_at": round(self.loaded_at, 3)}
+
+class IndexRegistry:
+    def __init__(self, history: int = 5):
+        self._lock = threading.Lock()
+        self.current: Optional[IndexHandle] = None
+        self._history: List[Tuple[str, str]] = []  # (version, dir) of earlier active versions
+        self._max_history = history
+        self._draining: List[IndexHandle] = []
+        self.swaps = 0
+
+    def acquire(self) -> IndexHandle:
+        with self._lock:
+            handle = self.current
+            if handle is None:
+                raise RuntimeError("No index loaded")
+            handle.refs += 1
+            return handle
+
+    def release(self, handle: IndexHandle) -> None:
+        with self._lock:
+            handle.refs -= 1
+            if handle.retired and handle.refs == 0:
+                self._free(handle)
+
+    def _free(self, handle: IndexHandle) -> None:
+        # drop the store so its index / mmaps can be collected
+        handle.vs = None
+        if handle in self._draining:
+            self._draining.remove(handle)
+
+    def swap(self, handle: IndexHandle, record: bool = True) -> Optional[IndexHandle]:
+        """
+        Make `handle` active; the old one is freed now or when its last in-flight request
+        releases it. With record=False (rollbacks) the old version is not pushed to the history.
+        """
+        with self._lock:
+            old, self.current = self.current, handle
+            self.swaps += 1
+            if old is not None:
+                if record and (not self._history or self._history[-1] != (old.version, old.directory)):
+                    self._history.append((old.version, old.directory))
+                    del self._history[:-self._max_history]
+                old.retired = True
+                if old.refs == 0:
+                    self._free(old)
+                else:
+                    self._draining.append(old)
+            return old
+
+    def previous(self) -> Optional[Tuple[str, str]]:
+        with self._lock:
+            return self._history[-1] if self._history else None
+
+    def pop_previous(self) -> None:
+        """Drop the newest history entry once it has been rolled back to."""
+        with self._lock:
+            if self._history:
+                self._history.pop()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "active": self.current.describe() if self.current is not None else None,
+                "previous": [v for v, _ in reversed(self._history)],
+                "draining": [h.describe() for h in self._draining],
+                "swaps": self.swaps,
+            }
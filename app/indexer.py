@@ -0,0 +1,497 @@
+"""
+Streaming, resumable index builder:  python -m app build-index [options]
+
+  (default)  stream data/passages.parquet in record batches, embed them on a worker
+             pool, stage vectors + passages on disk and checkpoint after every batch,
+             then write index.faiss / index.pkl (the FAISS.save_local layout that
+             load_faiss opens) plus the columnar passage store used by FAST_START.
+  --append   same pipeline for new passages only; rows whose text or doc_id is already
+             live are skipped and the rest are added to the existing index in place.
+  --delete   tombstone passages by doc_id; retrieval skips those rows until --compact.
+  --compact  drop tombstoned rows and rewrite the index files, keeping the index's type
+             (with --index-type, convert to that type in the same pass).
+  --bm25     (re)build only the BM25 postings used by HYBRID_RETRIEVAL.
+  --sentences  (re)build only the stored sentence splits / intent cue scores (app/sentences.py).
+  --reindex  rebuild index.faiss as the configured INDEX_TYPE from the vectors already
+             stored in it (e.g. to turn the notebook's flat index into IVF-PQ).
+
+Staging lives in <FAISS_DIR>/.build. Rerunning the same command after an interruption
+picks up after the last committed batch; --restart throws the staged work away.
+"""
+import hashlib, json, os, pickle, shutil, time, uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Set, Tuple
+
+import numpy as np
+
+from .ann import build_index, build_settings, index_type, is_lossy, reconstruct_all
+from .bm25 import build_bm25, index_exists as bm25_exists
+from .passages import (BLOB_FILE, PassageStore, append_passage_store, iter_langchain_docstore,
+                       load_tombstones, save_tombstones, stamp_index, store_exists, write_passage_store)
+from .sentences import build_sentence_index, index_exists as sentences_exist
+
+_DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+STAGING_SUBDIR = ".build"
+CHECKPOINT_FILE = "checkpoint.json"
+_VECTORS = "vectors.f32"
+_ENDS = "ends.i64"
+_DOC_IDS = "doc_ids.i64"
+
+def _text_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+
+def _source_fingerprint(path: str) -> str:
+    st = os.stat(path)
+    return f"{os.path.abspath(path)}:{st.st_size}:{int(st.st_mtime)}"
+
+class Staging:
+    """
+    Append-only staging area: raw float32 vectors, the passage blob, passage end offsets
+    and doc_ids. checkpoint.json records how many bytes of each file are committed, so a
+    crash mid-write is undone by truncating back to those lengths on resume.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.state: Dict[str, Any] = {}
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def open(self, job: Dict[str, Any], restart: bool = False) -> bool:
+        """Start or resume `job`; returns True when resuming from a checkpoint."""
+        ckpt = self._path(CHECKPOINT_FILE)
+        if not restart and os.path.exists(ckpt):
+            with open(ckpt, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if all(state.get(k) == v for k, v in job.items()):
+                self.state = state
+                self._truncate()
+                return True
+            print("⚠ Staged build does not match this command (source or options changed); starting over.")
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory)
+        for name in (_VECTORS, BLOB_FILE, _ENDS, _DOC_IDS):
+            open(self._path(name), "wb").close()
+        self.state = dict(job, batches_done=0, rows_read=0, rows=0, blob_bytes=0, dim=None, duplicates=0)
+        self._write_checkpoint()
+        return False
+
+    def _truncate(self) -> None:
+        s = self.state
+        sizes = {
+            _VECTORS: s["rows"] * (s["dim"] or 0) * 4,
+            BLOB_FILE: s["blob_bytes"],
+            _ENDS: s["rows"] * 8,
+            _DOC_IDS: s["rows"] * 8,
+        }
+        for name, size in sizes.items():
+            with open(self._path(name), "r+b") as f:
+                f.truncate(size)
+
+    def _write_checkpoint(self) -> None:
+        tmp = self._path(CHECKPOINT_FILE + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path(CHECKPOINT_FILE))
+
+    def commit(self, texts: List[str], doc_ids: List[int], vectors: np.ndarray, rows_read: int, duplicates: int) -> None:
+        s = self.state
+        if len(texts):
+            if s["dim"] is None:
+                s["dim"] = int(vectors.shape[1])
+            ends, pos = [], s["blob_bytes"]
+            with open(self._path(BLOB_FILE), "ab") as f:
+                for text in texts:
+                    data = text.encode("utf-8")
+                    f.write(data)
+                    pos += len(data)
+                    ends.append(pos)
+                f.flush()
+                os.fsync(f.fileno())
+            for name, arr in ((_VECTORS, vectors.astype(np.float32, copy=False)),
+                              (_ENDS, np.asarray(ends, dtype=np.int64)),
+                              (_DOC_IDS, np.asarray(doc_ids, dtype=np.int64))):
+                with open(self._path(name), "ab") as f:
+                    f.write(np.ascontiguousarray(arr).tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+            s["rows"] += len(texts)
+            s["blob_bytes"] = pos
+        s["batches_done"] += 1
+        s["rows_read"] += rows_read
+        s["duplicates"] += duplicates
+        self._write_checkpoint()
+
+    def vectors(self) -> np.ndarray:
+        rows, dim = self.state["rows"], self.state["dim"] or 0
+        if rows == 0:
+            return np.zeros((0, dim), dtype=np.float32)
+        return np.memmap(self._path(_VECTORS), dtype=np.float32, mode="r", shape=(rows, dim))
+
+    def passages(self) -> Iterator[Tuple[str, int]]:
+        rows = self.state["rows"]
+        if rows == 0:
+            return
+        ends = np.fromfile(self._path(_ENDS), dtype=np.int64, count=rows)
+        doc_ids = np.fromfile(self._path(_DOC_IDS), dtype=np.int64, count=rows)
+        with open(self._path(BLOB_FILE), "rb") as f:
+            start = 0
+            for end, doc_id in zip(ends, doc_ids):
+                yield f.read(int(end) - start).decode("utf-8"), int(doc_id)
+                start = int(end)
+
+    def remove(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def read_parquet_batches(path: str, batch_rows: int, text_column: str, id_column: str,
+                         skip_batches: int = 0) -> Iterator[Tuple[List[Any], List[Any]]]:
+    """Yield (texts, ids) column slices, one row group at a time, without loading the whole file."""
+    import pyarrow.parquet as pq
+    pf = pq.ParquetFile(path)
+    for i, batch in enumerate(pf.iter_batches(batch_size=batch_rows, columns=[text_column, id_column])):
+        if i < skip_batches:
+            continue
+        cols = batch.to_pydict()
+        yield cols[text_column], cols[id_column]
+
+def _clean(texts: List[Any], ids: List[Any], seen: Set[bytes], live_doc_ids: Set[int]) -> Tuple[List[str], List[int], int]:
+    """Notebook cleaning, streamed: drop null passages and duplicates of anything already kept."""
+    keep_texts, keep_ids, dupes = [], [], 0
+    for text, doc_id in zip(texts, ids):
+        if text is None or doc_id is None or not str(text).strip():
+            continue
+        text = str(text)
+        key = _text_key(text)
+        if key in seen or int(doc_id) in live_doc_ids:
+            dupes += 1
+            continue
+        seen.add(key)
+        keep_texts.append(text)
+        keep_ids.append(int(doc_id))
+    return keep_texts, keep_ids, dupes
+
+def embed_stream(embedder, batches: Iterable[Tuple[List[str], List[int], int, int]],
+                 workers: int, embed_batch: int) -> Iterator[Tuple[List[str], List[int], np.ndarray, int, int]]:
+    """
+    Embed batches on a thread pool, `embed_batch` texts per embed_documents call, and yield
+    them back in input order. At most `workers` batches are read ahead of the consumer, so
+    memory stays bounded regardless of corpus size.
+    """
+    def resolve(entry):
+        (texts, doc_ids, rows_read, dupes), futures = entry
+        parts = [np.asarray(f.result(), dtype=np.float32) for f in futures]
+        vectors = np.concatenate(parts) if parts else np.zeros((0, 0), dtype=np.float32)
+        return texts, doc_ids, vectors, rows_read, dupes
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="embed") as pool:
+        pending: deque = deque()
+        for item in batches:
+            texts = item[0]
+            futures = [pool.submit(embedder.embed_documents, texts[i:i + embed_batch])
+                       for i in range(0, len(texts), embed_batch)]
+            pending.append((item, futures))
+            while len(pending) > max(1, workers):
+                yield resolve(pending.popleft())
+        while pending:
+            yield resolve(pending.popleft())
+
+def write_langchain_index(out_dir: str, vectors: np.ndarray, passages: Iterable[Tuple[str, int]],
+                          cfg: Dict[str, Any]) -> int:
+    """
+    Write index.faiss + index.pkl in the layout FAISS.from_documents(...).save_local produces
+    (InMemoryDocstore keyed by uuid4, row -> docstore id map), plus the columnar passage store.
+    The index itself is whatever INDEX_TYPE selects (IndexFlatL2 by default, as before).
+    """
+    import faiss
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_core.documents import Document
+
+    os.makedirs(out_dir, exist_ok=True)
+    index = build_index(cfg, vectors)
+
+    docs: Dict[str, Any] = {}
+    index_to_docstore_id: Dict[int, str] = {}
+    rows: List[Tuple[str, int]] = []
+    for row, (text, doc_id) in enumerate(passages):
+        _id = str(uuid.uuid4())
+        docs[_id] = Document(page_content=text, metadata={"doc_id": doc_id})
+        index_to_docstore_id[row] = _id
+        rows.append((text, doc_id))
+    if len(rows) != index.ntotal:
+        raise RuntimeError(f"{index.ntotal} vectors but {len(rows)} passages; refusing to write a misaligned index")
+
+    faiss.write_index(index, os.path.join(out_dir, "index.faiss.tmp"))
+    with open(os.path.join(out_dir, "index.pkl.tmp"), "wb") as f:
+        pickle.dump((InMemoryDocstore(docs), index_to_docstore_id), f)
+    write_passage_store(out_dir, rows)
+    build_bm25(out_dir, rows, float(cfg.get("BM25_K1", 1.2)), float(cfg.get("BM25_B", 0.75)))
+    build_sentence_index(out_dir, rows)
+    os.replace(os.path.join(out_dir, "index.faiss.tmp"), os.path.join(out_dir, "index.faiss"))
+    os.replace(os.path.join(out_dir, "index.pkl.tmp"), os.path.join(out_dir, "index.pkl"))
+    stamp_index(out_dir)
+    save_tombstones(out_dir, [])
+    return index.ntotal
+
+def append_langchain_index(out_dir: str, vectors: np.ndarray, passages: Iterable[Tuple[str, int]],
+                           cfg: Dict[str, Any]) -> int:
+    """Add staged rows to an existing index folder: faiss add, docstore add, passage store append."""
+    import faiss
+    from langchain_core.documents import Document
+
+    index = faiss.read_index(os.path.join(out_dir, "index.faiss"))
+    with open(os.path.join(out_dir, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    if index.ntotal != len(index_to_docstore_id):
+        raise RuntimeError(f"{out_dir} is inconsistent: {index.ntotal} vectors vs {len(index_to_docstore_id)} docstore rows")
+
+    rows = list(passages)
+    base = int(index.ntotal)
+    if len(vectors):
+        index.add(np.ascontiguousarray(vectors))
+    new_docs = {}
+    for i, (text, doc_id) in enumerate(rows):
+        _id = str(uuid.uuid4())
+        new_docs[_id] = Document(page_content=text, metadata={"doc_id": doc_id})
+        index_to_docstore_id[base + i] = _id
+    docstore.add(new_docs)
+
+    faiss.write_index(index, os.path.join(out_dir, "index.faiss.tmp"))
+    with open(os.path.join(out_dir, "index.pkl.tmp"), "wb") as f:
+        pickle.dump((docstore, index_to_docstore_id), f)
+    if store_exists(out_dir):
+        if len(PassageStore(out_dir)) != base:
+            raise RuntimeError(f"Passage store in {out_dir} is out of step with index.faiss; re-run export-passages")
+        append_passage_store(out_dir, rows)
+    os.replace(os.path.join(out_dir, "index.faiss.tmp"), os.path.join(out_dir, "index.faiss"))
+    os.replace(os.path.join(out_dir, "index.pkl.tmp"), os.path.join(out_dir, "index.pkl"))
+    stamp_index(out_dir)
+    if bm25_exists(out_dir):
+        # BM25 statistics (idf, avgdl) are corpus-wide, so rebuild rather than patch
+        build_bm25_for(out_dir, cfg)
+    if sentences_exist(out_dir):
+        # the doc_id lookup is global too; splitting is cheap next to embedding
+        build_sentences_for(out_dir)
+    return len(rows)
+
+def _existing_rows(out_dir: str) -> Iterator[Tuple[str, int]]:
+    if store_exists(out_dir):
+        store = PassageStore(out_dir)
+        return (store.get(row) for row in range(len(store)))
+    return iter_langchain_docstore(out_dir)
+
+def build(cfg: Dict[str, Any], source: str, out_dir: str, append: bool = False, workers: int = 2,
+          batch_rows: int = 2048, embed_batch: int = 64, text_column: str = "passage",
+          id_column: str = "id", restart: bool = False) -> Dict[str, Any]:
+    from .retriever import load_embedder_from_dir
+
+    if append and not os.path.exists(os.path.join(out_dir, "index.faiss")):
+        raise RuntimeError(f"--append needs an existing index in {out_dir}")
+    staging = Staging(os.path.join(out_dir, STAGING_SUBDIR))
+    job = {
+        "mode": "append" if append else "build",
+        "source": _source_fingerprint(source),
+        "batch_rows": batch_rows,
+        "text_column": text_column,
+        "id_column": id_column,
+        "embedder": cfg["EMBEDDING_NAME_OR_DIR"],
+    }
+    resumed = staging.open(job, restart=restart)
+    if resumed:
+        print(f"↻ Resuming after batch {staging.state['batches_done']} ({staging.state['rows']} passages staged)")
+
+    # dedupe state is rebuilt from committed data, so it never runs ahead of the checkpoint
+    seen: Set[bytes] = set()
+    live_doc_ids: Set[int] = set()
+    if append:
+        tombstones = load_tombstones(out_dir)
+        for row, (text, doc_id) in enumerate(_existing_rows(out_dir)):
+            if row not in tombstones:
+                seen.add(_text_key(text))
+                live_doc_ids.add(doc_id)
+    for text, doc_id in staging.passages():
+        seen.add(_text_key(text))
+        if append:
+            live_doc_ids.add(doc_id)
+
+    def cleaned():
+        for texts, ids in read_parquet_batches(source, batch_rows, text_column, id_column,
+                                               skip_batches=staging.state["batches_done"]):
+            keep_texts, keep_ids, dupes = _clean(texts, ids, seen, live_doc_ids)
+            if append:
+                # a doc_id appended once is live from here on; a later row reusing it is a duplicate
+                live_doc_ids.update(keep_ids)
+            yield keep_texts, keep_ids, len(texts), dupes
+
+    embedder = load_embedder_from_dir(cfg)
+    t0 = time.perf_counter()
+    embedded = 0
+    for texts, doc_ids, vectors, rows_read, dupes in embed_stream(embedder, cleaned(), workers, embed_batch):
+        staging.commit(texts, doc_ids, vectors, rows_read, dupes)
+        embedded += len(texts)
+        s = staging.state
+        rate = embedded / max(time.perf_counter() - t0, 1e-9)
+        print(f"  batch {s['batches_done']}: {s['rows_read']} rows read, {s['rows']} staged ({rate:.0f} passages/s)")
+
+    s = staging.state
+    if s["rows"] == 0 and not append:
+        raise RuntimeError(f"No passages to index in {source}")
+    if append:
+        added = append_langchain_index(out_dir, staging.vectors(), staging.passages(), cfg) if s["rows"] else 0
+        print(f"✅ Appended {added} passages to {out_dir}")
+    else:
+        total = write_langchain_index(out_dir, staging.vectors(), staging.passages(), cfg)
+        print(f"✅ Wrote {total} passages to {out_dir}")
+    summary = {k: s[k] for k in ("mode", "rows_read", "rows", "duplicates", "dim")}
+    summary["embed_seconds"] = round(time.perf_counter() - t0, 2)
+    staging.remove()
+    return summary
+
+def delete_doc_ids(out_dir: str, doc_ids: Iterable[int]) -> int:
+    """Tombstone every live row holding one of `doc_ids`; returns the number of rows newly deleted."""
+    wanted = set(int(d) for d in doc_ids)
+    tombstones = set(load_tombstones(out_dir))
+    rows = {row for row, (_, doc_id) in enumerate(_existing_rows(out_dir)) if doc_id in wanted}
+    new = rows - tombstones
+    save_tombstones(out_dir, tombstones | rows)
+    print(f"🪦 Tombstoned {len(new)} rows ({len(tombstones | rows)} pending compaction) in {out_dir}")
+    return len(new)
+
+def _read_index(out_dir: str):
+    import faiss
+    return faiss.read_index(os.path.join(out_dir, "index.faiss"))
+
+def _rebuild_vectors(index):
+    if is_lossy(index):
+        print("⚠ index.faiss holds quantized codes; rebuilding from them loses accuracy. "
+              "A full build-index from passages.parquet is more faithful.")
+    return reconstruct_all(index)
+
+def compact(out_dir: str, cfg: Dict[str, Any], convert: bool = False) -> int:
+    """
+    Rewrite the index without tombstoned rows. The index keeps its own type (and IVF / PQ
+    build settings) unless `convert` asks for the configured INDEX_TYPE instead.
+    """
+    tombstones = load_tombstones(out_dir)
+    if not tombstones:
+        print("Nothing to compact.")
+        return 0
+    index = _read_index(out_dir)
+    existing = build_settings(index)
+    if not convert:
+        if existing["INDEX_TYPE"] != index_type(cfg):
+            print(f"  keeping the index's own type {existing['INDEX_TYPE']} (INDEX_TYPE is {index_type(cfg)}); "
+                  f"pass --index-type to convert while compacting")
+        cfg = {**cfg, **existing}
+    vectors = _rebuild_vectors(index)
+    del index
+    keep = np.ones(len(vectors), dtype=bool)
+    keep[sorted(tombstones)] = False
+    rows = (p for r, p in enumerate(_existing_rows(out_dir)) if r not in tombstones)
+    write_langchain_index(out_dir, vectors[keep], rows, cfg)
+    print(f"✅ Compacted {out_dir}: dropped {len(tombstones)} rows, {int(keep.sum())} remain")
+    return len(tombstones)
+
+def reindex(out_dir: str, cfg: Dict[str, Any]) -> Dict[str, Any]:
+    """Rebuild index.faiss as INDEX_TYPE; row order (and so index.pkl / the passage store) is unchanged."""
+    import faiss
+    from .ann import describe, memory_bytes
+
+    vectors = _rebuild_vectors(_read_index(out_dir))
+    t0 = time.perf_counter()
+    index = build_index(cfg, vectors)
+    tmp = os.path.join(out_dir, "index.faiss.tmp")
+    faiss.write_index(index, tmp)
+    os.replace(tmp, os.path.join(out_dir, "index.faiss"))
+    stamp_index(out_dir)
+    info = dict(describe(index), type=index_type(cfg), memory_mb=round(memory_bytes(index) / 2**20, 2),
+                build_s=round(time.perf_counter() - t0, 2))
+    print(f"✅ Rebuilt {out_dir}/index.faiss as {info['type']}: {info}")
+    return info
+
+def build_bm25_for(out_dir: str, cfg: Dict[str, Any]) -> int:
+    """(Re)build the BM25 postings over the rows already in `out_dir`."""
+    t0 = time.perf_counter()
+    n = build_bm25(out_dir, _existing_rows(out_dir), float(cfg.get("BM25_K1", 1.2)), float(cfg.get("BM25_B", 0.75)))
+    print(f"✅ BM25 index over {n} passages written to {out_dir} in {time.perf_counter() - t0:.1f}s")
+    return n
+
+def build_sentences_for(out_dir: str) -> int:
+    """(Re)build the sentence splits and cue scores over the rows already in `out_dir`."""
+    t0 = time.perf_counter()
+    n = build_sentence_index(out_dir, _existing_rows(out_dir))
+    print(f"✅ Sentence index over {n} passages written to {out_dir} in {time.perf_counter() - t0:.1f}s")
+    return n
+
+def _read_ids(args) -> List[int]:
+    ids = [int(x) for x in (args.delete or [])]
+    if args.delete_file:
+        with open(args.delete_file, "r", encoding="utf-8") as f:
+            ids.extend(int(line) for line in f if line.strip())
+    return ids
+
+def run_build_index(args) -> Dict[str, Any]:
+    from .config import load_config
+    from .index_versions import set_current, version_dir
+    from .retriever import faiss_dir_for, faiss_root_for
+
+    cfg = load_config(os.getenv("CONFIG_PATH", "./config.json"))
+    if args.index_type:
+        cfg["INDEX_TYPE"] = args.index_type
+    index_type(cfg)
+    if args.new_version:
+        if args.append or args.delete or args.delete_file or args.compact or args.bm25 or args.sentences \
+                or args.reindex:
+            raise SystemExit("--new-version makes a full build into a fresh folder; it cannot be combined "
+                             "with --append / --delete / --compact / --bm25 / --sentences / --reindex")
+        out_dir = version_dir(faiss_root_for(cfg), args.new_version)
+        result = build(cfg, args.source, out_dir, append=False, workers=args.workers,
+                       batch_rows=args.batch_rows, embed_batch=args.embed_batch,
+                       text_column=args.text_column, id_column=args.id_column, restart=args.restart)
+        if args.activate:
+            set_current(faiss_root_for(cfg), args.new_version)
+            print(f"✅ CURRENT -> {args.new_version}; POST /reload to serve it")
+        return result
+    if args.activate:
+        raise SystemExit("--activate needs --new-version (use POST /reload with a version to switch otherwise)")
+    out_dir = args.out_dir or faiss_dir_for(cfg)
+    if args.delete or args.delete_file:
+        return {"deleted": delete_doc_ids(out_dir, _read_ids(args))}
+    if args.bm25:
+        return {"bm25_rows": build_bm25_for(out_dir, cfg)}
+    if args.sentences:
+        return {"sentence_rows": build_sentences_for(out_dir)}
+    if args.compact:
+        return {"compacted": compact(out_dir, cfg, convert=bool(args.index_type))}
+    if args.reindex:
+        return reindex(out_dir, cfg)
+    return build(cfg, args.source, out_dir, append=args.append, workers=args.workers,
+                 batch_rows=args.batch_rows, embed_batch=args.embed_batch,
+                 text_column=args.text_column, id_column=args.id_column, restart=args.restart)
+
+def add_arguments(p) -> None:
+    p.add_argument("--source", default=os.path.join(_DATA_DIR, "passages.parquet"),
+                   help="passages parquet (default: data/passages.parquet)")
+    p.add_argument("--out-dir", default=None, help="index folder (default: the active FAISS_DIR version)")
+    p.add_argument("--new-version", default=None, metavar="NAME",
+                   help="full build into FAISS_DIR/versions/NAME, leaving the served version untouched")
+    p.add_argument("--activate", action="store_true", help="with --new-version: point CURRENT at it when done")
+    p.add_argument("--append", action="store_true", help="add new passages to the existing index")
+    p.add_argument("--delete", nargs="+", metavar="DOC_ID", help="tombstone passages with these doc_ids")
+    p.add_argument("--delete-file", default=None, help="file of doc_ids to tombstone, one per line")
+    p.add_argument("--compact", action="store_true", help="drop tombstoned rows and rewrite the index")
+    p.add_argument("--bm25", action="store_true", help="(re)build only the BM25 index for hybrid retrieval")
+    p.add_argument("--sentences", action="store_true",
+                   help="(re)build only the precomputed sentence splits / intent cue scores")
+    p.add_argument("--reindex", action="store_true", help="convert the existing index to INDEX_TYPE without re-embedding")
+    p.add_argument("--index-type", default=None, help="override INDEX_TYPE (flat | hnsw | ivf-flat | ivf-pq | sq8)")
+    p.add_argument("--workers", type=int, default=max(1, min(4, (os.cpu_count() or 2) // 2)),
+                   help="parallel embedding workers")
+    p.add_argument("--batch-rows", type=int, default=2048, help="parquet rows per batch / checkpoint")
+    p.add_argument("--embed-batch", type=int, default=64, help="texts per embed_documents call")
+    p.add_argument("--text-column", default="passage")
+    p.add_argument("--id-column", default="id")
+    p.add_argument("--restart", action="store_true", help="discard a staged, unfinished build")
@@ -1,5 +1,7 @@
-import re
-from typing import List
+import hashlib, json, re
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
 
 FALLBACK_LINE = "I'm sorry, I cannot answer that question based on the provided information."
 
@@ -12,23 +14,87 @@ INTENT_PATTERNS = {
     "definition":re.compile(r"\b(what is|define|definition)\b", re.I),
 }
 
+class IntentMatcher:
+    """
+    Every pattern of several intents compiled into one lookahead alternation, so a text is
+    scanned once whatever the number of patterns. Each match reports the first pattern (in
+    priority order) matching at that position; the later ones are re-checked there only.
+    """
+
+    def __init__(self, patterns: Sequence[Tuple[str, str]], flags: int = re.I):
+        self.labels = [label for label, _ in patterns]
+        self.intents = tuple(dict.fromkeys(self.labels))
+        self._column = [self.intents.index(label) for label in self.labels]
+        self._single = [re.compile(p, flags) for _, p in patterns]
+        # a leading \b shared by every pattern is tested once per position instead of once per pattern
+        lead = r"\b" if patterns and all(p.startswith(r"\b") for _, p in patterns) else ""
+        alts = "|".join(f"(?P<p{i}>{p[len(lead):]})" for i, (_, p) in enumerate(patterns))
+        self._combined = re.compile(f"{lead}(?={alts})", flags) if patterns else None
+
+    def matches(self, text: str) -> List[bool]:
+        """Whether each pattern occurs anywhere in `text`."""
+        n = len(self._single)
+        found = [False] * n
+        if self._combined is None:
+            return found
+        left = n
+        for m in self._combined.finditer(text):
+            i, pos = int(m.lastgroup[1:]), m.start()
+            if not found[i]:
+                found[i] = True
+                left -= 1
+            for j in range(i + 1, n):
+                if not found[j] and self._single[j].match(text, pos):
+                    found[j] = True
+                    left -= 1
+            if not left:
+                break
+        return found
+
+    def first(self, text: str) -> Optional[str]:
+        """Label of the highest-priority pattern occurring in `text`."""
+        if self._combined is None:
+            return None
+        best = len(self._single)
+        for m in self._combined.finditer(text):
+            best = min(best, int(m.lastgroup[1:]))
+            if best == 0:
+                break
+        return self.labels[best] if best < len(self._single) else None
+
+    def scores(self, text: str) -> Tuple[int, ...]:
+        """Number of distinct patterns of each intent (in `intents` order) occurring in `text`."""
+        out = [0] * len(self.intents)
+        for col, hit in zip(self._column, self.matches(text)):
+            out[col] += hit
+        return tuple(out)
+
+INTENT_MATCHER = IntentMatcher([(intent, pat.pattern) for intent, pat in INTENT_PATTERNS.items()])
+
+# substring fallbacks when no pattern matched, in the same priority order
+_INTENT_KEYWORDS = [
+    ("causes", ["cause", "etiology", "why"]),
+    ("symptoms", ["symptom", "sign", "presentation"]),
+    ("treatments", ["treat", "therapy", "manage", "medicat"]),
+    ("risks", ["risk", "predispos"]),
+    ("mechanisms", ["mechanism", "how does it work", "pathophys"]),
+]
+
 def detect_question_intent(question: str) -> str:
     q = question.lower()
-    for intent, pat in INTENT_PATTERNS.items():
-        if pat.search(q): return intent
-    if any(w in q for w in ["cause","etiology","why"]): return "causes"
-    if any(w in q for w in ["symptom","sign","presentation"]): return "symptoms"
-    if any(w in q for w in ["treat","therapy","manage","medicat"]): return "treatments"
-    if any(w in q for w in ["risk","predispos"]): return "risks"
-    if any(w in q for w in ["mechanism","how does it work","pathophys"]): return "mechanisms"
+    intent = INTENT_MATCHER.first(q)
+    if intent: return intent
+    # plain substring tests are already a C-level scan each; a regex would only be slower
+    for intent, words in _INTENT_KEYWORDS:
+        if any(w in q for w in words): return intent
     if q.startswith("what is") or q.startswith("define"): return "definition"
     return "general"
 
 _SENT_SPLIT = re.compile(r"(?<=[\.\?\!])\s+")
+_WHITESPACE = re.compile(r"\s+")
 
 def split_sentences(text: str) -> List[str]:
-    import re as _re
-    text = _re.sub(r"\s+", " ", text).strip()
+    text = _WHITESPACE.sub(" ", text).strip()
     return [s.strip() for s in _SENT_SPLIT.split(text) if s.strip()]
 
 INTENT_CUE_SETS = {
@@ -41,23 +107,51 @@ INTENT_CUE_SETS = {
     "general": []
 }
 
+# intents with cues, in the column order of cue_scores() and the stored sentence cue matrix
+CUE_INTENTS = tuple(intent for intent, pats in INTENT_CUE_SETS.items() if pats)
+CUE_MATCHER = IntentMatcher([(intent, pat) for intent in CUE_INTENTS for pat in INTENT_CUE_SETS[intent]])
+# one intent's cues only, for filtering a context that has no stored scores
+_INTENT_CUE_MATCHERS = {intent: IntentMatcher([(intent, pat) for pat in INTENT_CUE_SETS[intent]]) for intent in CUE_INTENTS}
+
+def cue_scores(sentence: str) -> Tuple[int, ...]:
+    """Cue matches of every intent in CUE_INTENTS order, from one scan of the sentence."""
+    return CUE_MATCHER.scores(sentence)
+
+def cue_fingerprint() -> str:
+    """Changes whenever the sentence splitter or a cue set does, invalidating stored cue scores."""
+    spec = [_SENT_SPLIT.pattern, _WHITESPACE.pattern] + [[i, INTENT_CUE_SETS[i]] for i in CUE_INTENTS]
+    return hashlib.sha1(json.dumps(spec).encode()).hexdigest()[:12]
+
+class FilteredContext(NamedTuple):
+    """Context already ranked for its intent (from the stored sentence index); prompts use it as is."""
+    text: str
+    intent: str
+
+    def __str__(self) -> str:
+        return self.text
+
+def rank_order(lengths: np.ndarray, scores: Optional[np.ndarray], max_sents: int = 15) -> np.ndarray:
+    """
+    Indices of the sentences filter_context_for_intent keeps: those with cue hits (most hits,
+    then longest), the longest few when none has any, the longest ones for intents without cues.
+    Stable, so ties keep reading order.
+    """
+    if scores is None:
+        return np.argsort(-lengths, kind="stable")[:max_sents]
+    hit = np.flatnonzero(scores > 0)
+    if not len(hit):
+        return np.argsort(-lengths, kind="stable")[:min(max_sents, 8)]
+    return hit[np.lexsort((-lengths[hit], -scores[hit]))][:max_sents]
+
 def filter_context_for_intent(context: str, intent: str, max_sents: int = 15) -> str:
     sents = split_sentences(context)
     if not sents: return ""
-    cues = INTENT_CUE_SETS.get(intent, [])
-    if not cues:
-        ranked = sorted(sents, key=len, reverse=True)[:max_sents]
-        return " ".join(ranked)
-    compiled = [re.compile(pat, re.I) for pat in cues]
-    scored = []
-    for s in sents:
-        score = sum(1 for pat in compiled if pat.search(s))
-        if score > 0: scored.append((score, len(s), s))
-    if not scored:
-        ranked = sorted(sents, key=len, reverse=True)[:min(max_sents, 8)]
-        return " ".join(ranked)
-    ranked = sorted(scored, key=lambda x: (-x[0], -x[1]))[:max_sents]
-    return " ".join(s for _, __, s in ranked)
+    lengths = np.fromiter(map(len, sents), dtype=np.int64, count=len(sents))
+    matcher = _INTENT_CUE_MATCHERS.get(intent)
+    scores = None
+    if matcher is not None:
+        scores = np.fromiter((matcher.scores(s)[0] for s in sents), dtype=np.int64, count=len(sents))
+    return " ".join(sents[i] for i in rank_order(lengths, scores, max_sents))
 
 INTENT_TEMPLATES = {
     "causes": """You are a biomedical expert.
@@ -1,12 +1,31 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
 from typing import Optional
-import os
-import torch
-from flask import Flask, jsonify, request, send_from_directory
+import json, os, threading, time
+from flask import Flask, Response, jsonify, request, send_from_directory, stream_with_context
 from flask_cors import CORS
 
 from .config import load_config
-from .retriever import load_embedder, load_faiss, retrieve_top_k
-from .gemma import load_gemma, build_rewriter, rewrite_query, answer_with_gemma
+from .retriever import (
+    load_embedder,
+    load_embedder_from_dir,
+    load_faiss,
+    load_fast_index,
+    retrieve_batch,
+    retrieve_by_vector,
+    retrieve_top_k,
+    retrieve_top_k_scored,
+    index_version,
+    faiss_dir_for,
+    faiss_root_for,
+)
+from .index_versions import IndexHandle, IndexRegistry, list_versions, set_current, versions_root
+from .rewriter import QueryRewriter
+from .intent import detect_question_intent
+from .cache import PipelineCache
+from .scheduler import BatchScheduler
+from . import metrics
+from .metrics import span
 
 # -----------------------------
 # Flask app (serves UI + API)
@@ -24,6 +43,8 @@ def index():
 # -----------------------------
 CFG = load_config(os.getenv("CONFIG_PATH", "./config.json"))
 
+metrics.configure(CFG.get("METRICS_ENABLED", True))
+
 # Optional: keep transformers offline after first download
 if CFG.get("TRANSFORMERS_OFFLINE", False):
     os.environ["TRANSFORMERS_OFFLINE"] = "1"
@@ -31,12 +52,32 @@ if CFG.get("TRANSFORMERS_OFFLINE", False):
 tokenizer = None
 model = None
 gen_pipeline = None
-vector_db = None
+rewriter: Optional[QueryRewriter] = None
+vector_db = None  # the active version's store; requests read it through pin_index() / active_db()
+indexes = IndexRegistry()
+_pinned: ContextVar[Optional[IndexHandle]] = ContextVar("pinned_index", default=None)
+_reload_lock = threading.Lock()
+reload_state = {"state": "idle"}
+scheduler: Optional[BatchScheduler] = None
+context_builder = None
+prefix_cache = None
+cpu_info = None
+decoder = None
+embedding_service = None
+reranker = None  # app.rerank.Reranker when RERANK_ENABLED
+worker_info = None  # {"worker", "pid", "cores"} in a pre-forked worker (app.workers)
+_started = False
+cache: Optional[PipelineCache] = PipelineCache(CFG) if CFG.get("CACHE_ENABLED", True) else None
+
+# per-component readiness, reported on /health: pending -> loading -> ready | error
+_components_lock = threading.Lock()
+components = {name: {"state": "pending"} for name in ("embedder", "index", "model")}
 
 # -----------------------------
 # Device helpers
 # -----------------------------
 def device_kind() -> str:
+    import torch
     if torch.cuda.is_available():
         return "cuda"
     # Apple Silicon Metal (MPS)
@@ -50,6 +91,7 @@ def move_model_to_device(m, dev: str):
     for memory/perf; keep float32 on CPU. MPS generally works best with float32/16
     depending on the model—here we keep default dtype for safety.
     """
+    import torch
     try:
         if dev == "cuda":
             # Prefer bfloat16 if supported (Ampere+), else float16
@@ -76,91 +118,830 @@ def move_model_to_device(m, dev: str):
 # -----------------------------
 # Startup
 # -----------------------------
-def startup():
-    """Load all required models and indexes into memory."""
-    global tokenizer, model, gen_pipeline, vector_db
+def _set_component(name: str, state: str, error: Optional[str] = None) -> None:
+    with _components_lock:
+        entry = components[name]
+        if state == "loading":
+            entry["started"] = time.time()
+        elif "started" in entry:
+            entry["seconds"] = round(time.time() - entry.pop("started"), 2)
+        entry["state"] = state
+        if error:
+            entry["error"] = error
+
+def is_ready() -> bool:
+    with _components_lock:
+        return all(c["state"] == "ready" for c in components.values())
+
+def _fast_start() -> bool:
+    return bool(CFG.get("FAST_START", False))
+
+def _mmap_index() -> bool:
+    # pre-forked workers share one page-cache copy of the mmap'd index instead of N heap copies
+    return _fast_start() or int(CFG.get("WORKERS", 0)) > 0
+
+def _open_vector_store(embedder, faiss_dir: Optional[str] = None):
+    """Memory-mapped native index + columnar passages in fast-start / worker-pool mode, load_faiss otherwise."""
+    if _mmap_index():
+        try:
+            return load_fast_index(CFG, embedder, faiss_dir)
+        except (RuntimeError, ValueError, OSError) as e:
+            print(f"⚠ Fast index unavailable ({e}); falling back to the LangChain store.")
+    return load_faiss(CFG, embedder, faiss_dir)
+
+def _wrap_embedder(embedder):
+    """The embedding service (micro-batching, LRU, optional ONNX) or the plain cached embedder."""
+    global embedding_service
+    if CFG.get("EMBED_SERVICE_ENABLED", True):
+        from .embedding import load_embedding_service
+        embedding_service = load_embedding_service(CFG, embedder, cache.embeddings if cache is not None else None)
+        return embedding_service
+    return cache.wrap_embedder(embedder) if cache is not None else embedder
+
+def _verify_embedder(vs) -> None:
+    """
+    EMBED_VERIFY_ON_LOAD: one encode of EMBED_VERIFY_SAMPLES passages per load. In worker mode it
+    runs in the supervisor, before fork, under its one-thread torch limit (app.workers).
+    """
+    samples = int(CFG.get("EMBED_VERIFY_SAMPLES", 16))
+    if embedding_service is not None and CFG.get("EMBED_VERIFY_ON_LOAD", True) and samples > 0:
+        embedding_service.verify(vs, samples, float(CFG.get("EMBED_VERIFY_MIN_COSINE", 0.99)))
+
+def _install(handle: IndexHandle, record: bool = True) -> Optional[IndexHandle]:
+    global vector_db
+    old = indexes.swap(handle, record=record)
+    vector_db = handle.vs
+    return old
 
+def _load_retrieval() -> None:
     print("🔄 Loading embedder and FAISS index...")
-    embedder = load_embedder(CFG)
-    vector_db = load_faiss(CFG, embedder)
+    _set_component("embedder", "loading")
+    embedder = load_embedder_from_dir(CFG) if _fast_start() else load_embedder(CFG)
+    faiss_dir = faiss_dir_for(CFG)
+    version = index_version(CFG, faiss_dir)
+    if cache is not None:
+        cache.set_index_version(version)
+    embedder = _wrap_embedder(embedder)
+    if _fast_start():
+        embedder.embed_query("warmup")  # first call pays tokenizer/graph init
+    _set_component("embedder", "ready")
+
+    _set_component("index", "loading")
+    vs = _open_vector_store(embedder, faiss_dir)
+    _verify_embedder(vs)
+    _install(IndexHandle(vs, version, faiss_dir))
+    _load_reranker()
+    _set_component("index", "ready")
+
+def _load_reranker() -> None:
+    global reranker
+    if not CFG.get("RERANK_ENABLED", False):
+        return
+    from .rerank import load_reranker
+    print("🔄 Loading cross-encoder reranker...")
+    try:
+        reranker = load_reranker(CFG)
+        print(f"✅ Reranker: {reranker.backend}, {reranker.fetch_k} candidates -> top {reranker.top_n}")
+    except Exception as e:
+        print(f"⚠ Reranker unavailable ({e}); passages stay in retrieval order.")
+
+def _load_generation() -> None:
+    global tokenizer, model, gen_pipeline, rewriter, scheduler, context_builder, prefix_cache, cpu_info, decoder
+    from .decoding import load_decoder
+    from .gemma import load_gemma, build_rewriter
 
     print("🔄 Loading Gemma model...")
+    _set_component("model", "loading")
     tokenizer, model = load_gemma(CFG["MODEL_DIR"])
 
     # Move to best device
     dev = device_kind()
     model = move_model_to_device(model, dev)
     print(f"✅ Model device: {model.device}")
+    if dev == "cpu":
+        from .cpu_backend import prepare_cpu_model
+        model, cpu_info = prepare_cpu_model(model, tokenizer, CFG)
+        print(f"✅ CPU backend: {cpu_info['backend']} ({cpu_info['threads']} threads, RSS {cpu_info['rss_mb']} MB)")
+
+    decoder = load_decoder(CFG, dev, lambda m: move_model_to_device(m, dev))
 
-    if CFG.get("USE_REWRITER", True):
-        print("🔄 Building rewriter pipeline...")
+    rewriter_mode = str(CFG.get("REWRITER_MODE", "llm")).lower()
+    if CFG.get("USE_REWRITER", True) and rewriter_mode in ("llm", "llm-greedy"):
+        print(f"🔄 Building rewriter pipeline ({rewriter_mode})...")
         # build_rewriter internally sets device index (cuda:0 => 0, else -1)
-        gen_pipeline = build_rewriter(tokenizer, model, max_new_tokens=128)
+        if rewriter_mode == "llm-greedy":
+            gen_pipeline = build_rewriter(
+                tokenizer, model,
+                max_new_tokens=int(CFG.get("REWRITER_GREEDY_MAX_NEW_TOKENS", 48)),
+                num_beams=1,
+            )
+        else:
+            gen_pipeline = build_rewriter(tokenizer, model, max_new_tokens=128)
     else:
         gen_pipeline = None
+    rewriter = QueryRewriter(CFG, gen_pipeline)
+
+    if int(CFG.get("CONTEXT_TOKEN_BUDGET", 0)) > 0:
+        from .context import ContextBuilder
+        context_builder = ContextBuilder(CFG, tokenizer)
+
+    if CFG.get("PREFIX_CACHE_ENABLED", True):
+        from .prefix_cache import PrefixCache
+        prefix_cache = PrefixCache(model, tokenizer, CFG).warm()
+        print(f"✅ Prefix KV-cache: {len(prefix_cache.entries)} template heads, {prefix_cache.bytes / 2**20:.1f} MB")
+
+    if CFG.get("USE_BATCHING", True):
+        print("🔄 Starting generation batch scheduler...")
+        scheduler = _start_scheduler()
+
+    if _fast_start():
+        import torch
+        with torch.no_grad():
+            # one-token generate so the first real request doesn't pay for lazy kernel init
+            warm = tokenizer(["warmup"], return_tensors="pt").to(model.device)
+            model.generate(**warm, max_new_tokens=1, pad_token_id=tokenizer.eos_token_id)
+    _set_component("model", "ready")
+
+def _start_scheduler() -> BatchScheduler:
+    return BatchScheduler(
+        generate_batch,
+        max_batch_size=int(CFG.get("BATCH_MAX_SIZE", 8)),
+        max_wait_ms=float(CFG.get("BATCH_MAX_WAIT_MS", 20)),
+    ).start()
+
+def _warm(loader, owned) -> None:
+    try:
+        loader()
+    except Exception as e:
+        print(f"❌ Warm-up failed: {e}")
+        for name in owned:
+            if components[name]["state"] != "ready":
+                _set_component(name, "error", str(e))
 
+def startup(load_model: bool = True, background: Optional[bool] = None):
+    """
+    Load all required models and indexes into memory.
+    With FAST_START the loaders run in background threads and this returns at once,
+    so the port opens immediately and /health reports each component as it warms.
+    Offline jobs pass background=False to block until loaded, and load_model=False
+    to skip Gemma entirely (the rewriter then runs without an LLM).
+    Later calls are no-ops, so pre-forked workers keep what the supervisor loaded.
+    """
+    global rewriter, _started
+    if _started:
+        return
+    _started = True
+    if _fast_start() if background is None else background:
+        print("🚀 Fast start: warming components in the background...")
+        threading.Thread(target=_warm, args=(_load_retrieval, ("embedder", "index")),
+                         name="warm-retrieval", daemon=True).start()
+        if load_model:
+            threading.Thread(target=_warm, args=(_load_generation, ("model",)),
+                             name="warm-generation", daemon=True).start()
+        return
+
+    _load_retrieval()
+    if load_model:
+        _load_generation()
+    else:
+        rewriter = QueryRewriter(CFG, None)
     print("✅ Startup complete.")
 
+def prepare_fork() -> None:
+    """
+    Stop this process's helper threads before app.workers forks from it: a child only
+    inherits the forking thread, so each worker starts its own in after_fork().
+    """
+    if scheduler is not None:
+        scheduler.stop()
+    from .retriever import shutdown_pool
+    shutdown_pool()
+
+def after_fork(info, threads: int = 0) -> None:
+    """
+    Per-worker setup after fork: torch threads for its core set, a fresh SQLite handle and
+    batch scheduler, and the active index version if a reload happened since the supervisor
+    loaded (a recycled worker must not come back on the old one).
+    """
+    global scheduler, worker_info
+    worker_info = info
+    if threads:
+        # the supervisor loaded with one torch thread; the embedder and reranker run on CPU either way
+        from .cpu_backend import tune_threads
+        tuned = tune_threads({**CFG, "CPU_THREADS": threads})
+        if cpu_info is not None:
+            cpu_info.update(tuned)
+    if cache is not None:
+        cache.after_fork()
+    if scheduler is not None:
+        scheduler = _start_scheduler()
+    current = indexes.current
+    if current is not None and index_version(CFG, faiss_dir_for(CFG)) != current.version:
+        reload_vector_db()
+
 # -----------------------------
-# Routes
+# Pipeline stages (shared by the Flask routes and app.asgi)
 # -----------------------------
-@app.route("/health", methods=["GET"])
-def health():
-    size = None
+def health_payload():
+    size = index_info = None
+    root = faiss_root_for(CFG)
     try:
         size = int(getattr(vector_db.index, "ntotal", 0))
+        from .ann import describe
+        index_info = describe(vector_db.index)
     except Exception:
         pass
-    return jsonify({
-        "status": "ok",
+    with _components_lock:
+        component_states = {name: dict(c) for name, c in components.items()}
+    states = {c["state"] for c in component_states.values()}
+    return {
+        "status": "ok" if states == {"ready"} else ("error" if "error" in states else "starting"),
+        "ready": states == {"ready"},
+        "components": component_states,
+        "fast_start": _fast_start(),
+        "worker": worker_info,
         "model_dir": CFG.get("MODEL_DIR"),
         "faiss_dir": CFG.get("FAISS_DIR"),
-        "use_rewriter": bool(CFG.get("USE_REWRITER", True)),
+        "use_rewriter": rewriter_enabled(),
+        "rewriter": rewriter.stats() if rewriter is not None else None,
         "top_k_default": int(CFG.get("TOP_K_DEFAULT", 5)),
         "index_size": size,
-        "device": str(model.device) if model is not None else "uninitialized"
-    })
+        "index": index_info,
+        "index_version": active_index_version(),
+        "index_versions": {**indexes.stats(), "available": list_versions(root), "reload": dict(reload_state)},
+        "embedding": embedding_service.stats() if embedding_service is not None else None,
+        "hybrid": vector_db.hybrid.stats() if getattr(vector_db, "hybrid", None) is not None else None,
+        "sentence_index": vector_db.sentences.stats() if getattr(vector_db, "sentences", None) is not None else None,
+        "rerank": reranker.stats() if reranker is not None else None,
+        "device": str(model.device) if model is not None else "uninitialized",
+        "cpu_backend": cpu_info,
+        "batching": scheduler.stats() if scheduler is not None else None,
+        "context": context_builder.stats() if context_builder is not None else None,
+        "prefix_cache": prefix_cache.stats() if prefix_cache is not None else None,
+        "decoding": decoder.stats() if decoder is not None else None,
+        "cache": cache.stats() if cache is not None else None
+    }
 
-@app.route("/ask", methods=["POST"])
-def ask():
-    data = request.get_json(force=True) or {}
+@contextmanager
+def pin_index():
+    """
+    Hold the active index version for the duration of a request. A concurrent reload swaps in
+    the new version for later requests; this one keeps reading the old store, which is only
+    released once every request pinning it has finished.
+    """
+    handle = _pinned.get()
+    if handle is not None:
+        yield handle
+        return
+    handle = indexes.acquire()
+    token = _pinned.set(handle)
+    try:
+        yield handle
+    finally:
+        _pinned.reset(token)
+        indexes.release(handle)
+
+def active_db():
+    handle = _pinned.get()
+    return handle.vs if handle is not None else vector_db
+
+def active_index_version() -> Optional[str]:
+    handle = _pinned.get() or indexes.current
+    return handle.version if handle is not None else None
+
+def _serving_current() -> bool:
+    """False while a request pinned to a retired version finishes; its results must not be cached."""
+    handle = _pinned.get()
+    return handle is None or handle is indexes.current
+
+def _persist_current(faiss_dir: str) -> None:
+    """Record the served version in CURRENT so a restart comes back on it."""
+    root = faiss_root_for(CFG)
+    if os.path.normpath(os.path.dirname(faiss_dir)) == os.path.normpath(versions_root(root)):
+        set_current(root, os.path.basename(faiss_dir))
+    elif os.path.normpath(faiss_dir) == os.path.normpath(root):
+        set_current(root, None)
+
+def reload_vector_db(version: Optional[str] = None, rollback: bool = False):
+    """
+    Load `version` (FAISS_DIR/versions/<version>; CURRENT, or FAISS_DIR itself, when None) or,
+    with rollback, the previously active version, next to the one being served. The active
+    embedder is reused, the new store is warmed with one query, then swapped in atomically.
+    Returns {"version", "previous", "index_size"}.
+    """
+    if not _reload_lock.acquire(blocking=False):
+        raise RuntimeError("A reload is already in progress")
+    try:
+        if rollback:
+            prev = indexes.previous()
+            if prev is None:
+                raise ValueError("No previous index version to roll back to")
+            label, faiss_dir = prev
+        else:
+            faiss_dir = faiss_dir_for(CFG, version)
+            if not os.path.exists(os.path.join(faiss_dir, "index.faiss")):
+                raise ValueError(f"No index.faiss in {faiss_dir}")
+            label = index_version(CFG, faiss_dir)
+        reload_state.clear()
+        reload_state.update(state="loading", target=label, started=time.time())
+
+        current = indexes.current
+        if current is not None:
+            embedder = current.vs.embedding_function
+        else:
+            embedder = _wrap_embedder(load_embedder_from_dir(CFG) if _fast_start() else load_embedder(CFG))
+        t0 = time.perf_counter()
+        new_db = _open_vector_store(embedder, faiss_dir)
+        _verify_embedder(new_db)
+        retrieve_top_k(new_db, "warmup", k=1)  # page in the index and passage store before traffic arrives
+        load_s = round(time.perf_counter() - t0, 2)
+
+        if rollback:
+            indexes.pop_previous()
+        old = _install(IndexHandle(new_db, label, faiss_dir), record=not rollback)
+        if version is not None or rollback:
+            _persist_current(faiss_dir)
+        if cache is not None:
+            # every cached answer/hit/embedding was computed against the old store
+            cache.set_index_version(label, force=True)
+        reload_state.clear()
+        reload_state.update(state="idle", last=label, load_s=load_s, finished=time.time())
+        return {"version": label, "previous": old.version if old is not None else None,
+                "index_size": int(getattr(new_db.index, "ntotal", 0))}
+    except Exception as e:
+        reload_state.clear()
+        reload_state.update(state="error", error=str(e), finished=time.time())
+        raise
+    finally:
+        _reload_lock.release()
+
+def reload_in_background(version: Optional[str] = None, rollback: bool = False) -> None:
+    """reload_vector_db on a worker thread; progress and errors are reported on /health."""
+    def _run():
+        try:
+            reload_vector_db(version, rollback)
+        except Exception as e:
+            print(f"❌ Index reload failed: {e}")
+    if _reload_lock.locked():
+        raise RuntimeError("A reload is already in progress")
+    threading.Thread(target=_run, name="index-reload", daemon=True).start()
+
+def parse_reload_request(data):
+    """Validate a /reload payload; returns (version, async) or raises ValueError."""
+    version = data.get("version") if isinstance(data, dict) else None
+    if version is not None and not isinstance(version, str):
+        raise ValueError("'version' must be a string")
+    run_async = str(data.get("async", "")).lower() in {"1", "true", "yes", "on"} if isinstance(data, dict) else False
+    return version, run_async
+
+def rewriter_enabled() -> bool:
+    return rewriter is not None and rewriter.enabled
+
+def rewrite_stage(question: str, preferred_option: str = "Option 2") -> str:
+    if not rewriter_enabled():
+        return question
+    with span("rewrite"):
+        return rewriter.rewrite(question, preferred_option)
+
+def probe_stage(question: str, k: int):
+    """
+    REWRITE_POLICY=on_low_score: retrieve with the raw question first and return (hits, ctx)
+    when the best hit is relevant enough to skip rewriting; None means "rewrite, then search".
+    """
+    if not rewriter_enabled() or rewriter.policy != "on_low_score":
+        return None
+    with span("probe"):
+        hits, scores = retrieve_top_k_scored(active_db(), question, k=k)
+    if rewriter.should_rewrite(max(scores) if scores else None):
+        return None
+    return hits, "\n".join(h.get("passage", str(h)) for h in hits)
+
+def search_stage(rewritten: str, k: int):
+    """Embed + FAISS search; returns (hits, ctx)."""
+    db = active_db()
+    hits = cache.get_hits(rewritten, k) if cache is not None else None
+    if hits is None:
+        if getattr(db, "hybrid", None) is not None:
+            # dense (embed + FAISS) and BM25 run concurrently inside; recorded as dense_search / bm25_search
+            with span("search"):
+                hits = retrieve_top_k(db, rewritten, k=k)
+        else:
+            with span("embed"):
+                vec = db.embedding_function.embed_query(rewritten)
+            with span("search"):
+                hits = retrieve_by_vector(db, vec, k=k)
+        if cache is not None and _serving_current():
+            cache.put_hits(rewritten, k, hits)
+    # Expect hits as list of dicts containing 'passage'—adjust if your retriever returns docs
+    ctx = "\n".join(h.get("passage", str(h)) for h in hits)
+    return hits, ctx
+
+def rerank_fetch_k(k: int) -> int:
+    """Candidates to retrieve for a request of k passages: RERANK_FETCH_K when reranking is on."""
+    return reranker.fetch(k) if reranker is not None else k
+
+def rerank_stage(question: str, hits, ctx, k: int):
+    """
+    Cross-encoder rerank of the over-fetched hits against the user's question, keeping the
+    best few; past RERANK_BUDGET_MS they stay in retrieval order. Returns (hits, ctx).
+    """
+    if reranker is None:
+        return hits, ctx
+    with span("rerank"):
+        hits, fell_back = reranker.rerank(question, hits, k)
+    metrics.count("rag_rerank_total", outcome="fallback" if fell_back else "ok")
+    return hits, "\n".join(h.get("passage", str(h)) for h in hits)
+
+def context_stage(question: str, hits, ctx):
+    """
+    With CONTEXT_TOKEN_BUDGET > 0 and a tokenizer loaded, replace the joined passages with a
+    deduplicated, relevance-ranked BudgetedContext that fits the budget. Otherwise, when the
+    index has a sentence index, the intent filter runs on its stored splits and cue scores and a
+    FilteredContext is returned; ctx is returned as is (and filtered at prompt time) without one.
+    """
+    if context_builder is not None and context_builder.enabled:
+        with span("context_build"):
+            return context_builder.build(question, hits)
+    sentences = getattr(active_db(), "sentences", None)
+    if sentences is None:
+        return ctx
+    with span("context_filter"):
+        filtered = sentences.filter(hits, detect_question_intent(question))
+    return filtered if filtered is not None else ctx
+
+def retrieve_context(question: str, k: int, preferred_option: str = "Option 2"):
+    """Rewrite (if enabled), retrieve and rerank (if enabled); returns (rewritten, hits, ctx)."""
+    fetch = rerank_fetch_k(k)
+    probed = probe_stage(question, fetch)
+    if probed is not None:
+        rewritten, (hits, ctx) = question, probed
+    else:
+        rewritten = rewrite_stage(question, preferred_option)
+        hits, ctx = search_stage(rewritten, fetch)
+    hits, ctx = rerank_stage(question, hits, ctx, k)
+    return rewritten, hits, context_stage(question, hits, ctx)
+
+def retrieve_batch_stage(questions, k: int, preferred_option: str = "Option 2"):
+    """
+    retrieve_context for many questions at once: every query that needs embedding goes
+    through one embed_documents call and one index.search over the query matrix.
+    Under REWRITE_POLICY=on_low_score the raw questions are probed the same way first, and
+    with reranking on, the candidates of all questions are scored in shared batches.
+    Returns [(rewritten, hits, ctx)] in input order.
+    """
+    db = active_db()
+    fetch = rerank_fetch_k(k)
+    n = len(questions)
+    out = [None] * n
+    todo = list(range(n))
+    if rewriter_enabled() and rewriter.policy == "on_low_score":
+        with span("batch_probe"):
+            vecs = db.embedding_function.embed_documents(list(questions))
+            hits, scores = retrieve_batch(db, vecs, fetch, queries=list(questions))
+        todo = []
+        for i in range(n):
+            if rewriter.should_rewrite(max(scores[i]) if scores[i] else None):
+                todo.append(i)
+            else:
+                out[i] = (questions[i], hits[i])
+    rewritten = {i: rewrite_stage(questions[i], preferred_option) for i in todo}
+    misses = []
+    for i in todo:
+        cached = cache.get_hits(rewritten[i], fetch) if cache is not None else None
+        if cached is not None:
+            out[i] = (rewritten[i], cached)
+        else:
+            misses.append(i)
+    if misses:
+        with span("batch_embed"):
+            vecs = db.embedding_function.embed_documents([rewritten[i] for i in misses])
+        with span("batch_search"):
+            hits, _ = retrieve_batch(db, vecs, fetch, queries=[rewritten[i] for i in misses])
+        for i, h in zip(misses, hits):
+            out[i] = (rewritten[i], h)
+            if cache is not None and _serving_current():
+                cache.put_hits(rewritten[i], fetch, h)
+    if reranker is not None and n:
+        with span("batch_rerank"):
+            kept, fell_back = reranker.rerank_many(list(questions), [h for _, h in out], k)
+        metrics.count("rag_rerank_total", float(sum(fell_back)), outcome="fallback")
+        metrics.count("rag_rerank_total", float(n - sum(fell_back)), outcome="ok")
+        out = [(rw, h) for (rw, _), h in zip(out, kept)]
+    return [(rw, hits, context_stage(q, hits, "\n".join(h.get("passage", str(h)) for h in hits)))
+            for q, (rw, hits) in zip(questions, out)]
+
+def generate_batch(items):
+    """Scheduler/direct generation callback; returns one (answer, stats) pair per item."""
+    from .gemma import answer_batch_with_gemma
+    stats = []
+    answers = answer_batch_with_gemma(items, tokenizer, model, CFG, stats=stats, prefix_cache=prefix_cache,
+                                      decoder=decoder)
+    return list(zip(answers, stats))
+
+def generate_group(items):
+    """Run a caller-formed batch as one generate call; via the scheduler when it is running, so the model has one owner."""
+    if scheduler is not None:
+        return scheduler.submit_batch(items).result()
+    return generate_batch(items)
+
+def record_generation(stats) -> None:
+    """Attach per-request generation stats (measured in the generating thread) to the current trace."""
+    if not stats:
+        return
+    if "context_filter_ms" in stats:
+        metrics.record_stage("context_filter", stats["context_filter_ms"])
+    if "generate_ms" in stats:
+        metrics.record_stage("model_generate", stats["generate_ms"])
+    metrics.annotate(**{k: stats[k] for k in ("prompt_tokens", "generated_tokens", "tokens_per_second", "batch_size",
+                                              "prefix_cached_tokens", "accepted_tokens", "acceptance_rate")
+                        if k in stats})
+
+def generate_stage(question: str, ctx: str) -> str:
+    # "generate" includes queueing in the batch scheduler; "model_generate" is the forward passes alone
+    with span("generate"):
+        if scheduler is not None:
+            answer, stats = scheduler.submit(question, ctx)
+        else:
+            answer, stats = generate_batch([(question, ctx)])[0]
+    record_generation(stats)
+    return answer
+
+def stream_answer(question: str, ctx):
+    """stream_answer_with_gemma with the prefix cache; time to the first token is traced as `first_token`."""
+    from .gemma import stream_answer_with_gemma
+    t0 = time.perf_counter()
+    first = True
+    for kind, text in stream_answer_with_gemma(question, ctx, tokenizer, model, CFG, prefix_cache=prefix_cache,
+                                               decoder=decoder):
+        if first and kind == "token":
+            metrics.record_stage("first_token", (time.perf_counter() - t0) * 1000.0)
+            first = False
+        yield kind, text
+
+def parse_ask_request(data):
+    """Validate an /ask payload; returns (question, k, preferred_option) or raises ValueError."""
     question = (data.get("question") or "").strip()
     if not question:
-        return jsonify({"error": "Missing 'question'"}), 400
-
+        raise ValueError("Missing 'question'")
     k = int(data.get("k", CFG.get("TOP_K_DEFAULT", 5)))
     preferred_option = data.get("preferred_option", "Option 2")
+    return question, k, preferred_option
 
-    rewritten = rewrite_query(gen_pipeline, question, preferred_option=preferred_option) \
-        if CFG.get("USE_REWRITER", True) else question
+def not_ready_response():
+    """Body for 503s while FAST_START is still warming components."""
+    with _components_lock:
+        return {"error": "Service is warming up", "components": {n: c["state"] for n, c in components.items()}}
 
-    hits = retrieve_top_k(vector_db, rewritten, k=k)
-    # Expect hits as list of dicts containing 'passage'—adjust if your retriever returns docs
-    ctx = "\n".join(h.get("passage", str(h)) for h in hits)
+def wants_timings(data, args=None) -> bool:
+    """Inline per-stage timings are opt-in via {"timings": true} or ?timings=1."""
+    flag = data.get("timings", args.get("timings") if args is not None else None)
+    return str(flag).lower() in {"1", "true", "yes", "on"}
 
-    answer = answer_with_gemma(
-        question=question,
-        context=ctx,
-        tokenizer=tokenizer,
-        model=model,
-        gen_cfg=CFG
-    )
+def cached_answer(question: str, k: int, preferred_option: str):
+    if cache is None:
+        return None
+    with span("answer_cache"):
+        return cache.get_answer(question, k, preferred_option)
+
+def _doc_ids(hits):
+    return [int(h["doc_id"]) for h in hits if isinstance(h, dict) and h.get("doc_id") is not None]
 
-    return jsonify({
+def semantic_answers(questions, k: int, preferred_option: str, retrieved, version: Optional[str] = None):
+    """
+    With CACHE_SEMANTIC_ENABLED, the cached answer to a paraphrase of each question (embeddings
+    within CACHE_SEMANTIC_MIN_COSINE, retrieved doc_ids overlapping by CACHE_SEMANTIC_MIN_OVERLAP),
+    relabelled for this question and its own sources; None where there is none.
+    `retrieved` holds (rewritten, hits) per question. Returns (payloads, question vectors);
+    the vectors are handed back to remember_answer so an answer is never embedded twice. They
+    are computed (one embed call for the whole batch) even while the cache is still empty.
+    """
+    n = len(questions)
+    semantic = cache.semantic if cache is not None else None
+    if semantic is None or not n:
+        return [None] * n, [None] * n
+    version = version or active_index_version()
+    with span("semantic_cache"):
+        emb = active_db().embedding_function
+        vecs = [emb.embed_query(questions[0])] if n == 1 else emb.embed_documents(list(questions))
+        if not len(semantic):
+            return [None] * n, vecs
+        found = [semantic.get(vec, k, preferred_option, detect_question_intent(q), _doc_ids(hits), version)
+                 for q, vec, (_, hits) in zip(questions, vecs, retrieved)]
+    out = []
+    for q, hit, (rewritten, hits) in zip(questions, found, retrieved):
+        metrics.count("rag_semantic_cache_lookups_total", result="hit" if hit is not None else "miss")
+        if hit is None:
+            out.append(None)
+            continue
+        cached, match = hit
+        payload = {**ask_response(q, rewritten, cached["answer"], hits, version), "semantic_cache": match}
+        if _serving_current():
+            # the next identical question is an exact hit
+            cache.put_answer(q, k, preferred_option, payload)
+        out.append(payload)
+    return out, vecs
+
+def remember_answer(question: str, k: int, preferred_option: str, payload, vector=None) -> None:
+    if cache is None or not _serving_current():
+        return
+    cache.put_answer(question, k, preferred_option, payload)
+    if cache.semantic is not None:
+        if vector is None:
+            vector = active_db().embedding_function.embed_query(question)
+        cache.semantic.put(vector, k, preferred_option, detect_question_intent(question),
+                           _doc_ids(payload.get("sources") or []), payload.get("index_version") or active_index_version(),
+                           question, payload)
+
+def ask_response(question: str, rewritten: str, answer: str, hits, version: Optional[str] = None):
+    return {
         "question": question,
-        "rewritten": rewritten if CFG.get("USE_REWRITER", True) else None,
+        "rewritten": rewritten if rewriter_enabled() else None,
         "answer": answer,
-        "sources": hits
-    })
+        "sources": hits,
+        "index_version": version or active_index_version(),
+    }
+
+# -----------------------------
+# Routes
+# -----------------------------
+@app.route("/health", methods=["GET"])
+def health():
+    return jsonify(health_payload())
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/ask", methods=["POST"])
+def ask():
+    data = request.get_json(force=True) or {}
+    try:
+        question, k, preferred_option = parse_ask_request(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not is_ready():
+        return jsonify(not_ready_response()), 503
+
+    inline = wants_timings(data, request.args)
+    metrics.start_trace(inline=inline)
+    try:
+        payload = cached_answer(question, k, preferred_option)
+        outcome = "cached" if payload is not None else "ok"
+        if payload is None:
+            with pin_index():
+                rewritten, hits, ctx = retrieve_context(question, k, preferred_option)
+                (payload,), (vec,) = semantic_answers([question], k, preferred_option, [(rewritten, hits)])
+                if payload is not None:
+                    outcome = "semantic_cache"
+                else:
+                    answer = generate_stage(question, ctx)
+                    payload = ask_response(question, rewritten, answer, hits)
+                    remember_answer(question, k, preferred_option, payload, vec)
+    except Exception:
+        metrics.finish_request("ask", "error")
+        raise
+    timings = metrics.finish_request("ask", outcome)
+
+    if inline:
+        payload = {**payload, "timings": timings}
+    return jsonify(payload)
+
+def parse_batch_request(data):
+    """Validate an /ask/batch payload; returns (records, k, preferred_option) or raises ValueError."""
+    from .batch import records_from_payload
+    records = records_from_payload(data, int(CFG.get("ASK_BATCH_MAX_QUESTIONS", 1000)))
+    k = int((data.get("k") if isinstance(data, dict) else None) or CFG.get("TOP_K_DEFAULT", 5))
+    preferred_option = data.get("preferred_option", "Option 2") if isinstance(data, dict) else "Option 2"
+    return records, k, preferred_option
+
+def batch_lines(records, k: int, preferred_option: str, generate=None, retrieve=None):
+    """NDJSON lines for /ask/batch, one per answered question, as generation groups finish."""
+    from .batch import iter_answers
+    metrics.start_trace()
+    outcome = "ok"
+    try:
+        for result in iter_answers(records, k, preferred_option, int(CFG.get("ASK_BATCH_GEN_SIZE", 16)),
+                                   generate=generate, retrieve=retrieve):
+            yield json.dumps(result) + "\n"
+    except Exception as e:
+        outcome = "error"
+        yield json.dumps({"error": str(e)}) + "\n"
+    finally:
+        metrics.finish_request("ask_batch", outcome)
+
+@app.route("/ask/batch", methods=["POST"])
+def ask_batch():
+    """
+    Answer many questions in one call: {"questions": ["...", {"id": 7, "question": "..."}], "k": 5}.
+    Streams application/x-ndjson, one /ask-shaped object (plus "id") per question.
+    """
+    data = request.get_json(force=True, silent=True)
+    try:
+        records, k, preferred_option = parse_batch_request(data if data is not None else {})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not is_ready():
+        return jsonify(not_ready_response()), 503
+    return Response(stream_with_context(batch_lines(records, k, preferred_option)), mimetype="application/x-ndjson")
+
+def sse_event(event: str, payload) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+@app.route("/ask/stream", methods=["GET", "POST"])
+def ask_stream():
+    """
+    Server-Sent Events variant of /ask.
+    Emits `meta` (rewritten query + sources) once retrieval finishes, then one
+    `token` event per decoded chunk, then `done` with the final answer.
+    """
+    if request.method == "POST":
+        data = request.get_json(force=True, silent=True) or {}
+    else:
+        data = request.args
+    try:
+        question, k, preferred_option = parse_ask_request(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not is_ready():
+        return jsonify(not_ready_response()), 503
+
+    def events():
+        metrics.start_trace()
+        outcome = "ok"
+        try:
+            payload = cached_answer(question, k, preferred_option)
+            if payload is not None:
+                outcome = "cached"
+                yield sse_event("meta", {key: payload[key] for key in ("question", "rewritten", "sources")})
+                yield sse_event("done", {"answer": payload["answer"]})
+                return
+            with pin_index() as handle:
+                rewritten, hits, ctx = retrieve_context(question, k, preferred_option)
+                (payload,), (vec,) = semantic_answers([question], k, preferred_option, [(rewritten, hits)],
+                                                      handle.version)
+            version = handle.version
+            if payload is not None:
+                outcome = "semantic_cache"
+                yield sse_event("meta", {key: payload[key] for key in ("question", "rewritten", "sources",
+                                                                        "index_version", "semantic_cache")})
+                yield sse_event("done", {"answer": payload["answer"]})
+                return
+            yield sse_event("meta", {
+                "question": question,
+                "rewritten": rewritten if rewriter_enabled() else None,
+                "sources": hits,
+                "index_version": version,
+            })
+            for kind, text in stream_answer(question, ctx):
+                if kind == "token":
+                    yield sse_event("token", {"text": text})
+                else:
+                    # the pin was released before streaming; a swap since then retired this answer's version
+                    if handle is indexes.current:
+                        remember_answer(question, k, preferred_option,
+                                        ask_response(question, rewritten, text, hits, version), vec)
+                    yield sse_event("done", {"answer": text})
+        except Exception as e:
+            outcome = "error"
+            yield sse_event("error", {"error": str(e)})
+        finally:
+            metrics.finish_request("ask_stream", outcome)
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @app.route("/reload", methods=["POST"])
 def reload_index():
-    global vector_db
+    """
+    Load an index version and swap it in without dropping requests: {} reloads CURRENT,
+    {"version": "v2"} switches to FAISS_DIR/versions/v2; {"async": true} returns 202 at once.
+    """
+    data = request.get_json(force=True, silent=True) or {}
     try:
-        embedder = load_embedder(CFG)
-        vector_db = load_faiss(CFG, embedder)
-        size = int(getattr(vector_db.index, "ntotal", 0))
-        return jsonify({"status": "reloaded", "index_size": size})
+        version, run_async = parse_reload_request(data)
+        if run_async:
+            reload_in_background(version)
+            return jsonify({"status": "loading", "version": version}), 202
+        return jsonify({"status": "reloaded", **reload_vector_db(version)})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 409
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/reload/rollback", methods=["POST"])
+def rollback_index():
+    """Swap back to the previously active index version."""
+    try:
+        return jsonify({"status": "rolled_back", **reload_vector_db(rollback=True)})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 409
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -0,0 +1,234 @@
+"""
+Lightweight per-request tracing and Prometheus-style metrics.
+
+    trace = start_trace(inline=want_timings)   # once per request
+    with span("embed"):
+        ...
+    annotate(prompt_tokens=412, generated_tokens=57, batch_size=4)
+
+Spans feed histograms (rendered by render_prometheus() for /metrics) and, when a
+trace is active, are also collected so /ask can return them under `timings`.
+With METRICS_ENABLED=false and no inline trace requested, span() hands back a
+shared no-op context manager and annotate() returns immediately.
+"""
+import threading, time
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+_TOKEN_BUCKETS = (8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+_TPS_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+_BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+_enabled = True
+_current: ContextVar[Optional["Trace"]] = ContextVar("rag_trace", default=None)
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count", "_lock")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self.sum += value
+            self.count += 1
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    self.counts[i] += 1
+                    break
+
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        with self._lock:
+            cumulative, running = [], 0
+            for c in self.counts:
+                running += c
+                cumulative.append(running)
+            return cumulative, self.sum, self.count
+
+class Registry:
+    """Histograms and counters keyed by (metric name, sorted label pairs)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hist: Dict[str, Tuple[str, Sequence[float], Dict[Tuple, Histogram]]] = {}
+        self._counters: Dict[str, Tuple[str, Dict[Tuple, float]]] = {}
+
+    def histogram(self, name: str, help_text: str, buckets: Sequence[float]) -> None:
+        with self._lock:
+            self._hist.setdefault(name, (help_text, buckets, {}))
+
+    def counter(self, name: str, help_text: str) -> None:
+        with self._lock:
+            self._counters.setdefault(name, (help_text, {}))
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        _, buckets, series = self._hist[name]
+        key = tuple(sorted(labels.items()))
+        h = series.get(key)
+        if h is None:
+            with self._lock:
+                h = series.setdefault(key, Histogram(buckets))
+        h.observe(value)
+
+    def inc(self, name: str, amount: float = 1.0, **labels: str) -> None:
+        _, series = self._counters[name]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series[key] = series.get(key, 0.0) + amount
+
+    def render(self) -> str:
+        lines: List[str] = []
+        with self._lock:
+            hists = {n: (h, b, dict(s)) for n, (h, b, s) in self._hist.items()}
+            counters = {n: (h, dict(s)) for n, (h, s) in self._counters.items()}
+        for name, (help_text, buckets, series) in hists.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for key, h in sorted(series.items()):
+                cumulative, total, count = h.snapshot()
+                for upper, c in zip(buckets, cumulative):
+                    lines.append(f"{name}_bucket{_labels(key, le=_fmt(upper))} {c}")
+                lines.append(f"{name}_bucket{_labels(key, le='+Inf')} {count}")
+                lines.append(f"{name}_sum{_labels(key)} {total}")
+                lines.append(f"{name}_count{_labels(key)} {count}")
+        for name, (help_text, series) in counters.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for key, value in sorted(series.items()):
+                lines.append(f"{name}{_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+def _fmt(v: float) -> str:
+    return repr(float(v))
+
+def _labels(key: Tuple, **extra: str) -> str:
+    pairs = list(key) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+REGISTRY = Registry()
+REGISTRY.histogram("rag_stage_duration_seconds", "Duration of each /ask pipeline stage.", _LATENCY_BUCKETS)
+REGISTRY.histogram("rag_request_duration_seconds", "End-to-end request duration.", _LATENCY_BUCKETS)
+REGISTRY.histogram("rag_prompt_tokens", "Prompt tokens fed to Gemma per request.", _TOKEN_BUCKETS)
+REGISTRY.histogram("rag_generated_tokens", "Tokens generated by Gemma per request.", _TOKEN_BUCKETS)
+REGISTRY.histogram("rag_generation_tokens_per_second", "Decode throughput per generate call.", _TPS_BUCKETS)
+REGISTRY.histogram("rag_generation_batch_size", "Rows per model.generate call.", _BATCH_BUCKETS)
+REGISTRY.counter("rag_requests_total", "Requests served, by endpoint and outcome.")
+REGISTRY.counter("rag_semantic_cache_lookups_total", "Semantic answer cache lookups, by result.")
+REGISTRY.counter("rag_rerank_total", "Rerank stage runs, by outcome (ok | fallback to retrieval order).")
+
+_ANNOTATION_HISTOGRAMS = {
+    "prompt_tokens": "rag_prompt_tokens",
+    "generated_tokens": "rag_generated_tokens",
+    "tokens_per_second": "rag_generation_tokens_per_second",
+    "batch_size": "rag_generation_batch_size",
+}
+
+class Trace:
+    __slots__ = ("started", "spans", "attrs")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+        self.attrs: Dict[str, Any] = {}
+
+    def as_dict(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {f"{k}_ms": round(v, 3) for k, v in self.spans.items()}
+        out["total_ms"] = round((time.perf_counter() - self.started) * 1000.0, 3)
+        out.update(self.attrs)
+        return out
+
+class _Span:
+    __slots__ = ("name", "trace", "t0")
+
+    def __init__(self, name: str, trace: Optional[Trace]):
+        self.name = name
+        self.trace = trace
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record_stage(self.name, (time.perf_counter() - self.t0) * 1000.0, self.trace)
+        return False
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NOOP = _NoopSpan()
+
+def configure(enabled: bool) -> None:
+    global _enabled
+    _enabled = bool(enabled)
+
+def enabled() -> bool:
+    return _enabled
+
+def start_trace(inline: bool = False) -> Optional[Trace]:
+    """Begin a request trace; returns None (and traces nothing) when metrics are off and no inline timings were asked for."""
+    if not _enabled and not inline:
+        _current.set(None)
+        return None
+    trace = Trace()
+    _current.set(trace)
+    return trace
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+def span(name: str):
+    trace = _current.get()
+    if trace is None and not _enabled:
+        return _NOOP
+    return _Span(name, trace)
+
+def record_stage(name: str, ms: float, trace: Optional[Trace] = None) -> None:
+    """Record a stage duration measured elsewhere (e.g. inside the batch scheduler thread)."""
+    trace = trace if trace is not None else _current.get()
+    if trace is not None:
+        trace.spans[name] = trace.spans.get(name, 0.0) + ms
+    if _enabled:
+        REGISTRY.observe("rag_stage_duration_seconds", ms / 1000.0, stage=name)
+
+def annotate(**attrs: Any) -> None:
+    trace = _current.get()
+    if trace is None and not _enabled:
+        return
+    if trace is not None:
+        trace.attrs.update(attrs)
+    if _enabled:
+        for key, value in attrs.items():
+            metric = _ANNOTATION_HISTOGRAMS.get(key)
+            if metric is not None and value is not None:
+                REGISTRY.observe(metric, float(value))
+
+def count(name: str, amount: float = 1.0, **labels: str) -> None:
+    """Bump a registered counter; a no-op with METRICS_ENABLED=false."""
+    if _enabled:
+        REGISTRY.inc(name, amount, **labels)
+
+def finish_request(endpoint: str, outcome: str = "ok") -> Optional[Dict[str, Any]]:
+    """Close the current trace, record request-level metrics and return the inline timings dict."""
+    trace = _current.get()
+    _current.set(None)
+    if _enabled:
+        REGISTRY.inc("rag_requests_total", endpoint=endpoint, outcome=outcome)
+        if trace is not None:
+            REGISTRY.observe("rag_request_duration_seconds", time.perf_counter() - trace.started, endpoint=endpoint)
+    return trace.as_dict() if trace is not None else None
+
+def render_prometheus() -> str:
+    return REGISTRY.render()
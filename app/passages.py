@@ -0,0 +1,297 @@
+"""
+Memory-mapped columnar passage store, row-aligned with the FAISS index.
+
+Files (written next to index.faiss):
+  passages.bin          UTF-8 text of every passage, concatenated
+  passages.offsets.npy  int64[n + 1]; passage i is bin[offsets[i]:offsets[i + 1]]
+  passages.doc_ids.npy  int64[n]; doc_id metadata of passage i
+  passages.index.json   fingerprint of the index.faiss the rows were written for
+  tombstones.npy        int64 row ids deleted since the last compaction (optional)
+
+Row i is FAISS row id i, so lookups need neither the pickled LangChain docstore
+nor index_to_docstore_id: a row is two offset reads and a slice of the mapped blob,
+decoded straight from the page cache. The store is only trusted while index.faiss
+still matches its fingerprint: a folder whose index was regenerated some other way
+(e.g. LangChain save_local) is served from index.pkl instead. Everything is opened with mmap, so several
+processes on a host share the same page-cache pages instead of each holding one
+Document object per passage.
+
+    python -m app export-passages --report     # write it from index.pkl, compare resident memory
+"""
+import hashlib, json, os, pickle, time
+from typing import Any, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+BLOB_FILE = "passages.bin"
+OFFSETS_FILE = "passages.offsets.npy"
+DOC_IDS_FILE = "passages.doc_ids.npy"
+STAMP_FILE = "passages.index.json"
+TOMBSTONES_FILE = "tombstones.npy"
+_SAMPLE_BYTES = 1 << 20
+
+def store_exists(directory: str) -> bool:
+    return all(os.path.exists(os.path.join(directory, f)) for f in (BLOB_FILE, OFFSETS_FILE, DOC_IDS_FILE))
+
+def index_fingerprint(faiss_path: str) -> Dict[str, Any]:
+    """Size plus a digest of the head, middle and tail MiB of index.faiss; survives copies, cheap on large indexes."""
+    size = os.path.getsize(faiss_path)
+    h = hashlib.blake2b(digest_size=16)
+    with open(faiss_path, "rb") as f:
+        for start in sorted({0, max(0, size // 2 - _SAMPLE_BYTES // 2), max(0, size - _SAMPLE_BYTES)}):
+            f.seek(start)
+            h.update(f.read(_SAMPLE_BYTES))
+    return {"size": size, "digest": h.hexdigest()}
+
+def stamp_index(directory: str, faiss_path: str = None) -> None:
+    """Record which index.faiss the store in `directory` is row-aligned with; call after every index write."""
+    if not store_exists(directory):
+        return
+    stamp = index_fingerprint(faiss_path or os.path.join(directory, "index.faiss"))
+    tmp = os.path.join(directory, STAMP_FILE + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(stamp, f)
+    os.replace(tmp, os.path.join(directory, STAMP_FILE))
+
+def check_stamp(directory: str, faiss_path: str = None) -> None:
+    """
+    Raise RuntimeError unless the store was written for this index.faiss. A store without a
+    stamp (exported before stamps existed) is only accepted when there is no index.pkl to use.
+    """
+    faiss_path = faiss_path or os.path.join(directory, "index.faiss")
+    path = os.path.join(directory, STAMP_FILE)
+    if not os.path.exists(path):
+        if os.path.exists(os.path.join(os.path.dirname(faiss_path), "index.pkl")):
+            raise RuntimeError(f"passage store in {directory} has no index fingerprint; re-run export-passages")
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        stamp = json.load(f)
+    if stamp != index_fingerprint(faiss_path):
+        raise RuntimeError(f"index.faiss changed since the passage store in {directory} was written")
+
+class PassageStore:
+    def __init__(self, directory: str):
+        self.directory = directory
+        blob_path = os.path.join(directory, BLOB_FILE)
+        # plain ndarray views of the mapping: indexing np.memmap objects costs more than the lookups themselves
+        self.offsets = np.asarray(np.load(os.path.join(directory, OFFSETS_FILE), mmap_mode="r"))
+        self.doc_ids = np.asarray(np.load(os.path.join(directory, DOC_IDS_FILE), mmap_mode="r"))
+        # np.memmap refuses zero-length files
+        if os.path.getsize(blob_path):
+            self.blob = np.asarray(np.memmap(blob_path, dtype=np.uint8, mode="r"))
+        else:
+            self.blob = np.zeros(0, dtype=np.uint8)
+        self._buf = memoryview(self.blob)
+        if len(self.offsets) != len(self.doc_ids) + 1:
+            raise RuntimeError(f"Corrupt passage store in {directory}: offsets/doc_ids length mismatch")
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def view(self, row: int) -> memoryview:
+        """UTF-8 bytes of passage `row` as a view into the mapping (no copy)."""
+        # ndarray.item returns a Python int without building a numpy scalar first
+        return self._buf[self.offsets.item(row):self.offsets.item(row + 1)]
+
+    def text(self, row: int) -> str:
+        # decoded from the mapped pages directly, without an intermediate bytes copy
+        return str(self.view(row), "utf-8")
+
+    def doc_id(self, row: int) -> int:
+        return self.doc_ids.item(row)
+
+    def get(self, row: int) -> Tuple[str, int]:
+        return self.text(row), self.doc_id(row)
+
+    def hits(self, rows: Sequence[int]) -> List[Dict[str, Any]]:
+        """Retrieval hits ({"passage", "doc_id"}) for FAISS rows, in order."""
+        offset, doc_id, buf = self.offsets.item, self.doc_ids.item, self._buf
+        return [{"passage": str(buf[offset(r):offset(r + 1)], "utf-8"), "doc_id": doc_id(r)} for r in rows]
+
+def write_passage_store(directory: str, rows: Iterable[Tuple[str, int]]) -> int:
+    """Write (text, doc_id) rows in FAISS row order; returns the number of rows written."""
+    os.makedirs(directory, exist_ok=True)
+    offsets: List[int] = [0]
+    doc_ids: List[int] = []
+    tmp_blob = os.path.join(directory, BLOB_FILE + ".tmp")
+    with open(tmp_blob, "wb") as f:
+        for text, doc_id in rows:
+            data = (text or "").encode("utf-8")
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+            doc_ids.append(int(doc_id))
+    np.save(os.path.join(directory, OFFSETS_FILE), np.asarray(offsets, dtype=np.int64))
+    np.save(os.path.join(directory, DOC_IDS_FILE), np.asarray(doc_ids, dtype=np.int64))
+    os.replace(tmp_blob, os.path.join(directory, BLOB_FILE))
+    return len(doc_ids)
+
+def append_passage_store(directory: str, rows: Iterable[Tuple[str, int]]) -> int:
+    """
+    Append rows to an existing store. The blob grows in place; the offsets/doc_ids arrays
+    are swapped in atomically afterwards, so open readers keep seeing the old row count.
+    """
+    offsets = list(np.load(os.path.join(directory, OFFSETS_FILE)))
+    doc_ids = list(np.load(os.path.join(directory, DOC_IDS_FILE)))
+    added = 0
+    with open(os.path.join(directory, BLOB_FILE), "r+b") as f:
+        # drop any tail left by an interrupted append
+        f.truncate(int(offsets[-1]))
+        f.seek(int(offsets[-1]))
+        for text, doc_id in rows:
+            data = (text or "").encode("utf-8")
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+            doc_ids.append(int(doc_id))
+            added += 1
+    _save_atomic(os.path.join(directory, OFFSETS_FILE), np.asarray(offsets, dtype=np.int64))
+    _save_atomic(os.path.join(directory, DOC_IDS_FILE), np.asarray(doc_ids, dtype=np.int64))
+    return added
+
+def _save_atomic(path: str, arr: np.ndarray) -> None:
+    tmp = path + ".tmp.npy"
+    np.save(tmp, arr)
+    os.replace(tmp, path)
+
+def load_tombstones(directory: str) -> frozenset:
+    path = os.path.join(directory, TOMBSTONES_FILE)
+    if not os.path.exists(path):
+        return frozenset()
+    return frozenset(int(r) for r in np.load(path))
+
+def save_tombstones(directory: str, rows: Iterable[int]) -> None:
+    rows = sorted(set(int(r) for r in rows))
+    path = os.path.join(directory, TOMBSTONES_FILE)
+    if not rows:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    _save_atomic(path, np.asarray(rows, dtype=np.int64))
+
+def iter_langchain_docstore(faiss_dir: str) -> Iterator[Tuple[str, int]]:
+    """
+    Yield (text, doc_id) in FAISS row order from a LangChain `index.pkl`.
+    This unpickles the docstore, so only run it on index folders you built yourself.
+    """
+    with open(os.path.join(faiss_dir, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    for row in range(len(index_to_docstore_id)):
+        doc = docstore.search(index_to_docstore_id[row])
+        yield doc.page_content, int(doc.metadata.get("doc_id"))
+
+def export_from_langchain(faiss_dir: str, out_dir: str = None) -> int:
+    out_dir = out_dir or faiss_dir
+    n = write_passage_store(out_dir, iter_langchain_docstore(faiss_dir))
+    stamp_index(out_dir, os.path.join(faiss_dir, "index.faiss"))
+    print(f"✅ Exported {n} passages to {out_dir}")
+    return n
+
+# -----------------------------
+# Resident memory: pickled docstore vs columnar store (python -m app export-passages --report)
+# -----------------------------
+def _rss_parts() -> Dict[str, float]:
+    """Resident MB of this process, split into private heap (anon) and mapped files."""
+    out = {"rss_mb": 0.0, "anon_mb": 0.0, "file_mb": 0.0}
+    keys = {"VmRSS:": "rss_mb", "RssAnon:": "anon_mb", "RssFile:": "file_mb"}
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as f:
+            for line in f:
+                parts = line.split()
+                if parts and parts[0] in keys:
+                    out[keys[parts[0]]] = round(int(parts[1]) / 1024.0, 1)
+    except OSError:
+        import resource
+        out["rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+    return out
+
+def _measure(kind: str, directory: str, queue) -> None:
+    """Runs in a fresh process, so the numbers belong to this representation alone."""
+    import gc
+    import random
+    before = _rss_parts()
+    t0 = time.perf_counter()
+    if kind == "docstore":
+        with open(os.path.join(directory, "index.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        n = len(index_to_docstore_id)
+
+        def lookup(row: int) -> Tuple[str, int]:
+            doc = docstore.search(index_to_docstore_id[row])
+            return doc.page_content, int(doc.metadata.get("doc_id"))
+    else:
+        store = PassageStore(directory)
+        n = len(store)
+        lookup = store.get
+    load_s = time.perf_counter() - t0
+    gc.collect()
+    loaded = _rss_parts()
+
+    rows = [random.randrange(n) for _ in range(min(n, 20000))] if n else []
+    t0 = time.perf_counter()
+    for row in rows:
+        lookup(row)
+    lookup_us = (time.perf_counter() - t0) / max(1, len(rows)) * 1e6
+    for row in range(n):  # touch every passage once, as a long-running server eventually does
+        lookup(row)
+    gc.collect()
+    touched = _rss_parts()
+    queue.put({
+        "rows": n,
+        "load_s": round(load_s, 3),
+        "lookup_us": round(lookup_us, 2),
+        "after_load": {k: round(loaded[k] - before[k], 1) for k in before},
+        "after_full_scan": {k: round(touched[k] - before[k], 1) for k in before},
+    })
+
+def _run_measure(ctx, kind: str, directory: str, timeout_s: float) -> Dict[str, Any]:
+    """_measure in a spawned process; {"error": ...} if it dies (e.g. MemoryError unpickling) or overruns."""
+    import queue as queue_mod
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_measure, args=(kind, directory, queue))
+    proc.start()
+    deadline = time.monotonic() + timeout_s
+    result = None
+    timed_out = False
+    while result is None:
+        try:
+            result = queue.get(timeout=1.0)
+        except queue_mod.Empty:
+            if not proc.is_alive():
+                # it may have exited right after putting the result
+                try:
+                    result = queue.get(timeout=1.0)
+                except queue_mod.Empty:
+                    break
+            elif time.monotonic() > deadline:
+                timed_out = True
+                proc.terminate()
+                break
+    proc.join(5.0)
+    if result is None:
+        reason = f"timed out after {timeout_s:.0f}s" if timed_out else f"exit code {proc.exitcode}"
+        print(f"⚠ {kind} measurement failed ({reason})")
+        return {"error": f"measurement process failed ({reason})"}
+    return result
+
+def memory_report(faiss_dir: str, store_dir: str = None, timeout_s: float = 3600.0) -> Dict[str, Any]:
+    """
+    Load the pickled docstore (faiss_dir/index.pkl) and the columnar store (store_dir, default
+    faiss_dir) in separate fresh processes and report load time, per-row lookup latency and
+    resident memory (private heap vs shared file pages). A measurement whose process dies or
+    runs past timeout_s is reported as {"error": ...}.
+    """
+    import multiprocessing as mp
+    ctx = mp.get_context("spawn")
+    report: Dict[str, Any] = {"faiss_dir": faiss_dir}
+    files = {"docstore": (faiss_dir, ["index.pkl"]),
+             "passage_store": (store_dir or faiss_dir, [BLOB_FILE, OFFSETS_FILE, DOC_IDS_FILE])}
+    for kind, (directory, names) in files.items():
+        result = _run_measure(ctx, kind, directory, timeout_s)
+        paths = [os.path.join(directory, f) for f in names]
+        result["disk_mb"] = round(sum(os.path.getsize(p) for p in paths if os.path.exists(p)) / 2**20, 1)
+        report[kind] = result
+    if "error" in report["docstore"] or "error" in report["passage_store"]:
+        return report
+    old, new = report["docstore"]["after_full_scan"], report["passage_store"]["after_full_scan"]
+    report["private_mb_saved_per_process"] = round(old["anon_mb"] - new["anon_mb"], 1)
+    report["load_speedup"] = round(report["docstore"]["load_s"] / max(report["passage_store"]["load_s"], 1e-6), 1)
+    return report
@@ -0,0 +1,108 @@
+"""
+Prefix KV-cache for the static heads of INTENT_TEMPLATES.
+
+Every answer prompt starts with its intent's fixed instructions (everything before
+"{context}"), so their past-key-values are computed once at startup and each generate
+call starts from them instead of prefilling the same tokens again.
+
+Rows of one intent share the whole head; a mixed-intent batch shares the longest token
+prefix common to its intents (the "You are a biomedical expert." preamble), sliced from
+any one of them since causal attention makes a prefix's keys/values independent of what
+follows. The stored tensors are never written to: each call gets a fresh DynamicCache
+over expanded views of them, and the cache grows by concatenation, so batched and beam
+rows copy on write.
+
+Bounded by PREFIX_CACHE_MAX_MB (heads that do not fit are skipped and prefilled as
+before); disable with "PREFIX_CACHE_ENABLED": false.
+"""
+import threading, time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import torch
+from transformers import DynamicCache
+
+from .intent import INTENT_TEMPLATES
+
+def _kv_layers(cache) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    """(key, value) per layer from a Cache object or a legacy tuple, across transformers versions."""
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    if hasattr(cache, "key_cache"):
+        return list(zip(cache.key_cache, cache.value_cache))
+    return [(k, v) for k, v in cache]
+
+def _common_prefix(a: Sequence[int], b: Sequence[int]) -> int:
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+class PrefixCache:
+    def __init__(self, model, tokenizer, cfg: Dict[str, Any]):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_bytes = int(float(cfg.get("PREFIX_CACHE_MAX_MB", 256)) * 2**20)
+        self.bytes = 0
+        self.entries: Dict[str, Tuple[List[int], List[Tuple[torch.Tensor, torch.Tensor]]]] = {}
+        self.skipped: List[str] = []
+        self.warm_ms = 0.0
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "full": 0, "shared": 0, "misses": 0, "reused_tokens": 0}
+
+    @torch.no_grad()
+    def warm(self) -> "PrefixCache":
+        from .gemma import template_head_ids
+
+        t0 = time.perf_counter()
+        for intent in INTENT_TEMPLATES:
+            ids = template_head_ids(self.tokenizer, intent)
+            out = self.model(input_ids=torch.tensor([ids], device=self.model.device), use_cache=True)
+            layers = [(k.detach(), v.detach()) for k, v in _kv_layers(out.past_key_values)]
+            size = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in layers)
+            if self.bytes + size > self.max_bytes:
+                self.skipped.append(intent)
+                continue
+            self.entries[intent] = (ids, layers)
+            self.bytes += size
+        self.warm_ms = (time.perf_counter() - t0) * 1000.0
+        return self
+
+    def lookup(self, intents: Sequence[str], seqs: Sequence[Sequence[int]], rows: int) -> Tuple[Optional[Any], int]:
+        """
+        Cache for a batch whose prompts are `seqs` (token ids, one per intent), expanded to `rows`
+        (batch size x beams). Returns (past_key_values, cached prefix length) or (None, 0).
+        """
+        entries = [self.entries.get(intent) for intent in intents]
+        length = 0
+        if entries and all(e is not None for e in entries):
+            length = len(entries[0][0])
+            for (ids, _), seq in zip(entries, seqs):
+                length = min(length, _common_prefix(entries[0][0], ids), _common_prefix(ids, seq))
+            # generate needs at least one uncached token per row
+            length = min(length, min(len(s) for s in seqs) - 1)
+        with self._lock:
+            self._stats["calls"] += 1
+            if length <= 0:
+                self._stats["misses"] += 1
+            else:
+                self._stats["full" if len(set(intents)) == 1 else "shared"] += 1
+                self._stats["reused_tokens"] += length * len(seqs)
+        if length <= 0:
+            return None, 0
+        cache = DynamicCache()
+        for layer, (k, v) in enumerate(entries[0][1]):
+            cache.update(k[:, :, :length].expand(rows, -1, -1, -1), v[:, :, :length].expand(rows, -1, -1, -1), layer)
+        return cache, length
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            s = dict(self._stats)
+        return {
+            "intents": sorted(self.entries),
+            "skipped": self.skipped,
+            "memory_mb": round(self.bytes / 2**20, 2),
+            "max_mb": round(self.max_bytes / 2**20, 2),
+            "warm_ms": round(self.warm_ms, 1),
+            **s,
+        }
@@ -0,0 +1,248 @@
+"""
+Cross-encoder reranking of retrieved passages (RERANK_ENABLED).
+
+Retrieval over-fetches RERANK_FETCH_K candidates; a small local cross-encoder
+(RERANKER_HF_REPO, downloaded into RERANKER_DIR once) scores every (query, passage)
+pair in batches of RERANK_BATCH_SIZE, dynamically int8-quantized on CPU with
+RERANKER_INT8. Only the best passages are kept: at most RERANK_TOP_N (and never more
+than the request's k), or, with RERANK_TOKEN_BUDGET > 0, as many as fit that many
+reranker tokens. Each query gets RERANK_BUDGET_MS from its first scored batch; once it is
+spent (or the next batch would overrun it) the query keeps the same number of passages
+in FAISS order instead.
+
+    python -m app rerank-report --limit 200      # recall / prompt length with and without it
+"""
+import os, threading, time
+from typing import Any, Dict, List, Sequence, Set, Tuple
+
+DEFAULT_HF_REPO = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+class Reranker:
+    def __init__(self, tokenizer, model, cfg: Dict[str, Any], backend: str = "fp32", device: str = "cpu"):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.backend = backend
+        self.device = device
+        self.fetch_k = int(cfg.get("RERANK_FETCH_K", 20))
+        self.top_n = max(1, int(cfg.get("RERANK_TOP_N", 3)))
+        self.token_budget = int(cfg.get("RERANK_TOKEN_BUDGET", 0))
+        self.batch_size = max(1, int(cfg.get("RERANK_BATCH_SIZE", 16)))
+        self.max_length = int(cfg.get("RERANK_MAX_LENGTH", 256))
+        self.budget_s = float(cfg.get("RERANK_BUDGET_MS", 150)) / 1000.0
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "fallbacks": 0, "pairs_scored": 0, "passages_in": 0,
+                       "passages_out": 0, "rerank_ms_total": 0.0}
+
+    def fetch(self, k: int) -> int:
+        """Candidates to retrieve for a request that asked for k passages."""
+        return max(k, self.fetch_k)
+
+    def score(self, pairs: Sequence[Tuple[str, str]]) -> List[float]:
+        import torch
+        enc = self.tokenizer([q for q, _ in pairs], [p for _, p in pairs], padding=True, truncation=True,
+                             max_length=self.max_length, return_tensors="pt").to(self.device)
+        with torch.inference_mode():
+            logits = self.model(**enc).logits
+        # single-logit relevance heads (ms-marco) vs two-class heads: the last column is "relevant"
+        return logits[:, -1].float().tolist()
+
+    def _keep(self, hits: List[Dict[str, Any]], k: int) -> List[Dict[str, Any]]:
+        if self.token_budget <= 0 or not hits:
+            return hits[:min(k, self.top_n)]
+        lengths = [len(ids) for ids in self.tokenizer([h.get("passage", "") for h in hits[:k]],
+                                                      add_special_tokens=False)["input_ids"]]
+        kept, used = [], 0
+        for hit, length in zip(hits, lengths):
+            if kept and used + length > self.token_budget:
+                break
+            kept.append(hit)
+            used += length
+        return kept
+
+    def rerank_many(self, queries: Sequence[str], hit_lists: Sequence[List[Dict[str, Any]]],
+                    k: int) -> Tuple[List[List[Dict[str, Any]]], List[bool]]:
+        """
+        Rerank each query's candidates; the pairs of all queries share batches. Every query has
+        its own RERANK_BUDGET_MS deadline, starting with its first batch, so its outcome does not
+        depend on its position in the batch. A query whose batch would start or did finish past
+        its deadline falls back. Returns the kept hits (with a "rerank_score") and, per query,
+        whether it fell back to FAISS order.
+        """
+        pairs = [(qi, j) for qi, hits in enumerate(hit_lists) for j in range(len(hits))]
+        scores: Dict[Tuple[int, int], float] = {}
+        deadlines: Dict[int, float] = {}
+        overrun: Set[int] = set()
+        t0 = time.perf_counter()
+        last = 0.0
+        pos = scored = 0
+        while pos < len(pairs):
+            now = time.perf_counter()
+            chunk = []
+            while pos < len(pairs) and len(chunk) < self.batch_size:
+                qi, j = pairs[pos]
+                pos += 1
+                if qi in overrun:
+                    continue
+                if qi in deadlines and now + last > deadlines[qi]:
+                    overrun.add(qi)  # the next batch would overrun it
+                    continue
+                deadlines.setdefault(qi, now + self.budget_s)
+                chunk.append((qi, j))
+            if not chunk:
+                continue
+            batch = self.score([(queries[qi], hit_lists[qi][j].get("passage", "")) for qi, j in chunk])
+            end = time.perf_counter()
+            last = end - now
+            scored += len(chunk)
+            for (qi, j), s in zip(chunk, batch):
+                if end > deadlines[qi]:
+                    overrun.add(qi)
+                elif qi not in overrun:
+                    scores[(qi, j)] = s
+
+        out, fell_back = [], []
+        for qi, hits in enumerate(hit_lists):
+            if qi not in overrun and all((qi, j) in scores for j in range(len(hits))):
+                ranked = sorted(({**h, "rerank_score": round(scores[(qi, j)], 4)} for j, h in enumerate(hits)),
+                                key=lambda h: -h["rerank_score"])
+                fell_back.append(False)
+            else:
+                ranked = list(hits)
+                fell_back.append(True)
+            out.append(self._keep(ranked, k))
+        with self._lock:
+            s = self._stats
+            s["requests"] += len(hit_lists)
+            s["fallbacks"] += sum(fell_back)
+            s["pairs_scored"] += scored
+            s["passages_in"] += len(pairs)
+            s["passages_out"] += sum(len(h) for h in out)
+            s["rerank_ms_total"] += (time.perf_counter() - t0) * 1000.0
+        return out, fell_back
+
+    def rerank(self, query: str, hits: List[Dict[str, Any]], k: int) -> Tuple[List[Dict[str, Any]], bool]:
+        kept, fell_back = self.rerank_many([query], [hits], k)
+        return kept[0], fell_back[0]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            s = dict(self._stats)
+        n = s["requests"]
+        return {
+            "backend": self.backend,
+            "fetch_k": self.fetch_k,
+            "top_n": self.top_n,
+            "token_budget": self.token_budget,
+            "budget_ms": self.budget_s * 1000.0,
+            **s,
+            "rerank_ms_total": round(s["rerank_ms_total"], 1),
+            "avg_ms": round(s["rerank_ms_total"] / n, 2) if n else 0.0,
+            "fallback_rate": round(s["fallbacks"] / n, 4) if n else 0.0,
+            "avg_passages_out": round(s["passages_out"] / n, 2) if n else 0.0,
+        }
+
+def load_reranker(cfg: Dict[str, Any]) -> Reranker:
+    """The cross-encoder from RERANKER_DIR, downloading RERANKER_HF_REPO into it when the folder is empty."""
+    import torch
+    from huggingface_hub import snapshot_download
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+    model_dir = cfg.get("RERANKER_DIR") or "./app/models/reranker"
+    if not (os.path.isdir(model_dir) and os.listdir(model_dir)):
+        repo = cfg.get("RERANKER_HF_REPO") or DEFAULT_HF_REPO
+        print(f"Downloading reranker from Hub: {repo} -> {model_dir}")
+        os.makedirs(model_dir, exist_ok=True)
+        snapshot_download(repo_id=repo, local_dir=model_dir)
+    tokenizer = AutoTokenizer.from_pretrained(model_dir, use_fast=True)
+    model = AutoModelForSequenceClassification.from_pretrained(model_dir).eval()
+    device, backend = ("cuda", "cuda") if torch.cuda.is_available() else ("cpu", "fp32")
+    if device == "cuda":
+        model = model.to(device)
+    elif cfg.get("RERANKER_INT8", True):
+        from .cpu_backend import apply_backend
+        model, backend = apply_backend(model, "int8")
+    reranker = Reranker(tokenizer, model, cfg, backend, device)
+    reranker.score([("warmup", "warmup")])  # first call pays for lazy kernel init
+    return reranker
+
+# -----------------------------
+# Quality / prompt-length report (python -m app rerank-report)
+# -----------------------------
+def _prompt_stats(reranker: Reranker, hit_lists: List[List[Dict[str, Any]]]) -> Dict[str, float]:
+    n = max(1, len(hit_lists))
+    texts = ["\n".join(h.get("passage", "") for h in hits) for hits in hit_lists]
+    tokens = sum(len(ids) for ids in reranker.tokenizer(texts, add_special_tokens=False)["input_ids"]) if texts else 0
+    return {"avg_passages": round(sum(len(h) for h in hit_lists) / n, 2),
+            "avg_context_chars": round(sum(len(t) for t in texts) / n, 1),
+            "avg_context_tokens": round(tokens / n, 1)}
+
+def run_report(args) -> Dict[str, Any]:
+    """
+    Retrieve RERANK_FETCH_K candidates for each test question and compare what would reach
+    the prompt: FAISS top-k (today), FAISS top-n (same size, no reranking) and the reranked
+    selection, by recall@k / hit@k / MRR against relevant_passage_ids and context length.
+    """
+    import json
+    from .bench import load_test_set, retrieval_metrics, summarize
+    from .config import load_config
+    from .retriever import load_embedder_from_dir, load_faiss, retrieve_batch
+
+    cfg = load_config(os.getenv("CONFIG_PATH", "./config.json"))
+    for key, value in (("RERANK_FETCH_K", args.fetch_k), ("RERANK_TOP_N", args.top_n),
+                       ("RERANK_TOKEN_BUDGET", args.token_budget), ("RERANK_BUDGET_MS", args.budget_ms)):
+        if value is not None:
+            cfg[key] = value
+    k_values = [int(x) for x in args.k_values.split(",") if x.strip()]
+    tests = load_test_set(args.test_set, args.limit)
+    questions = [t["question"] for t in tests]
+    relevant = [t["relevant"] for t in tests]
+
+    vs = load_faiss(cfg, load_embedder_from_dir(cfg))
+    reranker = load_reranker(cfg)
+    vecs = vs.embedding_function.embed_documents(questions)
+    candidates, _ = retrieve_batch(vs, vecs, reranker.fetch(args.k), queries=questions)
+
+    latencies: List[float] = []
+    reranked, fallbacks = [], 0
+    for question, hits in zip(questions, candidates):
+        t0 = time.perf_counter()
+        kept, fell_back = reranker.rerank(question, hits, args.k)
+        latencies.append((time.perf_counter() - t0) * 1000.0)
+        reranked.append(kept)
+        fallbacks += fell_back
+    same_size = [hits[:len(kept)] for hits, kept in zip(candidates, reranked)]
+
+    def entry(hit_lists: List[List[Dict[str, Any]]]) -> Dict[str, Any]:
+        ranked = [[h["doc_id"] for h in hits] for hits in hit_lists]
+        return {"retrieval": retrieval_metrics(ranked, relevant, k_values), **_prompt_stats(reranker, hit_lists)}
+
+    report = {
+        "questions": len(tests),
+        "k": args.k,
+        "reranker": {key: v for key, v in reranker.stats().items()
+                     if key in ("backend", "fetch_k", "top_n", "token_budget", "budget_ms")},
+        "faiss_top_k": entry([hits[:args.k] for hits in candidates]),
+        "faiss_same_size": entry(same_size),
+        "reranked": {**entry(reranked), "latency": summarize(latencies), "fallbacks": fallbacks},
+    }
+    for name in ("faiss_top_k", "faiss_same_size", "reranked"):
+        r = report[name]
+        print(f"  {name:16s} passages {r['avg_passages']:5.2f}  context tokens {r['avg_context_tokens']:7.1f}  "
+              f"mrr {r['retrieval'].get('mrr')}  recall@{max(k_values)} {r['retrieval'].get(f'recall@{max(k_values)}')}")
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"✅ Wrote {args.out}")
+    return report
+
+def add_report_arguments(p) -> None:
+    p.add_argument("--test-set", default=None, help="test.parquet / df_test.csv (default: data/test.parquet)")
+    p.add_argument("--limit", type=int, default=200, help="number of test questions")
+    p.add_argument("--k", type=int, default=5, help="passages a request asks for (TOP_K_DEFAULT)")
+    p.add_argument("--k-values", default="1,3,5")
+    p.add_argument("--fetch-k", type=int, default=None, help="override RERANK_FETCH_K")
+    p.add_argument("--top-n", type=int, default=None, help="override RERANK_TOP_N")
+    p.add_argument("--token-budget", type=int, default=None, help="override RERANK_TOKEN_BUDGET")
+    p.add_argument("--budget-ms", type=float, default=None, help="override RERANK_BUDGET_MS")
+    p.add_argument("--out", default="bench_results/rerank_report.json")
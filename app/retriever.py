@@ -1,11 +1,15 @@
-import os, pickle
-from typing import Any, Dict, List
+import os, threading, time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Any, Dict, List, NamedTuple, Optional, Tuple
 
-from langchain_community.vectorstores import FAISS
+from . import metrics
 
-import os
-import joblib
-from langchain_community.embeddings import HuggingFaceEmbeddings  # ✅ updated import
+# langchain / faiss / joblib are imported inside the loaders so that importing this
+# module (and app.main) stays cheap; FAST_START relies on that to open the port early.
+if TYPE_CHECKING:
+    from langchain_community.vectorstores import FAISS
+
+SENTENCE_TRANSFORMER_SUBDIR = "sentence_transformer"
 
 def load_embedder(cfg):
     """
@@ -14,6 +18,9 @@ def load_embedder(cfg):
     2. If missing or invalid, rebuild from model name/directory.
     3. Save rebuilt embedder to pickle for next time.
     """
+    import joblib
+    from langchain_community.embeddings import HuggingFaceEmbeddings  # ✅ updated import
+
     embedder_pkl = os.path.abspath(cfg["EMBEDDER_PKL"])
     embedding_name_or_dir = cfg["EMBEDDING_NAME_OR_DIR"]
 
@@ -42,18 +49,390 @@ def load_embedder(cfg):
 
     return embedder
 
+def load_embedder_from_dir(cfg):
+    """
+    Pickle-free embedder: rebuild HuggingFaceEmbeddings from a sentence-transformers
+    directory under EMBEDDER_DIR. The first call exports the model there (from the
+    pickle or EMBEDDING_NAME_OR_DIR); later starts just read the safetensors files.
+    """
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+
+    local_dir = os.path.join(cfg["EMBEDDER_DIR"], SENTENCE_TRANSFORMER_SUBDIR)
+    if os.path.isfile(os.path.join(local_dir, "modules.json")):
+        print(f"✅ Embedder loaded from directory: {local_dir}")
+        return HuggingFaceEmbeddings(model_name=local_dir)
 
+    embedder = load_embedder(cfg)
+    print(f"🔄 Exporting embedder to {local_dir} for pickle-free starts")
+    embedder.client.save(local_dir)
+    return embedder
 
-def load_faiss(cfg, embedder):
+def faiss_root_for(cfg) -> str:
     base_dir = os.path.dirname(os.path.abspath(__file__))  # /.../Project/app
-    faiss_dir = os.path.join(base_dir, "index", "faiss_index_folder")
+    return cfg.get("FAISS_DIR") or os.path.join(base_dir, "index", "faiss_index_folder")
+
+def faiss_dir_for(cfg, version: Optional[str] = None) -> str:
+    """Index folder to serve: FAISS_DIR/versions/<version or CURRENT>, or FAISS_DIR itself when unversioned."""
+    from .index_versions import resolve_dir
+    return resolve_dir(faiss_root_for(cfg), version)
+
+def index_version(cfg, faiss_dir: Optional[str] = None) -> str:
+    """Version name of a versioned index folder, else a fingerprint of its files; changes whenever it is rebuilt."""
+    from .index_versions import version_label
+    return version_label(faiss_root_for(cfg), faiss_dir or faiss_dir_for(cfg))
+
+def load_faiss(cfg, embedder, faiss_dir: Optional[str] = None):
+    """
+    The index folder's store: index.faiss read into RAM plus the columnar passage store when
+    the folder has one (PASSAGE_STORE), else LangChain's FAISS with the pickled docstore.
+    """
+    faiss_dir = faiss_dir or faiss_dir_for(cfg)
 
     print(f"FAISS_DIR: {faiss_dir}")
     if not os.path.exists(faiss_dir):
         raise RuntimeError(f"FAISS_DIR not found: {faiss_dir}")
-    
-    return FAISS.load_local(faiss_dir, embedder, allow_dangerous_deserialization=True)
 
-def retrieve_top_k(vs: FAISS, query: str, k: int) -> List[Dict[str, Any]]:
+    from .passages import load_tombstones, store_exists
+    if cfg.get("PASSAGE_STORE", True) and store_exists(faiss_dir):
+        try:
+            return _open_columnar(cfg, embedder, faiss_dir, mmap=False)
+        except (RuntimeError, ValueError, OSError) as e:  # stale stamp, or a truncated / corrupt .npy
+            print(f"⚠ Columnar passage store unusable ({e}); unpickling index.pkl instead.")
+
+    from langchain_community.vectorstores import FAISS
+    from .ann import apply_search_params
+    vs = FAISS.load_local(faiss_dir, embedder, allow_dangerous_deserialization=True)
+    apply_search_params(vs.index, cfg)
+    tombstones = load_tombstones(faiss_dir)
+    if tombstones:
+        # LangChain's search has no row-level filter, so serve deleted-row-aware lookups ourselves
+        print(f"FAISS_DIR has {len(tombstones)} tombstoned rows; filtering them at query time.")
+        vs = MmapVectorStore(vs.index, DocstorePassages(vs), embedder, tombstones)
+    attach_hybrid(vs, cfg, faiss_dir)
+    attach_sentences(vs, cfg, faiss_dir)
+    return vs
+
+class Passage(NamedTuple):
+    """Minimal stand-in for a LangChain Document (page_content + metadata)."""
+    page_content: str
+    metadata: Dict[str, Any]
+
+def search_live(index, q, k: int, tombstones=frozenset()) -> List[List[Tuple[int, float]]]:
+    """Live (row, squared L2) pairs of the k nearest rows per query, from index.search over the matrix."""
+    import numpy as np
+    q = np.asarray(q, dtype=np.float32)
+    total = int(index.ntotal)
+    # over-fetch when rows have been deleted, widening until every query has k live rows
+    fetch = min(total, k if not tombstones else 2 * k)
+    while True:
+        distances, rows = index.search(q, max(fetch, 1))
+        live = [[(int(r), float(d)) for d, r in zip(distances[i], rows[i]) if r >= 0 and int(r) not in tombstones]
+                for i in range(len(q))]
+        if fetch >= total or all(len(found) >= k for found in live):
+            return [found[:k] for found in live]
+        fetch = min(total, fetch * 4)
+
+class MmapVectorStore:
+    """
+    Read-only vector store over the native `index.faiss` (opened with IO_FLAG_MMAP where the
+    index type supports it, in fast-start / worker mode) and the columnar PassageStore, with
+    no pickle anywhere. Implements the subset of the LangChain FAISS API that the retrieval
+    helpers use; they read rows through search_rows() and skip the Document stand-ins.
+    Rows listed in `tombstones` (see `python -m app build-index --delete`) are skipped.
+    """
+
+    def __init__(self, index, passages, embedding_function, tombstones=frozenset()):
+        self.index = index
+        self.passages = passages
+        self.embedding_function = embedding_function
+        self.tombstones = tombstones
+
+    def search_rows(self, vector, k: int) -> List[Tuple[int, float]]:
+        """Live (row, squared L2) pairs of the k nearest rows."""
+        return search_live(self.index, [vector], k, self.tombstones)[0]
+
+    def _search(self, vector, k: int):
+        out = []
+        for row, dist in self.search_rows(vector, k):
+            text, doc_id = self.passages.get(row)
+            out.append((Passage(text, {"doc_id": doc_id}), dist))
+        return out
+
+    def similarity_search_by_vector(self, embedding, k: int = 4, **kwargs):
+        return [doc for doc, _ in self._search(embedding, k)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs):
+        return self._search(self.embedding_function.embed_query(query), k)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs):
+        return self.similarity_search_by_vector(self.embedding_function.embed_query(query), k)
+
+class DocstorePassages:
+    """PassageStore-shaped view over a loaded LangChain FAISS docstore."""
+
+    def __init__(self, vs):
+        self.docstore = vs.docstore
+        self.index_to_docstore_id = vs.index_to_docstore_id
+
+    def __len__(self) -> int:
+        return len(self.index_to_docstore_id)
+
+    def get(self, row: int) -> Tuple[str, int]:
+        doc = self.docstore.search(self.index_to_docstore_id[row])
+        return doc.page_content, int(doc.metadata.get("doc_id"))
+
+    def hits(self, rows) -> List[Dict[str, Any]]:
+        out = []
+        for row in rows:
+            text, doc_id = self.get(row)
+            out.append({"passage": text, "doc_id": doc_id})
+        return out
+
+def read_index_mmap(path: str):
+    """faiss.read_index with the page cache doing the work; falls back to a normal read."""
+    import faiss
+    flags = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_READ_ONLY", 0)
+    # newer faiss can also mmap flat code arrays (IndexFlat*, SQ) rather than only inverted lists
+    flags |= getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+    try:
+        return faiss.read_index(path, flags)
+    except RuntimeError as e:
+        print(f"⚠ mmap read not supported for this index ({e}); loading into RAM.")
+        return faiss.read_index(path)
+
+def load_fast_index(cfg, embedder, faiss_dir: Optional[str] = None) -> MmapVectorStore:
+    from .passages import store_exists
+
+    faiss_dir = faiss_dir or faiss_dir_for(cfg)
+    if not store_exists(faiss_dir):
+        raise RuntimeError(
+            f"No columnar passage store in {faiss_dir}; run `python -m app export-passages` first."
+        )
+    return _open_columnar(cfg, embedder, faiss_dir, mmap=True)
+
+def _open_columnar(cfg, embedder, faiss_dir: str, mmap: bool) -> MmapVectorStore:
+    import faiss
+    from .ann import apply_search_params
+    from .passages import PassageStore, check_stamp, load_tombstones
+
+    path = os.path.join(faiss_dir, "index.faiss")
+    check_stamp(faiss_dir, path)
+    index = read_index_mmap(path) if mmap else faiss.read_index(path)
+    apply_search_params(index, cfg)
+    passages = PassageStore(faiss_dir)
+    if index.ntotal != len(passages):
+        raise RuntimeError(f"index.faiss has {index.ntotal} vectors but the passage store has {len(passages)} rows")
+    vs = MmapVectorStore(index, passages, embedder, load_tombstones(faiss_dir))
+    attach_hybrid(vs, cfg, faiss_dir)
+    attach_sentences(vs, cfg, faiss_dir)
+    return vs
+
+# -----------------------------
+# Hybrid (dense + BM25) retrieval
+# -----------------------------
+_hybrid_pool: Optional[ThreadPoolExecutor] = None
+_hybrid_pool_lock = threading.Lock()
+
+def _pool() -> ThreadPoolExecutor:
+    global _hybrid_pool
+    with _hybrid_pool_lock:
+        if _hybrid_pool is None:
+            _hybrid_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="hybrid")
+        return _hybrid_pool
+
+def shutdown_pool() -> None:
+    """Join the hybrid pool's threads (before forking workers); the next query starts a new pool."""
+    global _hybrid_pool
+    with _hybrid_pool_lock:
+        if _hybrid_pool is not None:
+            _hybrid_pool.shutdown(wait=True)
+            _hybrid_pool = None
+
+def _passages_for(vs):
+    passages = getattr(vs, "passages", None)
+    return passages if passages is not None else DocstorePassages(vs)
+
+def _dense_rows(vs, q, fetch: int) -> List[List[Tuple[int, float]]]:
+    """(row, squared L2) per query from index.search over the matrix, tombstones removed."""
+    return search_live(vs.index, q, fetch, getattr(vs, "tombstones", frozenset()))
+
+def rrf_fuse(rankings: List[List[int]], k: int, rrf_k: int = 60) -> List[int]:
+    """Reciprocal rank fusion: score(row) = sum over rankings of 1 / (rrf_k + rank)."""
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking, start=1):
+            scores[row] = scores.get(row, 0.0) + 1.0 / (rrf_k + rank)
+    return sorted(scores, key=lambda r: -scores[r])[:k]
+
+class HybridSearch:
+    """
+    Dense FAISS + BM25 retrieval fused with reciprocal rank fusion. For a single query both
+    retrievers run concurrently; after HYBRID_BUDGET_MS whatever has finished is fused. If
+    neither has, the first to finish within HYBRID_MAX_WAIT_MS is used, and past that the
+    query gets no hits, so a slow retriever cannot stall /ask. Work that is no longer needed
+    is cancelled while queued and skips its search once embedded, keeping the pool free.
+    """
+
+    def __init__(self, bm25, cfg: Dict[str, Any]):
+        self.bm25 = bm25
+        self.rrf_k = int(cfg.get("RRF_K", 60))
+        self.fetch_k = int(cfg.get("HYBRID_FETCH_K", 20))
+        self.budget_s = float(cfg.get("HYBRID_BUDGET_MS", 100)) / 1000.0
+        self.max_wait_s = max(self.budget_s, float(cfg.get("HYBRID_MAX_WAIT_MS", 1000)) / 1000.0)
+        self._lock = threading.Lock()
+        self._stats = {"queries": 0, "dense_late": 0, "bm25_late": 0, "bm25_only_hits": 0, "timeouts": 0}
+
+    def _fuse(self, dense: Optional[List[Tuple[int, float]]], lexical: Optional[List[Tuple[int, float]]], k: int):
+        rankings = [[r for r, _ in ranked] for ranked in (dense, lexical) if ranked is not None]
+        rows = rrf_fuse(rankings, k, self.rrf_k)
+        cosine = {r: 1.0 - d / 2.0 for r, d in (dense or [])}
+        # rows BM25 alone surfaced rank below every dense candidate, so bound them by the weakest one
+        floor = min(cosine.values()) if cosine else 0.0
+        extra = sum(1 for r in rows if r not in cosine)
+        with self._lock:
+            self._stats["bm25_only_hits"] += extra
+        return [(r, cosine.get(r, floor)) for r in rows]
+
+    def search(self, vs, query: str, k: int, vector=None) -> List[Tuple[int, float]]:
+        """Fused top-k as (row, cosine relevance); embeds `query` itself unless `vector` is given."""
+        fetch = max(k, self.fetch_k)
+        trace = metrics.current_trace()
+        exclude = getattr(vs, "tombstones", frozenset())
+        abandoned = threading.Event()
+
+        def timed(stage, fn):
+            t0 = time.perf_counter()
+            try:
+                return fn()
+            finally:
+                metrics.record_stage(stage, (time.perf_counter() - t0) * 1000.0, trace)
+
+        def dense():
+            vec = vector if vector is not None else vs.embedding_function.embed_query(query)
+            if abandoned.is_set():
+                return None
+            return _dense_rows(vs, [vec], fetch)[0]
+
+        futures = {
+            "dense": _pool().submit(timed, "dense_search", dense),
+            "bm25": _pool().submit(timed, "bm25_search", lambda: self.bm25.search(query, fetch, exclude)),
+        }
+        done, _ = wait(futures.values(), timeout=self.budget_s)
+        if not done:
+            done, _ = wait(futures.values(), timeout=self.max_wait_s - self.budget_s, return_when=FIRST_COMPLETED)
+        abandoned.set()
+        results: Dict[str, Any] = {}
+        with self._lock:
+            self._stats["queries"] += 1
+            if not done:
+                self._stats["timeouts"] += 1
+            for name, fut in futures.items():
+                if fut in done:
+                    results[name] = fut.result()
+                else:
+                    fut.cancel()  # drops it if still queued behind other queries
+                    self._stats[f"{name}_late"] += 1
+        return self._fuse(results.get("dense"), results.get("bm25"), k)
+
+    def search_batch(self, vs, queries: List[str], vectors, k: int) -> List[List[Tuple[int, float]]]:
+        """Throughput path: one dense index.search for the whole matrix, then BM25 per query."""
+        fetch = max(k, self.fetch_k)
+        exclude = getattr(vs, "tombstones", frozenset())
+        dense = _dense_rows(vs, vectors, fetch)
+        with self._lock:
+            self._stats["queries"] += len(queries)
+        return [self._fuse(d, self.bm25.search(q, fetch, exclude), k) for q, d in zip(queries, dense)]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            s = dict(self._stats)
+        return {**s, "rrf_k": self.rrf_k, "fetch_k": self.fetch_k, "budget_ms": self.budget_s * 1000.0,
+                "max_wait_ms": self.max_wait_s * 1000.0, "bm25_rows": len(self.bm25)}
+
+def attach_hybrid(vs, cfg: Dict[str, Any], faiss_dir: str) -> None:
+    """With HYBRID_RETRIEVAL on, hang a HybridSearch over the folder's BM25 index on the store."""
+    vs.hybrid = None
+    if not cfg.get("HYBRID_RETRIEVAL", False):
+        return
+    from .bm25 import BM25Index, index_exists
+    if not index_exists(faiss_dir):
+        print(f"⚠ HYBRID_RETRIEVAL is on but {faiss_dir} has no BM25 index; "
+              f"run `python -m app build-index --bm25`. Using dense retrieval only.")
+        return
+    bm25 = BM25Index(faiss_dir)
+    if len(bm25) != int(vs.index.ntotal):
+        print(f"⚠ BM25 index covers {len(bm25)} rows but index.faiss has {vs.index.ntotal}; rebuild it. Dense only.")
+        return
+    vs.hybrid = HybridSearch(bm25, cfg)
+
+def attach_sentences(vs, cfg: Dict[str, Any], faiss_dir: str) -> None:
+    """Hang the folder's precomputed sentence splits / cue scores on the store when they match the index."""
+    vs.sentences = None
+    if not cfg.get("SENTENCE_INDEX", True):
+        return
+    from .sentences import SentenceIndex, index_exists
+    if not index_exists(faiss_dir):
+        return
+    sentences = SentenceIndex(faiss_dir)
+    if len(sentences) != int(vs.index.ntotal):
+        print(f"⚠ Sentence index covers {len(sentences)} rows but index.faiss has {vs.index.ntotal}; "
+              f"run `python -m app build-index --sentences`. Filtering context per request.")
+        return
+    if not sentences.current:
+        print("⚠ Sentence index was built with other intent cues; "
+              "run `python -m app build-index --sentences`. Filtering context per request.")
+        return
+    vs.sentences = sentences
+
+def _hits_from_rows(vs, scored_rows) -> Tuple[List[Dict[str, Any]], List[float]]:
+    return _passages_for(vs).hits([row for row, _ in scored_rows]), [score for _, score in scored_rows]
+
+def _scored_rows(vs, vector, k: int) -> List[Tuple[int, float]]:
+    return [(row, 1.0 - dist / 2.0) for row, dist in vs.search_rows(vector, k)]
+
+def retrieve_top_k(vs: "FAISS", query: str, k: int) -> List[Dict[str, Any]]:
+    if getattr(vs, "hybrid", None) is not None:
+        return _hits_from_rows(vs, vs.hybrid.search(vs, query, k))[0]
+    if isinstance(vs, MmapVectorStore):
+        return _hits_from_rows(vs, _scored_rows(vs, vs.embedding_function.embed_query(query), k))[0]
     docs = vs.similarity_search(query, k=k)
     return [{"passage": d.page_content, "doc_id": int(d.metadata.get("doc_id"))} for d in docs]
+
+def retrieve_by_vector(vs: "FAISS", vector: List[float], k: int, query: Optional[str] = None) -> List[Dict[str, Any]]:
+    """retrieve_top_k for an already-embedded query, so embedding and search can be timed separately."""
+    if query is not None and getattr(vs, "hybrid", None) is not None:
+        return _hits_from_rows(vs, vs.hybrid.search(vs, query, k, vector=vector))[0]
+    if isinstance(vs, MmapVectorStore):
+        return _hits_from_rows(vs, _scored_rows(vs, vector, k))[0]
+    docs = vs.similarity_search_by_vector(vector, k=k)
+    return [{"passage": d.page_content, "doc_id": int(d.metadata.get("doc_id"))} for d in docs]
+
+def retrieve_top_k_scored(vs: "FAISS", query: str, k: int) -> Tuple[List[Dict[str, Any]], List[float]]:
+    """
+    Like retrieve_top_k, plus a cosine relevance per hit. MiniLM vectors are unit-norm,
+    so the squared L2 distance d returned by the index maps to cosine as 1 - d/2
+    (approximately so for the quantized INDEX_TYPEs).
+    """
+    if getattr(vs, "hybrid", None) is not None:
+        return _hits_from_rows(vs, vs.hybrid.search(vs, query, k))
+    if isinstance(vs, MmapVectorStore):
+        return _hits_from_rows(vs, _scored_rows(vs, vs.embedding_function.embed_query(query), k))
+    pairs = vs.similarity_search_with_score(query, k=k)
+    hits = [{"passage": d.page_content, "doc_id": int(d.metadata.get("doc_id"))} for d, _ in pairs]
+    return hits, [1.0 - float(dist) / 2.0 for _, dist in pairs]
+
+def retrieve_batch(vs: "FAISS", vectors, k: int,
+                   queries: Optional[List[str]] = None) -> Tuple[List[List[Dict[str, Any]]], List[List[float]]]:
+    """
+    Batched retrieve_top_k_scored for already-embedded queries: a single index.search over the
+    whole query matrix instead of one call per question. Works on both the LangChain store and
+    MmapVectorStore. Pass the query texts to fuse in BM25 when hybrid retrieval is on.
+    """
+    if not len(vectors):
+        return [], []
+    if queries is not None and getattr(vs, "hybrid", None) is not None:
+        ranked = vs.hybrid.search_batch(vs, queries, vectors, k)
+    else:
+        ranked = [[(r, 1.0 - d / 2.0) for r, d in rows] for rows in _dense_rows(vs, vectors, k)]
+    pairs = [_hits_from_rows(vs, rows) for rows in ranked]
+    return [h for h, _ in pairs], [sc for _, sc in pairs]
@@ -0,0 +1,137 @@
+import json, os, re, threading, time
+from typing import Any, Dict, List, Optional
+
+from .cache import LRUCache, normalize_text
+
+REWRITER_MODES = ("none", "llm", "llm-greedy", "lexical")
+_TERMS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources", "biomed_terms.json")
+_TOKEN = re.compile(r"[A-Za-z][A-Za-z0-9\-]*")
+
+class LexicalExpander:
+    """
+    Dictionary-driven query expansion: uppercase abbreviations are spelled out and
+    lay terms get their clinical synonyms appended. Costs microseconds, no model call.
+    """
+
+    def __init__(self, path: str = _TERMS_PATH):
+        with open(path, "r", encoding="utf-8") as f:
+            terms = json.load(f)
+        self.abbreviations: Dict[str, str] = {k.lower(): v for k, v in terms.get("abbreviations", {}).items()}
+        synonyms = {k.lower(): v for k, v in terms.get("synonyms", {}).items()}
+        # longest phrases first so "heart attack" wins over "heart"
+        self._phrases = sorted(synonyms.items(), key=lambda kv: -len(kv[0]))
+        self._phrase_pats = [(re.compile(rf"\b{re.escape(p)}\b", re.I), syns) for p, syns in self._phrases]
+
+    def expand(self, question: str) -> str:
+        extra: List[str] = []
+        seen = set(normalize_text(question).split())
+        for tok in _TOKEN.findall(question):
+            full = self.abbreviations.get(tok.lower())
+            # only expand tokens written as abbreviations ("MI", "lncRNA"), never plain words like "all"
+            if full and tok != tok.lower():
+                extra.append(full)
+        consumed = question
+        for pat, syns in self._phrase_pats:
+            if pat.search(consumed):
+                extra.extend(syns)
+                consumed = pat.sub(" ", consumed)
+        out: List[str] = []
+        for term in extra:
+            if term.lower() not in seen:
+                seen.add(term.lower())
+                out.append(term)
+        return f"{question} {' '.join(out)}" if out else question
+
+class QueryRewriter:
+    """
+    Pluggable rewriting stage in front of retrieval.
+
+    Modes:
+      none        pass the question through
+      llm         Gemma beam-search rewrite via the build_rewriter pipeline (original behaviour)
+      llm-greedy  same prompt, greedy decoding with a small token budget
+      lexical     LexicalExpander over app/resources/biomed_terms.json
+
+    Results are memoized per (mode, option, normalized question), and per-mode latency
+    is tracked for /health. With REWRITE_POLICY="on_low_score" the caller first retrieves
+    with the raw question and only rewrites when the best relevance is below
+    REWRITE_SCORE_THRESHOLD (see should_rewrite).
+    """
+
+    def __init__(self, cfg: Dict[str, Any], gen_pipeline=None):
+        mode = str(cfg.get("REWRITER_MODE", "llm")).lower()
+        if not cfg.get("USE_REWRITER", True):
+            mode = "none"
+        if mode not in REWRITER_MODES:
+            raise ValueError(f"Unknown REWRITER_MODE {mode!r}; expected one of {REWRITER_MODES}")
+        if mode.startswith("llm") and gen_pipeline is None:
+            print(f"⚠ REWRITER_MODE={mode} but no generation pipeline is loaded; falling back to 'none'.")
+            mode = "none"
+        self.mode = mode
+        self.gen_pipeline = gen_pipeline
+        self.policy = str(cfg.get("REWRITE_POLICY", "always")).lower()
+        self.threshold = float(cfg.get("REWRITE_SCORE_THRESHOLD", 0.5))
+        self.lexical = LexicalExpander() if mode == "lexical" else None
+        self.memo = LRUCache("rewrites", int(cfg.get("REWRITE_CACHE_SIZE", 4096)), 0)
+        self._lock = threading.Lock()
+        self._latency = {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "last_ms": 0.0}
+        self.skipped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "none"
+
+    def should_rewrite(self, best_score: Optional[float]) -> bool:
+        """Under the on_low_score policy, rewrite only when first-pass retrieval looks weak."""
+        if not self.enabled:
+            return False
+        if self.policy != "on_low_score" or best_score is None:
+            return True
+        if best_score >= self.threshold:
+            with self._lock:
+                self.skipped += 1
+            return False
+        return True
+
+    def _run(self, question: str, preferred_option: str) -> str:
+        if self.mode == "lexical":
+            return self.lexical.expand(question)
+        if self.mode in ("llm", "llm-greedy"):
+            from .gemma import rewrite_query
+            return rewrite_query(self.gen_pipeline, question, preferred_option=preferred_option)
+        return question
+
+    def rewrite(self, question: str, preferred_option: str = "Option 2") -> str:
+        if not self.enabled:
+            return question
+        key = f"{self.mode}|{preferred_option}|{normalize_text(question)}"
+        cached = self.memo.get(key)
+        if cached is not None:
+            return cached
+        t0 = time.perf_counter()
+        out = self._run(question, preferred_option)
+        ms = (time.perf_counter() - t0) * 1000.0
+        with self._lock:
+            lat = self._latency
+            lat["count"] += 1
+            lat["total_ms"] += ms
+            lat["last_ms"] = ms
+            lat["max_ms"] = max(lat["max_ms"], ms)
+        self.memo.set(key, out)
+        return out
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lat = dict(self._latency)
+            skipped = self.skipped
+        return {
+            "mode": self.mode,
+            "policy": self.policy,
+            "score_threshold": self.threshold if self.policy == "on_low_score" else None,
+            "rewrites": lat["count"],
+            "skipped_by_policy": skipped,
+            "avg_ms": round(lat["total_ms"] / lat["count"], 2) if lat["count"] else 0.0,
+            "last_ms": round(lat["last_ms"], 2),
+            "max_ms": round(lat["max_ms"], 2),
+            "memo": self.memo.stats(),
+        }
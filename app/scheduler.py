@@ -0,0 +1,166 @@
+import queue, threading, time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Tuple
+
+class _Pending:
+    __slots__ = ("item", "future", "enqueued")
+
+    def __init__(self, item: Tuple[str, str]):
+        self.item = item
+        self.future: Future = Future()
+        self.enqueued = time.perf_counter()
+
+class _PendingBatch:
+    """A caller-formed batch (e.g. a length-sorted /ask/batch group) that runs as one generate call."""
+    __slots__ = ("items", "future", "enqueued")
+
+    def __init__(self, items: List[Tuple[str, str]]):
+        self.items = items
+        self.future: Future = Future()
+        self.enqueued = time.perf_counter()
+
+class BatchScheduler:
+    """
+    Micro-batching front for answer generation.
+
+    Callers block in submit(); a single worker thread collects in-flight
+    requests until either max_batch_size is reached or max_wait_ms has passed
+    since the first one arrived, runs them through run_batch as one padded
+    generate call, and hands each answer back to its own caller.
+    submit_batch() queues a whole pre-formed batch instead; it runs on its own,
+    in order with the single requests, so the model only ever has one caller.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[List[Tuple[str, str]]], List[str]],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 20.0,
+    ):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue: "queue.Queue" = queue.Queue()
+        self._held: "_PendingBatch | None" = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="gemma-batcher", daemon=True)
+        self._stats = {
+            "batches": 0,
+            "requests": 0,
+            "last_batch_size": 0,
+            "max_batch_size_seen": 0,
+            "queue_wait_ms_total": 0.0,
+            "last_queue_wait_ms": 0.0,
+            "max_queue_wait_ms": 0.0,
+        }
+
+    def start(self) -> "BatchScheduler":
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def submit(self, question: str, context: str) -> str:
+        return self.submit_async(question, context).result()
+
+    def submit_async(self, question: str, context: str) -> Future:
+        pending = _Pending((question, context))
+        self._queue.put(pending)
+        return pending.future
+
+    def submit_batch(self, items: List[Tuple[str, str]]) -> Future:
+        """Queue `items` to run as exactly one run_batch call; the future resolves to its result list."""
+        pending = _PendingBatch(list(items))
+        self._queue.put(pending)
+        return pending.future
+
+    def _collect(self):
+        if self._held is not None:
+            first, self._held = self._held, None
+        else:
+            try:
+                first = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                return []
+        if isinstance(first, _PendingBatch):
+            return first
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                nxt = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if isinstance(nxt, _PendingBatch):
+                # keep it for the next round rather than mixing it into this one
+                self._held = nxt
+                break
+            batch.append(nxt)
+        return batch
+
+    def _run_formed(self, pending: _PendingBatch) -> None:
+        wait = (time.perf_counter() - pending.enqueued) * 1000.0
+        self._record(len(pending.items), [wait] * len(pending.items))
+        if not pending.future.set_running_or_notify_cancel():
+            return
+        try:
+            pending.future.set_result(self.run_batch(pending.items))
+        except Exception as e:
+            pending.future.set_exception(e)
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            batch = self._collect()
+            if isinstance(batch, _PendingBatch):
+                self._run_formed(batch)
+                continue
+            if not batch:
+                continue
+            started = time.perf_counter()
+            waits = [(started - p.enqueued) * 1000.0 for p in batch]
+            self._record(len(batch), waits)
+            live = [p for p in batch if p.future.set_running_or_notify_cancel()]
+            if not live:
+                continue
+            try:
+                answers = self.run_batch([p.item for p in live])
+            except Exception as e:
+                for p in live:
+                    p.future.set_exception(e)
+                continue
+            for p, answer in zip(live, answers):
+                p.future.set_result(answer)
+
+    def _record(self, size: int, waits: List[float]) -> None:
+        with self._lock:
+            s = self._stats
+            s["batches"] += 1
+            s["requests"] += size
+            s["last_batch_size"] = size
+            s["max_batch_size_seen"] = max(s["max_batch_size_seen"], size)
+            s["queue_wait_ms_total"] += sum(waits)
+            s["last_queue_wait_ms"] = max(waits)
+            s["max_queue_wait_ms"] = max(s["max_queue_wait_ms"], max(waits))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            s = dict(self._stats)
+        requests = s.pop("requests")
+        wait_total = s.pop("queue_wait_ms_total")
+        return {
+            **s,
+            "requests": requests,
+            "queue_depth": self._queue.qsize(),
+            "avg_batch_size": round(requests / s["batches"], 2) if s["batches"] else 0.0,
+            "avg_queue_wait_ms": round(wait_total / requests, 2) if requests else 0.0,
+            "last_queue_wait_ms": round(s["last_queue_wait_ms"], 2),
+            "max_queue_wait_ms": round(s["max_queue_wait_ms"], 2),
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+        }
@@ -0,0 +1,152 @@
+"""
+Precomputed sentence splits and intent cue scores, row-aligned with the FAISS index, so the
+default (untokenized) context filter is a lookup and a sort instead of a regex pass per request.
+
+Files (next to index.faiss, all memory-mapped at load):
+  sentences.bin          UTF-8 text of every sentence of every passage, concatenated
+  sentences.offsets.npy  int64[S + 1]; sentence i is bin[offsets[i]:offsets[i + 1]]
+  sentences.lengths.npy  int32[S]; length of sentence i in characters (the ranking tie-break)
+  sentences.cues.npy     uint8[S, I]; cue matches of sentence i for each intent in meta["intents"]
+  sentences.rows.npy     int64[N + 1]; sentences of FAISS row r are [rows[r], rows[r + 1])
+  sentences.doc_ids.npy  int64[D]; sorted doc_ids ...
+  sentences.doc_rows.npy int64[D]; ... and the row holding each (the newest when a doc_id repeats)
+  sentences.meta.json    intents, cue fingerprint and counts; a fingerprint that no longer matches
+                         intent.py (cues or splitter edited) makes the server ignore the files
+
+Build with `python -m app build-index --sentences` (full builds, appends and compactions
+rebuild it automatically when it exists).
+"""
+import json, os
+from array import array
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .intent import CUE_INTENTS, CUE_MATCHER, FilteredContext, cue_fingerprint, rank_order, split_sentences
+
+BLOB_FILE = "sentences.bin"
+OFFSETS_FILE = "sentences.offsets.npy"
+LENGTHS_FILE = "sentences.lengths.npy"
+CUES_FILE = "sentences.cues.npy"
+ROWS_FILE = "sentences.rows.npy"
+DOC_IDS_FILE = "sentences.doc_ids.npy"
+DOC_ROWS_FILE = "sentences.doc_rows.npy"
+META_FILE = "sentences.meta.json"
+
+def index_exists(directory: str) -> bool:
+    return all(os.path.exists(os.path.join(directory, f))
+               for f in (BLOB_FILE, OFFSETS_FILE, LENGTHS_FILE, CUES_FILE, ROWS_FILE, DOC_IDS_FILE,
+                         DOC_ROWS_FILE, META_FILE))
+
+def build_sentence_index(directory: str, rows: Iterable[Tuple[str, int]]) -> int:
+    """Split and cue-score (text, doc_id) rows in FAISS row order; one matcher scan per sentence."""
+    offsets, lengths = array("q", [0]), array("i")
+    row_starts, doc_ids = array("q", [0]), array("q")
+    cues = array("B")
+    tmp_blob = os.path.join(directory, BLOB_FILE + ".tmp")
+    with open(tmp_blob, "wb") as f:
+        for text, doc_id in rows:
+            sents = split_sentences(text or "")
+            for s in sents:
+                data = s.encode("utf-8")
+                f.write(data)
+                offsets.append(offsets[-1] + len(data))
+                lengths.append(len(s))
+                cues.extend(min(c, 255) for c in CUE_MATCHER.scores(s))
+            row_starts.append(row_starts[-1] + len(sents))
+            doc_ids.append(int(doc_id))
+
+    n_rows = len(doc_ids)
+    ids = np.frombuffer(doc_ids, dtype=np.int64) if n_rows else np.zeros(0, dtype=np.int64)
+    row_ids = np.arange(n_rows, dtype=np.int64)
+    # sorted by doc_id, newest row first within a doc_id; keep that first one
+    order = np.lexsort((-row_ids, ids))
+    first = np.ones(n_rows, dtype=bool)
+    first[1:] = ids[order][1:] != ids[order][:-1]
+    keep = order[first]
+
+    def save(name: str, arr: np.ndarray) -> None:
+        tmp = os.path.join(directory, name + ".tmp.npy")
+        np.save(tmp, arr)
+        os.replace(tmp, os.path.join(directory, name))
+
+    save(OFFSETS_FILE, np.frombuffer(offsets, dtype=np.int64))
+    save(LENGTHS_FILE, np.frombuffer(lengths, dtype=np.int32) if len(lengths) else np.zeros(0, dtype=np.int32))
+    save(CUES_FILE, np.frombuffer(cues, dtype=np.uint8).reshape(len(lengths), len(CUE_INTENTS))
+         if len(cues) else np.zeros((len(lengths), len(CUE_INTENTS)), dtype=np.uint8))
+    save(ROWS_FILE, np.frombuffer(row_starts, dtype=np.int64))
+    save(DOC_IDS_FILE, ids[keep])
+    save(DOC_ROWS_FILE, row_ids[keep])
+    os.replace(tmp_blob, os.path.join(directory, BLOB_FILE))
+    meta = {"intents": list(CUE_INTENTS), "fingerprint": cue_fingerprint(), "rows": n_rows,
+            "sentences": len(lengths)}
+    tmp = os.path.join(directory, META_FILE + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp, os.path.join(directory, META_FILE))
+    return n_rows
+
+def _mmap(directory: str, name: str) -> np.ndarray:
+    # plain ndarray views of the mapping: indexing np.memmap objects costs more than the lookups themselves
+    return np.asarray(np.load(os.path.join(directory, name), mmap_mode="r"))
+
+class SentenceIndex:
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, META_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.intents: List[str] = list(meta["intents"])
+        self.fingerprint: str = meta["fingerprint"]
+        self.offsets = _mmap(directory, OFFSETS_FILE)
+        self.lengths = _mmap(directory, LENGTHS_FILE)
+        self.cues = _mmap(directory, CUES_FILE)
+        self.rows = _mmap(directory, ROWS_FILE)
+        self.doc_ids = _mmap(directory, DOC_IDS_FILE)
+        self.doc_rows = _mmap(directory, DOC_ROWS_FILE)
+        blob_path = os.path.join(directory, BLOB_FILE)
+        # np.memmap refuses zero-length files
+        if os.path.getsize(blob_path):
+            self.blob = np.asarray(np.memmap(blob_path, dtype=np.uint8, mode="r"))
+        else:
+            self.blob = np.zeros(0, dtype=np.uint8)
+        if len(self.offsets) != len(self.lengths) + 1 or len(self.cues) != len(self.lengths):
+            raise RuntimeError(f"Corrupt sentence index in {directory}: array lengths disagree")
+
+    def __len__(self) -> int:
+        return len(self.rows) - 1
+
+    @property
+    def current(self) -> bool:
+        """Whether the stored cue scores were computed with the cue sets intent.py has now."""
+        return self.fingerprint == cue_fingerprint() and self.intents == list(CUE_INTENTS)
+
+    def text(self, i: int) -> str:
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return self.blob[start:end].tobytes().decode("utf-8")
+
+    def filter(self, hits: Sequence[Dict[str, Any]], intent: str, max_sents: int = 15) -> Optional[FilteredContext]:
+        """
+        filter_context_for_intent over the hits' passages from the stored splits and scores;
+        None when a hit has no doc_id in the index (the caller filters the joined text instead).
+        """
+        if any(hit.get("doc_id") is None for hit in hits):
+            return None
+        wanted = np.fromiter((int(hit["doc_id"]) for hit in hits), dtype=np.int64, count=len(hits))
+        pos = np.searchsorted(self.doc_ids, wanted)
+        if len(wanted) and (pos.max() >= len(self.doc_ids) or (self.doc_ids[pos] != wanted).any()):
+            return None
+        rows = self.doc_rows[pos]
+        starts, ends = self.rows[rows], self.rows[rows + 1]
+        ids = np.concatenate([np.arange(a, b) for a, b in zip(starts.tolist(), ends.tolist())]) \
+            if len(rows) else np.zeros(0, dtype=np.int64)
+        if not len(ids):
+            return FilteredContext("", intent)
+        lengths = np.asarray(self.lengths[ids], dtype=np.int64)
+        scores = None
+        if intent in self.intents:
+            scores = np.asarray(self.cues[ids, self.intents.index(intent)], dtype=np.int64)
+        order = rank_order(lengths, scores, max_sents)
+        return FilteredContext(" ".join(self.text(int(i)) for i in ids[order]), intent)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"rows": len(self), "sentences": len(self.lengths), "intents": self.intents,
+                "fingerprint": self.fingerprint}
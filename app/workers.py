@@ -0,0 +1,442 @@
+"""
+Pre-fork serving: one supervisor, WORKERS worker processes and a front router on PORT.
+
+  supervisor  loads the embedder, the mmap'd FAISS index + passage store and Gemma once,
+              then forks every worker (and the router) from that state. Weights and index
+              pages are shared copy-on-write / through the page cache, so N workers cost
+              about one model's worth of RAM. gc.freeze() keeps the collector from touching
+              the inherited objects (which would copy their pages). A worker that exits or is
+              recycled is re-forked from the same in-memory state, without reading the model
+              from disk again.
+  worker      pinned to its own slice of the CPU affinity set (WORKER_PIN_CORES), with torch
+              threads to match; serves the usual Flask or ASGI app (SERVER_MODE) on
+              127.0.0.1:<WORKER_BASE_PORT + i>.
+  router      forwards each request to the worker with the fewest in-flight requests
+              (streams included), fans /reload and /reload/rollback out to every worker and
+              merges /health. After WORKER_MAX_REQUESTS a worker is drained (no new requests,
+              in-flight ones finish) and recycled, one at a time so capacity never drops to zero.
+
+Run with:  python -m app.workers [--workers N]   (or WORKERS=N with docker-entrypoint.sh)
+Linux only (fork + sched_setaffinity).
+"""
+import argparse, asyncio, gc, os, select, signal, sys, time, traceback
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+from .config import load_config
+
+CFG = load_config()
+
+def core_sets(n: int, cpus: Optional[List[int]] = None) -> List[List[int]]:
+    """Split the CPU affinity set into n contiguous slices; workers share cores when n exceeds them."""
+    cpus = sorted(cpus if cpus is not None else os.sched_getaffinity(0))
+    if n >= len(cpus):
+        return [[cpus[i % len(cpus)]] for i in range(n)]
+    size, extra = divmod(len(cpus), n)
+    out, start = [], 0
+    for i in range(n):
+        end = start + size + (1 if i < extra else 0)
+        out.append(cpus[start:end])
+        start = end
+    return out
+
+def worker_ports(cfg: Dict[str, Any], n: int) -> List[int]:
+    base = int(cfg.get("WORKER_BASE_PORT", 0)) or int(cfg.get("PORT", 8080)) + 1
+    return [base + i for i in range(n)]
+
+# -----------------------------
+# Worker
+# -----------------------------
+def _serve_worker(index: int, port: int, cores: List[int], threads: int) -> None:
+    from . import main as core
+
+    if cores and CFG.get("WORKER_PIN_CORES", True):
+        os.sched_setaffinity(0, cores)
+    core.after_fork({"worker": index, "pid": os.getpid(), "cores": cores}, threads)
+    print(f"✅ Worker {index} (pid {os.getpid()}) on 127.0.0.1:{port}, cores {cores}")
+    if str(CFG.get("SERVER_MODE", "flask")).lower() == "asgi":
+        import uvicorn
+        from .asgi import app as asgi_app
+        # the lifespan's startup() is a no-op here: everything was inherited from the supervisor
+        uvicorn.Server(uvicorn.Config(asgi_app, host="127.0.0.1", port=port, log_level="warning")).run()
+    else:
+        from werkzeug.serving import make_server
+        make_server("127.0.0.1", port, core.app, threaded=True).serve_forever()
+
+# -----------------------------
+# Router
+# -----------------------------
+_HOP_HEADERS = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailer",
+                "transfer-encoding", "upgrade", "host", "content-length"}
+
+def _forward_headers(headers) -> Dict[str, str]:
+    return {k: v for k, v in headers.items() if k.lower() not in _HOP_HEADERS}
+
+class _Worker:
+    __slots__ = ("index", "port", "cores", "pid", "retired_pid", "up", "draining", "recycle_requested",
+                 "in_flight", "served", "total", "recycles", "failures")
+
+    def __init__(self, index: int, port: int, cores: List[int]):
+        self.index = index
+        self.port = port
+        self.cores = cores
+        self.pid = self.retired_pid = None
+        self.up = False
+        self.draining = False
+        self.recycle_requested = False
+        self.in_flight = 0
+        self.served = 0  # since the last recycle
+        self.total = 0
+        self.recycles = 0
+        self.failures = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def describe(self) -> Dict[str, Any]:
+        return {"worker": self.index, "port": self.port, "cores": self.cores, "pid": self.pid, "up": self.up,
+                "draining": self.draining, "in_flight": self.in_flight, "served": self.served,
+                "total": self.total, "recycles": self.recycles, "failures": self.failures}
+
+class Router:
+    """
+    Least-loaded routing and drain/recycle bookkeeping. Runs on the router's event loop
+    only, so plain counters are enough.
+    """
+
+    def __init__(self, workers: List[_Worker], max_requests: int, send: Callable[[str], None]):
+        self.workers = workers
+        self.max_requests = max_requests
+        self.send = send
+        self.unavailable = 0
+
+    def pick(self, exclude=()) -> Optional[_Worker]:
+        live = [w for w in self.workers if w.up and not w.draining and w not in exclude]
+        if not live:
+            self.unavailable += 1
+            return None
+        # fewest in flight; among equals the one that has served least, so idle workers rotate
+        return min(live, key=lambda w: (w.in_flight, w.total))
+
+    def acquire(self, w: _Worker) -> None:
+        w.in_flight += 1
+        w.served += 1
+        w.total += 1
+
+    def release(self, w: _Worker) -> None:
+        w.in_flight -= 1
+        self.maybe_recycle(w)
+
+    def mark_down(self, w: _Worker) -> None:
+        w.up = False
+        w.failures += 1
+
+    def maybe_recycle(self, w: _Worker) -> None:
+        if not w.draining and w.up and (w.recycle_requested or (self.max_requests and w.served >= self.max_requests)):
+            others = [o for o in self.workers if o is not w]
+            # one at a time, and only while every other worker is serving
+            if others and all(o.up and not o.draining for o in others):
+                w.draining = True
+        if w.draining and w.in_flight == 0:
+            w.up = w.draining = w.recycle_requested = False
+            w.retired_pid = w.pid  # until the supervisor has replaced it, that process still answers /health
+            w.served = 0
+            w.recycles += 1
+            self.send(f"recycle {w.index}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": [w.describe() for w in self.workers],
+            "live": sum(1 for w in self.workers if w.up and not w.draining),
+            "routed": sum(w.total for w in self.workers),
+            "unavailable": self.unavailable,
+            "max_requests": self.max_requests,
+        }
+
+def build_router_app(router: Router, timeout_s: float):
+    import httpx
+    from starlette.applications import Starlette
+    from starlette.background import BackgroundTask
+    from starlette.requests import Request
+    from starlette.responses import JSONResponse, StreamingResponse
+    from starlette.routing import Route
+
+    client = httpx.AsyncClient(timeout=httpx.Timeout(timeout_s, connect=2.0),
+                               limits=httpx.Limits(max_connections=None, max_keepalive_connections=64))
+
+    async def probe_loop():
+        while True:
+            for w in router.workers:
+                if not w.up and not w.draining:
+                    try:
+                        r = await client.get(w.url + "/health", timeout=2.0)
+                        payload = r.json()
+                        pid = (payload.get("worker") or {}).get("pid")
+                        if r.status_code == 200 and payload.get("ready") and pid != w.retired_pid:
+                            w.up, w.pid = True, pid
+                    except (httpx.HTTPError, ValueError):
+                        pass
+                router.maybe_recycle(w)
+            await asyncio.sleep(0.5)
+
+    async def proxy(request: Request):
+        body = await request.body()
+        tried: List[_Worker] = []
+        while True:
+            w = router.pick(tried)
+            if w is None:
+                return JSONResponse({"error": "No worker available, try again later"}, status_code=503,
+                                    headers={"Retry-After": "1"})
+            router.acquire(w)
+            upstream_req = client.build_request(request.method, w.url + request.url.path,
+                                                params=request.query_params, headers=_forward_headers(request.headers),
+                                                content=body)
+            try:
+                upstream = await client.send(upstream_req, stream=True)
+                break
+            except httpx.ConnectError:
+                # never reached the worker (recycling or crashed): safe to try the next one
+                router.release(w)
+                router.mark_down(w)
+                tried.append(w)
+            except httpx.HTTPError as e:
+                router.release(w)
+                return JSONResponse({"error": f"Worker {w.index} failed: {e}"}, status_code=502)
+
+        released = False
+
+        def done():
+            nonlocal released
+            if not released:
+                released = True
+                router.release(w)
+
+        async def stream():
+            try:
+                async for chunk in upstream.aiter_raw():
+                    yield chunk
+            finally:
+                await upstream.aclose()
+                done()
+
+        headers = _forward_headers(upstream.headers)
+        headers["X-Worker"] = str(w.index)
+        # done() also runs as a background task in case the client disconnects mid-stream
+        return StreamingResponse(stream(), status_code=upstream.status_code, headers=headers,
+                                 background=BackgroundTask(done))
+
+    async def _each(method: str, path: str, body: bytes = b"", headers=None, timeout=None):
+        async def one(w: _Worker):
+            try:
+                r = await client.request(method, w.url + path, content=body, headers=headers,
+                                         timeout=timeout or client.timeout)
+                return r.status_code, {"worker": w.index, **r.json()}
+            except (httpx.HTTPError, ValueError) as e:
+                return 502, {"worker": w.index, "error": str(e)}
+        return await asyncio.gather(*(one(w) for w in router.workers if w.up))
+
+    async def health(request: Request):
+        results = await _each("GET", "/health", timeout=5.0)
+        ready = any(w.up for w in router.workers)
+        return JSONResponse({
+            "status": "ok" if ready else "starting",
+            "ready": ready,
+            "router": router.stats(),
+            "workers": [payload for _, payload in results],
+        }, status_code=200 if ready else 503)
+
+    async def broadcast(request: Request):
+        """/reload and /reload/rollback apply to every live worker; the worst status wins."""
+        results = await _each("POST", request.url.path, await request.body(),
+                              {"Content-Type": request.headers.get("content-type", "application/json")})
+        status = max((code for code, _ in results), default=503)
+        return JSONResponse({"workers": [payload for _, payload in results]}, status_code=status)
+
+    async def workers_endpoint(request: Request):
+        return JSONResponse(router.stats())
+
+    async def recycle_all(request: Request):
+        """Rolling recycle of every worker (one drains at a time); e.g. after changing weights on disk."""
+        for w in router.workers:
+            w.recycle_requested = True
+        return JSONResponse({"status": "recycling", "workers": len(router.workers)}, status_code=202)
+
+    @asynccontextmanager
+    async def lifespan(app):
+        prober = asyncio.get_running_loop().create_task(probe_loop())
+        try:
+            yield
+        finally:
+            prober.cancel()
+            await client.aclose()
+
+    return Starlette(
+        routes=[
+            Route("/health", health, methods=["GET"]),
+            Route("/workers", workers_endpoint, methods=["GET"]),
+            Route("/workers/recycle", recycle_all, methods=["POST"]),
+            Route("/reload", broadcast, methods=["POST"]),
+            Route("/reload/rollback", broadcast, methods=["POST"]),
+            Route("/{path:path}", proxy, methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"]),
+        ],
+        lifespan=lifespan,
+    )
+
+def _serve_router(workers: List[_Worker], cmd_fd: int) -> None:
+    import uvicorn
+
+    def send(line: str) -> None:
+        os.write(cmd_fd, (line + "\n").encode())
+
+    router = Router(workers, int(CFG.get("WORKER_MAX_REQUESTS", 0)), send)
+    app = build_router_app(router, float(CFG.get("WORKER_TIMEOUT_S", 300)))
+    print(f"✅ Router on 0.0.0.0:{CFG.get('PORT', 8080)} -> {len(workers)} workers")
+    uvicorn.run(app, host="0.0.0.0", port=int(CFG.get("PORT", 8080)), log_level="info")
+
+# -----------------------------
+# Supervisor
+# -----------------------------
+def _fork(target: Callable[..., None], *args) -> int:
+    pid = os.fork()
+    if pid:
+        return pid
+    code = 0
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C reaches the whole group; the supervisor decides
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        target(*args)
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        sys.stdout.flush()
+        os._exit(code)
+
+class Supervisor:
+    def __init__(self, n: int):
+        self.n = n
+        self.ports = worker_ports(CFG, n)
+        self.cores = core_sets(n) if CFG.get("WORKER_PIN_CORES", True) else [[] for _ in range(n)]
+        threads = int(CFG.get("CPU_THREADS", 0))
+        # pinned: one torch thread per owned core; unpinned: an equal share of the machine
+        from .cpu_backend import available_cpus
+        self.threads = [min(threads, len(c)) if threads else len(c) for c in self.cores] \
+            if CFG.get("WORKER_PIN_CORES", True) else [threads or max(1, available_cpus() // n)] * n
+        self.pids: Dict[int, int] = {}  # pid -> worker index
+        self.router_pid = 0
+        self.stopping = False
+        self.started = time.time()
+        self._cmd_r, self._cmd_w = os.pipe()
+
+    def load(self) -> None:
+        from . import main as core
+
+        core.CFG["WORKERS"] = self.n
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+        # single-threaded torch while loading: an OpenMP pool started here would not survive fork.
+        # Retrieval loads first and already runs forwards (embedder warmup and check, reranker warmup),
+        # so torch itself is limited before anything loads, not just the CPU_THREADS the model applies.
+        saved_env = {var: os.environ.get(var) for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS")}
+        os.environ.update(OMP_NUM_THREADS="1", MKL_NUM_THREADS="1")
+        import torch
+        torch.set_num_threads(1)
+        requested = core.CFG.get("CPU_THREADS", 0)
+        core.CFG["CPU_THREADS"] = 1
+        try:
+            core.startup(background=False)
+        finally:
+            core.CFG["CPU_THREADS"] = requested
+            for var, value in saved_env.items():
+                if value is None:
+                    os.environ.pop(var, None)
+                else:
+                    os.environ[var] = value
+        core.prepare_fork()
+        gc.collect()
+        gc.freeze()
+
+    def spawn_worker(self, i: int) -> None:
+        pid = _fork(_serve_worker, i, self.ports[i], self.cores[i], self.threads[i])
+        self.pids[pid] = i
+
+    def spawn_router(self) -> None:
+        workers = [_Worker(i, self.ports[i], self.cores[i]) for i in range(self.n)]
+        self.router_pid = _fork(_serve_router, workers, self._cmd_w)
+
+    def recycle(self, i: int) -> None:
+        pid = next((p for p, idx in self.pids.items() if idx == i), None)
+        if pid is not None:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+            del self.pids[pid]
+        if not self.stopping:
+            self.spawn_worker(i)
+
+    def _reap(self) -> None:
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid == self.router_pid:
+                print(f"⚠ Router exited ({status}); restarting it.")
+                if not self.stopping:
+                    self.spawn_router()
+            elif pid in self.pids:
+                i = self.pids.pop(pid)
+                print(f"⚠ Worker {i} (pid {pid}) exited ({status}); re-forking it.")
+                if not self.stopping:
+                    self.spawn_worker(i)
+
+    def _commands(self) -> None:
+        for line in os.read(self._cmd_r, 4096).decode().splitlines():
+            cmd, _, arg = line.partition(" ")
+            if cmd == "recycle" and arg.isdigit():
+                self.recycle(int(arg))
+
+    def _stop(self, *_) -> None:
+        self.stopping = True
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for i in range(self.n):
+            self.spawn_worker(i)
+        self.spawn_router()
+        print(f"✅ Supervisor {os.getpid()}: {self.n} workers on ports {self.ports}, cores {self.cores}")
+        while not self.stopping:
+            try:
+                ready, _, _ = select.select([self._cmd_r], [], [], 1.0)
+            except InterruptedError:
+                continue
+            if ready:
+                self._commands()
+            self._reap()
+        for pid in [self.router_pid, *self.pids]:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in [self.router_pid, *self.pids]:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+def run_pool(n: int) -> None:
+    supervisor = Supervisor(n)
+    supervisor.load()
+    supervisor.run()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-fork worker pool behind a least-loaded router")
+    parser.add_argument("--workers", type=int, default=int(CFG.get("WORKERS", 0)) or 2,
+                        help="worker processes (default: WORKERS from config, else 2)")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    run_pool(args.workers)
@@ -8,4 +8,16 @@ export PYTHONPATH=/app
 PORT=$(python -c "from app.config import load_config; print(load_config().get('PORT', 8080))")
 echo "✅ Using port: $PORT"
 
+WORKERS=$(python -c "from app.config import load_config; print(int(load_config().get('WORKERS', 0)))")
+if [ "$WORKERS" -gt 0 ]; then
+  echo "✅ Serving with $WORKERS pre-forked workers behind the router"
+  exec python -m app.workers --workers "$WORKERS"
+fi
+
+SERVER_MODE=$(python -c "from app.config import load_config; print(load_config().get('SERVER_MODE', 'flask'))")
+if [ "$SERVER_MODE" = "asgi" ]; then
+  echo "✅ Serving with ASGI (uvicorn)"
+  exec python -m app.asgi
+fi
+
 exec python -m app.main
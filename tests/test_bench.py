@@ -0,0 +1,22 @@
+from app.bench import retrieval_metrics
+
+def test_recall_hit_and_mrr():
+    ranked = [[1, 2, 3], [4, 5, 6]]
+    relevant = [[2, 9], [7]]
+    out = retrieval_metrics(ranked, relevant, [1, 3])
+    assert out["recall@1"] == 0.0 and out["hit@1"] == 0.0
+    assert out["recall@3"] == 0.25 and out["hit@3"] == 0.5
+    assert out["mrr"] == 0.25
+    assert out["questions_evaluated"] == 2 and out["questions_skipped"] == 0
+
+def test_questions_without_relevant_ids_are_left_out():
+    out = retrieval_metrics([[1], [2], [3]], [[1], [], None], [1])
+    assert out["recall@1"] == 1.0 and out["hit@1"] == 1.0 and out["mrr"] == 1.0
+    assert out["questions_evaluated"] == 1 and out["questions_skipped"] == 2
+
+def test_no_evaluable_questions():
+    assert retrieval_metrics([[1]], [[]], [1, 3]) == {"questions_evaluated": 0, "questions_skipped": 1}
+
+def test_k_beyond_the_ranking():
+    out = retrieval_metrics([[3, 1]], [[1, 2]], [5])
+    assert out["recall@5"] == 0.5 and out["mrr"] == 0.5
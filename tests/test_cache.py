@@ -0,0 +1,61 @@
+import pytest
+
+pytest.importorskip("numpy")
+
+from app import cache
+from app.cache import LRUCache, SQLiteBackend
+
+class _Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = _Clock()
+    monkeypatch.setattr(cache, "time", c)
+    return c
+
+def test_entry_expires_after_ttl(clock):
+    lru = LRUCache("t", 8, ttl_s=10)
+    lru.set("a", 1)
+    clock.now += 9
+    assert lru.get("a") == 1
+    clock.now += 2
+    assert lru.get("a", "missing") == "missing"
+    assert (lru.hits, lru.misses) == (1, 1)
+
+def test_no_ttl_never_expires(clock):
+    lru = LRUCache("t", 8)
+    lru.set("a", 1)
+    clock.now += 10**9
+    assert lru.get("a") == 1
+
+def test_lru_eviction(clock):
+    lru = LRUCache("t", 2)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    lru.get("a")
+    lru.set("c", 3)
+    assert lru.get("b") is None
+    assert lru.get("a") == 1 and lru.get("c") == 3
+    assert lru.evictions == 1
+
+def test_backend_hit_keeps_the_stored_expiry(clock, tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "cache.sqlite"))
+    LRUCache("t", 8, ttl_s=10, backend=backend).set("a", {"x": 1})
+    clock.now += 8
+    # a fresh process: the entry comes from disk with 2s left, not a new 10s TTL
+    lru = LRUCache("t", 8, ttl_s=10, backend=backend)
+    assert lru.get("a") == {"x": 1}
+    clock.now += 3
+    assert lru.get("a") is None
+
+def test_backend_drops_expired_rows(clock, tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "cache.sqlite"))
+    backend.set("t", "a", 1, clock.now + 5)
+    assert backend.get("t", "a") == (1, clock.now + 5)
+    clock.now += 6
+    assert backend.get("t", "a") is cache._MISSING
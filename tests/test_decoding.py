@@ -0,0 +1,22 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from app.decoding import trim_at_stop
+
+def test_no_marker():
+    assert trim_at_stop("Lupus causes joint pain.") == "Lupus causes joint pain."
+
+def test_cuts_at_a_new_section():
+    assert trim_at_stop("Joint pain.\nQuestion: what else?") == "Joint pain."
+
+def test_cuts_at_the_earliest_marker():
+    text = "Fatigue.\nAnswer: x\nContext: y\nQuestion: z"
+    assert trim_at_stop(text) == "Fatigue."
+
+def test_marker_needs_a_line_start():
+    assert trim_at_stop("The Question: remains open.") == "The Question: remains open."
+
+def test_marker_at_the_start():
+    assert trim_at_stop("\nContext: leaked") == ""
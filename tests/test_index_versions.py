@@ -0,0 +1,52 @@
+import pytest
+
+from app.index_versions import IndexHandle, IndexRegistry
+
+def _handle(version):
+    return IndexHandle(object(), version, f"/idx/{version}")
+
+def test_acquire_without_index():
+    with pytest.raises(RuntimeError):
+        IndexRegistry().acquire()
+
+def test_swap_frees_an_unpinned_handle_at_once():
+    reg = IndexRegistry()
+    v1, v2 = _handle("v1"), _handle("v2")
+    assert reg.swap(v1) is None
+    assert reg.swap(v2) is v1
+    assert reg.current is v2
+    assert v1.retired and v1.vs is None
+    assert reg.stats()["draining"] == []
+
+def test_pinned_handle_drains_until_released():
+    reg = IndexRegistry()
+    v1, v2 = _handle("v1"), _handle("v2")
+    reg.swap(v1)
+    pinned = reg.acquire()
+    assert pinned is v1 and v1.refs == 1
+    reg.swap(v2)
+    # the in-flight request still reads the old store
+    assert v1.retired and v1.vs is not None
+    assert [h["version"] for h in reg.stats()["draining"]] == ["v1"]
+    reg.release(pinned)
+    assert v1.refs == 0 and v1.vs is None
+    assert reg.stats()["draining"] == []
+
+def test_release_keeps_the_current_handle():
+    reg = IndexRegistry()
+    v1 = _handle("v1")
+    reg.swap(v1)
+    reg.release(reg.acquire())
+    assert v1.vs is not None and not v1.retired
+
+def test_history_and_rollback():
+    reg = IndexRegistry(history=2)
+    for v in ("v1", "v2", "v3", "v4"):
+        reg.swap(_handle(v))
+    assert reg.stats()["previous"] == ["v3", "v2"]
+    assert reg.previous() == ("v3", "/idx/v3")
+    # a rollback swaps without recording the version it leaves
+    reg.swap(_handle("v3"), record=False)
+    reg.pop_previous()
+    assert reg.stats()["previous"] == ["v2"]
+    assert reg.swaps == 5
@@ -0,0 +1,62 @@
+import re
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from app.intent import INTENT_MATCHER, INTENT_PATTERNS, IntentMatcher, detect_question_intent
+
+QUESTIONS = [
+    "What are the symptoms of lupus?",
+    "What causes sickle cell anemia?",
+    "How is type 2 diabetes treated?",
+    "What are the risk factors for stroke?",
+    "What is the mechanism of action of aspirin?",
+    "What is psoriasis?",
+    "Which drug treats the symptoms caused by asthma?",
+    "Is obesity associated with the risk of breast cancer?",
+    "How does insulin work in the liver?",
+    "Define apoptosis and its underlying process.",
+    "Tell me about Crohn's disease.",
+    "",
+    "SIGNS AND SYMPTOMS OF MENINGITIS",
+    "asymptomatic carriers due to exposure",
+]
+
+def _first_by_loop(text):
+    # the original per-pattern scan, in priority order
+    for intent, pat in INTENT_PATTERNS.items():
+        if pat.search(text):
+            return intent
+    return None
+
+@pytest.mark.parametrize("question", QUESTIONS)
+def test_first_matches_the_per_pattern_loop(question):
+    assert INTENT_MATCHER.first(question) == _first_by_loop(question)
+    assert INTENT_MATCHER.first(question.lower()) == _first_by_loop(question.lower())
+
+@pytest.mark.parametrize("question", QUESTIONS)
+def test_matches_agrees_with_each_pattern(question):
+    assert INTENT_MATCHER.matches(question) == [bool(p.search(question)) for p in INTENT_PATTERNS.values()]
+
+def test_priority_wins_over_position():
+    # "treat" comes first in the text but symptoms has the higher priority
+    assert INTENT_MATCHER.first("how to treat a symptom") == "symptoms"
+
+def test_overlapping_patterns_at_one_position():
+    matcher = IntentMatcher([("a", r"\brisk factor\b"), ("b", r"\brisk\b")])
+    assert matcher.matches("risk factor") == [True, True]
+    assert matcher.first("risk") == "b"
+
+def test_scores_count_distinct_patterns_per_intent():
+    matcher = IntentMatcher([("x", r"\bfoo\b"), ("x", r"\bbar\b"), ("y", r"\bbaz\b")])
+    assert matcher.intents == ("x", "y")
+    assert matcher.scores("foo foo bar") == (2, 0)
+
+def test_empty_matcher():
+    matcher = IntentMatcher([])
+    assert matcher.first("anything") is None and matcher.matches("anything") == []
+
+def test_detect_question_intent_fallbacks():
+    assert detect_question_intent("Why does this happen?") == "causes"
+    assert detect_question_intent("Tell me about Crohn's disease.") == "general"
@@ -0,0 +1,68 @@
+from app import rerank
+from app.rerank import Reranker
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def perf_counter(self):
+        return self.now
+
+class _FakeReranker(Reranker):
+    """Scores a passage by its "score" field; every batch costs `batch_ms` on the fake clock."""
+
+    def __init__(self, clock, batch_ms, **cfg):
+        super().__init__(None, None, {"RERANK_TOP_N": 100, **cfg})
+        self.clock = clock
+        self.batch_ms = batch_ms
+        self.batches = []
+
+    def score(self, pairs):
+        self.batches.append(list(pairs))
+        self.clock.now += self.batch_ms / 1000.0
+        return [float(p.split(":")[1]) for _, p in pairs]
+
+def _hits(*scores):
+    return [{"doc_id": i, "passage": f"p{i}:{s}"} for i, s in enumerate(scores)]
+
+def _ids(hits):
+    return [h["doc_id"] for h in hits]
+
+def _reranker(monkeypatch, batch_ms, **cfg):
+    clock = _Clock()
+    monkeypatch.setattr(rerank, "time", clock)
+    return _FakeReranker(clock, batch_ms, **cfg)
+
+def test_reranks_within_budget(monkeypatch):
+    r = _reranker(monkeypatch, 10, RERANK_BUDGET_MS=100, RERANK_BATCH_SIZE=4)
+    out, fell_back = r.rerank_many(["q0", "q1"], [_hits(1, 3, 2), _hits(5, 9)], k=10)
+    assert fell_back == [False, False]
+    assert _ids(out[0]) == [1, 2, 0] and _ids(out[1]) == [1, 0]
+    assert out[0][0]["rerank_score"] == 3.0
+    # the pairs of both queries share batches
+    assert [len(b) for b in r.batches] == [4, 1]
+
+def test_keeps_at_most_k(monkeypatch):
+    r = _reranker(monkeypatch, 1, RERANK_TOP_N=2)
+    out, _ = r.rerank_many(["q"], [_hits(1, 3, 2)], k=5)
+    assert _ids(out[0]) == [1, 2]
+
+def test_overrun_falls_back_to_faiss_order(monkeypatch):
+    r = _reranker(monkeypatch, 200, RERANK_BUDGET_MS=100)
+    out, fell_back = r.rerank_many(["q"], [_hits(1, 3, 2)], k=10)
+    assert fell_back == [True]
+    assert _ids(out[0]) == [0, 1, 2]
+    assert "rerank_score" not in out[0][0]
+    assert r.stats()["fallbacks"] == 1
+
+def test_deadline_is_per_query(monkeypatch):
+    # q0 needs two batches of 60ms against a 100ms budget and falls back; q1's budget starts
+    # with the second batch, so it still fits although the whole call takes 120ms
+    r = _reranker(monkeypatch, 60, RERANK_BUDGET_MS=100, RERANK_BATCH_SIZE=2)
+    out, fell_back = r.rerank_many(["q0", "q1"], [_hits(1, 2, 3, 4), _hits(1, 2)], k=10)
+    assert fell_back == [True, False]
+    assert _ids(out[0]) == [0, 1, 2, 3]
+    assert _ids(out[1]) == [1, 0]
+    # q0's remaining pairs were skipped, not scored
+    assert [[p for _, p in b] for b in r.batches] == [["p0:1", "p1:2"], ["p0:1", "p1:2"]]
+    assert [q for q, _ in r.batches[1]] == ["q1", "q1"]
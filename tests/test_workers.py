@@ -0,0 +1,85 @@
+from app.workers import Router, _Worker, core_sets
+
+def _router(n=3, max_requests=0):
+    sent = []
+    workers = [_Worker(i, 9000 + i, [i]) for i in range(n)]
+    for w in workers:
+        w.up = True
+    return Router(workers, max_requests, sent.append), sent
+
+def test_core_sets_splits_contiguously():
+    assert core_sets(2, [0, 1, 2, 3]) == [[0, 1], [2, 3]]
+    # the first slices take the remainder
+    assert core_sets(3, [0, 1, 2, 3, 4, 5, 6]) == [[0, 1, 2], [3, 4], [5, 6]]
+
+def test_core_sets_unsorted_input():
+    assert core_sets(2, [3, 1, 2, 0]) == [[0, 1], [2, 3]]
+
+def test_core_sets_shares_cores_when_oversubscribed():
+    assert core_sets(5, [4, 5]) == [[4], [5], [4], [5], [4]]
+
+def test_pick_prefers_fewest_in_flight_then_least_served():
+    router, _ = _router()
+    a, b, c = router.workers
+    a.in_flight, b.in_flight, c.in_flight = 2, 1, 1
+    b.total, c.total = 5, 3
+    assert router.pick() is c
+    assert router.pick(exclude=(c,)) is b
+
+def test_pick_skips_down_and_draining_workers():
+    router, _ = _router()
+    a, b, c = router.workers
+    a.up = False
+    b.draining = True
+    assert router.pick() is c
+    assert router.pick(exclude=(c,)) is None
+    assert router.unavailable == 1
+
+def test_recycle_after_max_requests():
+    router, sent = _router(max_requests=2)
+    w = router.workers[0]
+    for _ in range(2):
+        router.acquire(w)
+        router.release(w)
+    assert sent == ["recycle 0"]
+    assert not w.up and not w.draining
+    assert w.served == 0 and w.total == 2 and w.recycles == 1
+
+def test_recycle_drains_in_flight_requests_first():
+    router, sent = _router(max_requests=1)
+    w = router.workers[0]
+    router.acquire(w)
+    router.acquire(w)
+    router.release(w)
+    assert w.draining and w.up
+    assert router.pick(exclude=router.workers[1:]) is None
+    assert sent == []
+    router.release(w)
+    assert sent == ["recycle 0"]
+    assert not w.draining
+
+def test_recycle_waits_while_another_worker_is_out():
+    router, sent = _router(max_requests=1)
+    a, b, _ = router.workers
+    b.up = False
+    router.acquire(a)
+    router.release(a)
+    assert not a.draining and sent == []
+    b.up = True
+    router.maybe_recycle(a)
+    assert sent == ["recycle 0"]
+
+def test_recycle_never_drains_the_only_worker():
+    router, sent = _router(n=1, max_requests=1)
+    w = router.workers[0]
+    router.acquire(w)
+    router.release(w)
+    assert w.up and sent == []
+
+def test_requested_recycle_without_max_requests():
+    router, sent = _router()
+    w = router.workers[1]
+    w.recycle_requested = True
+    router.maybe_recycle(w)
+    assert sent == ["recycle 1"]
+    assert not w.recycle_requested